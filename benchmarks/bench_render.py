@@ -0,0 +1,104 @@
+"""Micro-benchmark of rendering streamed answers for Telegram.
+
+Streams a large markdown answer in `--steps` growing prefixes, the way the
+bot re-renders an answer on every edit, and times rendering each prefix with
+one incremental `Renderer` against a fresh one per prefix.
+
+    python benchmarks/bench_render.py --size 20000 --steps 200
+"""
+from __future__ import annotations
+
+import typing as t
+import argparse
+import os
+import re
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from render import MESSAGE_LIMIT, Renderer, length, plain  # noqa: E402
+
+
+def make_answer(size: int) -> str:
+    """A Bing-like markdown answer of about `size` characters."""
+    parts = [
+        '[1]: https://example.com/a?x=1&y=2 ""',
+        '[2]: https://example.org/b ""',
+        "",
+        "## Overview",
+        "",
+    ]
+    i = 0
+    while sum(len(p) + 1 for p in parts) < size:
+        i += 1
+        parts += [
+            f"Paragraph {i} with **bold**, *italic*, `inline <code>` and a "
+            f"citation[^1^]. Some more words to make it longer, 中文也有一些。[^2^]",
+            "",
+            f"- item {i}.1 with [a link](https://example.com/{i})",
+            f"- item {i}.2",
+            "  - nested item",
+            "",
+            "```python",
+            *(f"def f{i}_{j}(x):\n    return x < {j}" for j in range(3)),
+            "```",
+            "",
+            "```",
+            f"output of run {i}",
+            "```",
+            "",
+        ]
+    return "\n".join(parts)
+
+
+def bench(
+    prefixes: t.List[str], make: t.Callable[[], Renderer], fresh: bool
+) -> t.List[float]:
+    times = []
+    renderer = make()
+    for prefix in prefixes:
+        if fresh:
+            renderer = make()
+        start = time.perf_counter()
+        renderer.render(prefix)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=20000, help="answer length")
+    parser.add_argument("--steps", type=int, default=200, help="streamed prefixes")
+    parser.add_argument("--plain", action="store_true", help="markdown rendering off")
+    args = parser.parse_args()
+
+    answer = make_answer(args.size)
+    step = max(len(answer) // args.steps, 1)
+    prefixes = [answer[:end] for end in range(step, len(answer), step)] + [answer]
+
+    def make():
+        return Renderer(markdown=not args.plain)
+
+    messages = make().render(answer)
+    # Only the labelled code blocks name a language.
+    languages = set(re.findall(r'class="language-([^"]*)"', "".join(messages)))
+    assert languages <= {"python"}, f"wrong code block languages: {languages}"
+    print(f"answer:        {len(answer)} chars, {len(prefixes)} prefixes")
+    print(
+        f"messages:      {len(messages)}, longest "
+        f"{max(length(plain(m)) for m in messages)} of {MESSAGE_LIMIT}"
+    )
+    for name, fresh in (("full", True), ("incremental", False)):
+        times = bench(prefixes, make, fresh)
+        print(
+            f"{name + ':':15}total {sum(times) * 1000:.1f}ms"
+            f"  mean {statistics.fmean(times) * 1000:.3f}ms"
+            f"  last {times[-1] * 1000:.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Micro-benchmark of saving and loading chat sessions.
+
+Times what `save_bot` and persistence do per turn for `--sessions` Bing
+sessions, with the dicts sessions were saved as before records (a deep copy
+of the context on every save) against session records, and reports the
+pickled bytes per session.
+
+    python benchmarks/bench_session.py --sessions 10000
+"""
+from __future__ import annotations
+
+import typing as t
+import argparse
+import copy
+import gc
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+# bing reads its accounts when imported.
+_cookie = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+json.dump([{"name": "_U", "value": "bench"}], _cookie)
+_cookie.close()
+os.environ.setdefault("BING_COOKIE_FILE", _cookie.name)
+
+import bing  # noqa: E402
+from persistence import _signature  # noqa: E402
+from record import SessionRecord  # noqa: E402
+
+
+def make_context(i: int) -> t.Dict[str, t.Any]:
+    """A context like the ones Bing's create endpoint returns."""
+    return {
+        "conversationId": f"51D|BingProd|{i:064X}",
+        "clientId": f"{i:020d}",
+        "conversationSignature": f"{i:044x}" + "=" * 4,
+        "result": {"value": "Success", "message": None},
+        "account": "cookie.json",
+        "invocation_id": 0,
+    }
+
+
+def legacy_serialize(bot: bing.Bot) -> t.Dict[str, t.Any]:
+    """What `bing.Bot.serialize` returned before session records."""
+    assert bot._client is not None
+    context = copy.deepcopy(dict(**t.cast(dict, bot._context)))
+    context["invocation_id"] = bot._client.request.invocation_id
+    return dict(info=bot.info(), context=context)
+
+
+def timed(fn: t.Callable[[], t.Any], n: int) -> float:
+    # Garbage left by the previous case would be collected in this one.
+    gc.collect()
+    start = time.perf_counter()
+    fn()
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10000)
+    args = parser.parse_args()
+    n = args.sessions
+
+    bots = [bing.Bot(f"bot-{i}", context=make_context(i)) for i in range(n)]
+
+    def turn():
+        for b in bots:
+            assert b._client is not None
+            b._client.request.invocation_id += 1
+            b._count += 1
+
+    legacy = [legacy_serialize(b) for b in bots]
+    records = [b.serialize() for b in bots]
+    for r in records:
+        r.saved = r.version
+
+    print(f"sessions:            {n}")
+    rows = [
+        ("dict save", lambda: [legacy_serialize(b) for b in bots]),
+        ("record save, same", lambda: [b.serialize() for b in bots]),
+        ("record save, turn", lambda: (turn(), [b.serialize() for b in bots])),
+        (
+            "dict load",
+            lambda: [bing.Bot.deserialize(SessionRecord.load(d)) for d in legacy],
+        ),
+        ("record load", lambda: [bing.Bot.deserialize(r) for r in records]),
+    ]
+    for name, fn in rows:
+        print(f"{name + ':':21}{timed(fn, n):12.0f} sessions/s")
+
+    chats = [dict(bot_data=r, last_active=time.time()) for r in records]
+    legacy_chats = [dict(bot_data=d, last_active=time.time()) for d in legacy]
+    rows = [
+        (
+            "pickle+digest dict",
+            lambda: [
+                hashlib.blake2b(pickle.dumps(c), digest_size=16).digest()
+                for c in legacy_chats
+            ],
+        ),
+        (
+            "pickle+digest record",
+            lambda: [
+                hashlib.blake2b(pickle.dumps(c), digest_size=16).digest()
+                for c in chats
+            ],
+        ),
+        ("signature record", lambda: [_signature(c) for c in chats]),
+        ("unpickle dict", lambda: [pickle.loads(pickle.dumps(c)) for c in legacy]),
+        ("unpickle record", lambda: [pickle.loads(pickle.dumps(r)) for r in records]),
+    ]
+    for name, fn in rows:
+        print(f"{name + ':':21}{timed(fn, n):12.0f} chats/s")
+
+    size = pickle.HIGHEST_PROTOCOL
+    legacy_bytes = sum(len(pickle.dumps(d, protocol=size)) for d in legacy) / n
+    record_bytes = sum(len(pickle.dumps(r, protocol=size)) for r in records) / n
+    print(f"bytes per session:   dict {legacy_bytes:.0f}, record {record_bytes:.0f}")
+    os.unlink(_cookie.name)
+
+
+if __name__ == "__main__":
+    main()
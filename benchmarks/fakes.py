@@ -0,0 +1,332 @@
+"""Local stand-ins for the Telegram Bot API, Bing and ChatGPT."""
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import json
+import time
+from urllib.parse import parse_qsl
+from uuid import uuid4
+
+import httpx
+
+from httpserver import HTTPServer, Request, Response
+
+# Final answers end with this marker, so a reply can be recognised as done.
+DONE_MARKER = "[done]"
+# Reply to requests shed by admission control.
+BUSY_TEXT = "忙，请稍后再试"
+# Start of the reply to prompts over the user's quota.
+QUOTA_TEXT = "额度已用完"
+
+
+class Shed(Exception):
+    """The bot answered busy or over quota instead of answering the prompt."""
+
+
+def answer_chunks(prompt: str, chunks: int) -> t.List[str]:
+    """Cumulative texts streamed for `prompt`, the last one is the answer."""
+    words = [f"word{i}" for i in range(chunks)]
+    texts = [f"echo {prompt}: " + " ".join(words[: i + 1]) for i in range(chunks)]
+    texts[-1] = f"{texts[-1]} {DONE_MARKER}"
+    return texts
+
+
+class ChunkTiming:
+    def __init__(self, first_chunk: float = 0.5, interval: float = 0.05, chunks: int = 20):
+        self.first_chunk = first_chunk
+        self.interval = interval
+        self.chunks = chunks
+
+    async def stream(self, prompt: str) -> t.AsyncIterator[str]:
+        await asyncio.sleep(self.first_chunk)
+        for i, text in enumerate(answer_chunks(prompt, self.chunks)):
+            if i:
+                await asyncio.sleep(self.interval)
+            yield text
+
+
+def _json(result: t.Any) -> Response:
+    return Response(
+        json.dumps(dict(ok=True, result=result)), content_type="application/json"
+    )
+
+
+class FakeTelegram:
+    """Bot API server that feeds synthetic updates and records replies.
+
+    `send` queues a text message from a private chat and returns a future
+    resolved with `(first_reply_latency, final_reply_latency)` once a
+    message containing `DONE_MARKER` is sent or edited into that chat, or
+    failed with `Shed` if the bot answered busy or over quota.
+    Updates are served to `getUpdates`, or posted to the webhook once the
+    bot called `setWebhook`.
+    """
+
+    BOT = dict(id=1, is_bot=True, first_name="bench", username="bench_bot")
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.server = HTTPServer(host, port)
+        self.server.route("POST", "/bot/", self._dispatch)
+        self.server.route("GET", "/bot/", self._dispatch)
+        self._updates: t.List[t.Dict[str, t.Any]] = []
+        self._new_update = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        self._pending: t.Dict[int, t.Tuple[float, t.Optional[float], asyncio.Future]] = {}
+        self.calls: t.Dict[str, int] = {}
+        self.webhook: t.Optional[t.Tuple[str, t.Optional[str]]] = None
+        self._client: t.Optional[httpx.AsyncClient] = None
+        self._posts: t.Set[asyncio.Task] = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server.host}:{self.server.port}/bot/"
+
+    async def start(self):
+        await self.server.start()
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+        await self.server.stop()
+
+    def send(self, chat_id: int, text: str) -> asyncio.Future:
+        self._update_id += 1
+        self._message_id += 1
+        user = dict(id=chat_id, is_bot=False, first_name=f"user{chat_id}")
+        update = dict(
+            update_id=self._update_id,
+            message=dict(
+                message_id=self._message_id,
+                date=int(time.time()),
+                chat=dict(id=chat_id, type="private", first_name=user["first_name"]),
+                **{"from": user},
+                text=text,
+            ),
+        )
+        if text.startswith("/"):
+            command = text.split()[0]
+            update["message"]["entities"] = [
+                dict(type="bot_command", offset=0, length=len(command))
+            ]
+        future = asyncio.get_running_loop().create_future()
+        self._pending[chat_id] = (time.perf_counter(), None, future)
+        if self.webhook is None:
+            self._updates.append(update)
+            self._new_update.set()
+        else:
+            task = asyncio.create_task(self._post(update))
+            self._posts.add(task)
+            task.add_done_callback(self._posts.discard)
+        return future
+
+    async def _post(self, update: t.Dict[str, t.Any]):
+        assert self.webhook is not None
+        url, secret_token = self.webhook
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100))
+        headers = {}
+        if secret_token is not None:
+            headers["x-telegram-bot-api-secret-token"] = secret_token
+        response = await self._client.post(url, json=update, headers=headers)
+        response.raise_for_status()
+
+    def _message(self, params: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+        chat_id = int(params["chat_id"])
+        text = str(params.get("text", ""))
+        pending = self._pending.get(chat_id)
+        if pending is not None:
+            start, first, future = pending
+            now = time.perf_counter()
+            if first is None:
+                first = now - start
+                self._pending[chat_id] = (start, first, future)
+            if DONE_MARKER in text:
+                del self._pending[chat_id]
+                if not future.done():
+                    future.set_result((first, now - start))
+            elif text == BUSY_TEXT or text.startswith(QUOTA_TEXT):
+                del self._pending[chat_id]
+                if not future.done():
+                    future.set_exception(Shed())
+        message_id = params.get("message_id")
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        return dict(
+            message_id=int(message_id),
+            date=int(time.time()),
+            chat=dict(id=chat_id, type="private"),
+            **{"from": self.BOT},
+            text=text,
+        )
+
+    async def _get_updates(self, params: t.Dict[str, t.Any]) -> t.List[t.Any]:
+        offset = int(params.get("offset") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(
+                    self._new_update.wait(), float(params.get("timeout") or 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self._updates[:limit]
+
+    async def _dispatch(self, request: Request) -> Response:
+        method = request.path.rsplit("/", 1)[-1]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params: t.Dict[str, t.Any] = {}
+        if request.headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(request.body or b"{}")
+        else:
+            for key, value in parse_qsl(request.body.decode()):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+
+        if method == "getMe":
+            return _json(self.BOT)
+        if method == "getUpdates":
+            return _json(await self._get_updates(params))
+        if method == "setWebhook":
+            self.webhook = (params["url"], params.get("secret_token"))
+            return _json(True)
+        if method == "deleteWebhook":
+            self.webhook = None
+            return _json(True)
+        if method in ("sendMessage", "editMessageText"):
+            return _json(self._message(params))
+        return _json(True)
+
+
+class FakeBing:
+    """Conversation create endpoint plus an in-process ChatHub stand-in."""
+
+    def __init__(
+        self, timing: ChunkTiming, host: str = "127.0.0.1", port: int = 0
+    ) -> None:
+        self.timing = timing
+        self.server = HTTPServer(host, port)
+        self.server.route("GET", "/turing/conversation/create", self._create)
+        self.created = 0
+        self.asks = 0
+
+    @property
+    def create_url(self) -> str:
+        return f"http://{self.server.host}:{self.server.port}/turing/conversation/create"
+
+    async def start(self):
+        await self.server.start()
+
+    async def stop(self):
+        await self.server.stop()
+
+    async def _create(self, request: Request) -> Response:
+        self.created += 1
+        body = dict(
+            conversationId=str(uuid4()),
+            clientId=str(uuid4()),
+            conversationSignature=str(uuid4()),
+            result=dict(value="Success", message=None),
+        )
+        return Response(json.dumps(body), content_type="application/json")
+
+    def chathub_class(self, base: type) -> type:
+        """Subclass `base` (bing.Client) to stream from `timing` locally."""
+        timing = self.timing
+        fake = self
+
+        class FakeChatHub(base):  # type: ignore
+            async def ask_stream(self, prompt: str, conversation_style=None, **kwargs):
+                fake.asks += 1
+                self.request.invocation_id += 1
+                text = ""
+                async for text in timing.stream(prompt):
+                    yield False, text
+                message = dict(
+                    text=text,
+                    adaptiveCards=[dict(body=[dict(text=text)])],
+                    suggestedResponses=[dict(text="tell me more")],
+                )
+                yield True, dict(
+                    type=2,
+                    item=dict(
+                        messages=[dict(text=prompt), message],
+                        result=dict(value="Success"),
+                    ),
+                )
+
+            async def close(self):
+                pass
+
+        return FakeChatHub
+
+
+class FakeChatGPT:
+    """Backend API for revChatGPT's `AsyncChatbot`, streaming server events."""
+
+    def __init__(
+        self, timing: ChunkTiming, host: str = "127.0.0.1", port: int = 0
+    ) -> None:
+        self.timing = timing
+        self.asks = 0
+        self.server = HTTPServer(host, port)
+        self.server.route("POST", "/conversation", self._conversation)
+        self.server.route("PATCH", "/conversation/", self._ok)
+        self.server.route("PATCH", "/conversations", self._ok)
+        self.server.route("GET", "/conversation/", self._history)
+        self.server.route("GET", "/conversations", self._conversations)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server.host}:{self.server.port}/"
+
+    async def start(self):
+        await self.server.start()
+
+    async def stop(self):
+        await self.server.stop()
+
+    async def _ok(self, request: Request) -> Response:
+        return Response(json.dumps(dict(success=True)), content_type="application/json")
+
+    async def _history(self, request: Request) -> Response:
+        body = dict(current_node=str(uuid4()), mapping={})
+        return Response(json.dumps(body), content_type="application/json")
+
+    async def _conversations(self, request: Request) -> Response:
+        body = dict(items=[], total=0)
+        return Response(json.dumps(body), content_type="application/json")
+
+    async def _conversation(self, request: Request) -> Response:
+        self.asks += 1
+        data = json.loads(request.body)
+        prompt = data["messages"][0]["content"]["parts"][0]
+        conversation_id = data.get("conversation_id") or str(uuid4())
+        message_id = str(uuid4())
+
+        async def stream():
+            async for text in self.timing.stream(prompt):
+                event = dict(
+                    conversation_id=conversation_id,
+                    message=dict(
+                        id=message_id,
+                        author=dict(role="assistant"),
+                        content=dict(content_type="text", parts=[text]),
+                        metadata=dict(
+                            model_slug="fake", finish_details=dict(type="stop")
+                        ),
+                        end_turn=True,
+                        recipient="all",
+                    ),
+                    error=None,
+                )
+                yield f"data: {json.dumps(event)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+
+        return Response(content_type="text/event-stream", stream=stream())
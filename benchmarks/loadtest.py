@@ -0,0 +1,243 @@
+"""Offline load test for the bot.
+
+Runs the real `Application` and handlers from src/app.py against local fakes
+of the Telegram Bot API, Bing and ChatGPT (see fakes.py). `--chats` simulated
+users each send `--messages` prompts, one after another, and wait for the
+final answer before sending the next one.
+
+    python benchmarks/loadtest.py --chats 100 --messages 5 --engine bing
+"""
+from __future__ import annotations
+
+import typing as t
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from fakes import ChunkTiming, FakeBing, FakeChatGPT, FakeTelegram, Shed  # noqa: E402
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values: t.List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+
+class FakeWorld:
+    """Runs the fakes and the simulated users on a loop in another thread."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.timing = ChunkTiming(args.first_chunk, args.chunk_interval, args.chunks)
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.latencies: t.List[t.Tuple[float, float]] = []
+        self.errors = 0
+        self.shed = 0
+        self.elapsed = 0.0
+        self.loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self.telegram: t.Optional[FakeTelegram] = None
+        self.bing: t.Optional[FakeBing] = None
+        self.chatgpt: t.Optional[FakeChatGPT] = None
+
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.go = asyncio.Event()
+        self.stop = asyncio.Event()
+        self.telegram = FakeTelegram()
+        self.bing = FakeBing(self.timing)
+        self.chatgpt = FakeChatGPT(self.timing)
+        for fake in (self.telegram, self.bing, self.chatgpt):
+            await fake.start()
+        self.ready.set()
+        await self.go.wait()
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(self._user(1000 + i) for i in range(self.args.chats))
+        )
+        self.elapsed = time.perf_counter() - start
+        self.done.set()
+        # Keep serving until the application has shut down.
+        await self.stop.wait()
+        for fake in (self.telegram, self.bing, self.chatgpt):
+            await fake.stop()
+
+    async def _user(self, chat_id: int):
+        assert self.telegram is not None
+        for i in range(self.args.messages):
+            # A question split over several quick messages, waiting for the
+            # answer to the last part.
+            for part in range(self.args.burst - 1):
+                self.telegram.send(chat_id, f"part {part} of question {i}")
+                await asyncio.sleep(self.args.burst_gap)
+            if self.args.shared_prompts:
+                prompt = f"question {i}"
+            else:
+                prompt = f"question {i} from {chat_id}"
+            future = self.telegram.send(chat_id, prompt)
+            try:
+                self.latencies.append(
+                    await asyncio.wait_for(future, self.args.reply_timeout)
+                )
+            except asyncio.TimeoutError:
+                self.errors += 1
+            except Shed:
+                self.shed += 1
+
+    def start_users(self):
+        assert self.loop is not None
+        self.loop.call_soon_threadsafe(self.go.set)
+
+    def finish(self):
+        assert self.loop is not None
+        self.loop.call_soon_threadsafe(self.stop.set)
+
+
+async def run_app(world: FakeWorld) -> t.Dict[str, t.Any]:
+    import app
+    import bing
+
+    bing.Client = world.bing.chathub_class(bing.Client)  # type: ignore
+
+    app.add_handlers()
+    application = app.app
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    if world.args.mode == "webhook":
+        await application.bot.set_webhook(
+            app.config.webhook_url, secret_token=app.config.webhook_secret_token
+        )
+    else:
+        await application.updater.start_polling(poll_interval=0, timeout=1)  # type: ignore
+    await application.start()
+
+    rss_before = rss_bytes()
+    world.start_users()
+    await asyncio.get_running_loop().run_in_executor(None, world.done.wait)
+    rss_after = rss_bytes()
+
+    if application.updater.running:  # type: ignore
+        await application.updater.stop()  # type: ignore
+    await application.stop()
+    if application.post_shutdown is not None:
+        await application.post_shutdown(application)
+    await application.shutdown()
+    return dict(
+        rss_before=rss_before,
+        rss_after=rss_after,
+        response_cache=app.response_cache and app.response_cache.stats(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=3)
+    parser.add_argument("--engine", choices=["bing", "chatgpt", "race"], default="bing")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--first-chunk", type=float, default=0.5)
+    parser.add_argument("--chunk-interval", type=float, default=0.05)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--reply-timeout", type=float, default=120)
+    parser.add_argument(
+        "--burst", type=int, default=1, help="messages each question is split into"
+    )
+    parser.add_argument("--burst-gap", type=float, default=0.1)
+    parser.add_argument(
+        "--shared-prompts",
+        action="store_true",
+        help="all chats ask the same questions, to exercise the response cache",
+    )
+    args = parser.parse_args()
+
+    world = FakeWorld(args)
+    thread = threading.Thread(target=world.run, daemon=True)
+    thread.start()
+    world.ready.wait()
+    assert world.telegram and world.bing and world.chatgpt
+
+    # The webhook URL must be known before the server starts.
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        webhook_port = sock.getsockname()[1]
+
+    tmp = tempfile.mkdtemp(prefix="tg-chatbot-bench-")
+    cookie_file = os.path.join(tmp, "cookie.json")
+    with open(cookie_file, "w") as f:
+        f.write('[{"name": "_U", "value": "bench"}]')
+    os.environ.update(
+        TELEGRAM_BOT_TOKEN="123456:bench",
+        TELEGRAM_BASE_URL=world.telegram.base_url,
+        TELEGRAM_BOT_DATA_PATH=os.path.join(tmp, "bot_data"),
+        TELEGRAM_DEFAULT_ENGINE=args.engine,
+        TELEGRAM_METRICS_PORT="0",
+        TELEGRAM_UPDATE_MODE=args.mode,
+        TELEGRAM_WEBHOOK_URL=f"http://127.0.0.1:{webhook_port}/webhook",
+        TELEGRAM_WEBHOOK_HOST="127.0.0.1",
+        TELEGRAM_WEBHOOK_PORT=str(webhook_port),
+        TELEGRAM_WEBHOOK_SECRET_TOKEN="bench-secret",
+        TELEGRAM_LOG_LEVEL=os.environ.get("TELEGRAM_LOG_LEVEL", "WARNING"),
+        BING_COOKIE_FILE=cookie_file,
+        BING_CREATE_URL=world.bing.create_url,
+        CHATGPT_ACCESS_TOKEN="bench",
+        CHATGPT_BASE_URL=world.chatgpt.base_url,
+    )
+
+    result = asyncio.run(run_app(world))
+    world.finish()
+    thread.join(timeout=5)
+
+    first = [f for f, _ in world.latencies]
+    final = [f for _, f in world.latencies]
+    total = len(world.latencies)
+    print(f"engine:            {args.engine}")
+    print(f"mode:              {args.mode}")
+    print(f"chats x messages:  {args.chats} x {args.messages}")
+    print(
+        f"replies:           {total} ok, {world.shed} busy, {world.errors} timed out"
+    )
+    print(f"elapsed:           {world.elapsed:.2f}s")
+    print(f"updates/s:         {total / world.elapsed:.2f}")
+    for name, values in (("first reply", first), ("final reply", final)):
+        print(
+            f"{name + ' latency:':21}"
+            f"p50 {percentile(values, 0.5):.3f}s"
+            f"  p95 {percentile(values, 0.95):.3f}s"
+            f"  p99 {percentile(values, 0.99):.3f}s"
+            f"  mean {statistics.fmean(values) if values else float('nan'):.3f}s"
+        )
+    growth = (result["rss_after"] - result["rss_before"]) / 2**20
+    print(f"rss:               {result['rss_after'] / 2**20:.1f} MiB ({growth:+.1f} MiB)")
+    print(f"upstream asks:     bing {world.bing.asks}, chatgpt {world.chatgpt.asks}")
+    print(f"telegram calls:    {world.telegram.calls}")
+    if result["response_cache"] is not None:
+        print(f"response cache:    {result['response_cache']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import contextlib
+import time
+
+import structlog
+
+import metrics
+from fairness import FairQueue, current as current_flow
+
+logger = structlog.get_logger(__name__)
+
+
+class Overloaded(RuntimeError):
+    """The engine has no free slot and the request was shed."""
+
+    def __init__(self, engine: str, reason: str) -> None:
+        super().__init__(f"{engine} overloaded: {reason}")
+        self.engine = engine
+        self.reason = reason
+
+
+controllers: t.Dict[str, AdmissionController] = {}
+
+ADMISSION_WAIT = metrics.registry.histogram(
+    "admission_wait_seconds", "Time spent waiting for an upstream slot.", ["engine"]
+)
+ADMISSION_REJECTED = metrics.registry.counter(
+    "admission_rejected_total",
+    "Requests shed by admission control.",
+    ["engine", "reason"],
+)
+metrics.registry.gauge(
+    "admission_limit",
+    "Current concurrency limit per engine.",
+    ["engine"],
+    fn=lambda: {(e,): c.effective_limit for e, c in controllers.items()},
+)
+metrics.registry.gauge(
+    "admission_in_flight",
+    "Admitted upstream requests per engine.",
+    ["engine"],
+    fn=lambda: {(e,): c.in_flight for e, c in controllers.items()},
+)
+metrics.registry.gauge(
+    "admission_queued",
+    "Requests waiting for an upstream slot per engine.",
+    ["engine"],
+    fn=lambda: {(e,): len(c._waiters) for e, c in controllers.items()},
+)
+
+
+class Slot:
+    __slots__ = ("controller", "start", "sampled")
+
+    def __init__(self, controller: AdmissionController) -> None:
+        self.controller = controller
+        self.start = time.monotonic()
+        self.sampled = False
+
+    def chunk(self):
+        """Feed the latency to the first chunk to the adaptive limit."""
+        if not self.sampled:
+            self.sampled = True
+            self.controller._sample(time.monotonic() - self.start)
+
+
+class AdmissionController:
+    """Bound the upstream requests of one engine and shed the excess.
+
+    At most `limit` requests run at once and up to `max_queue` wait for a
+    slot, each for at most `queue_timeout` seconds; beyond that `Overloaded`
+    is raised right away. Waiting requests are served fairly across the
+    flows they are made for, see `FairQueue`.
+
+    With `adaptive` the limit moves between `min_in_flight` and
+    `max_in_flight`: it shrinks by `backoff` when the latency to the first
+    chunk exceeds `latency_tolerance` times the best latency seen recently or
+    a request fails, and grows back by one slot per limit's worth of fast
+    requests.
+    """
+
+    def __init__(
+        self,
+        engine: str,
+        max_in_flight: int = 32,
+        min_in_flight: int = 1,
+        max_queue: int = 64,
+        queue_timeout: float = 10,
+        adaptive: bool = True,
+        latency_tolerance: float = 2.0,
+        backoff: float = 0.9,
+    ) -> None:
+        self.engine = engine
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min(min_in_flight, max_in_flight)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.adaptive = adaptive
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.limit = float(max_in_flight)
+        self.baseline: t.Optional[float] = None
+        self.in_flight = 0
+        self._waiters = FairQueue()
+        self._last_decrease = 0.0
+        controllers[engine] = self
+
+    @property
+    def effective_limit(self) -> int:
+        return max(self.min_in_flight, int(self.limit))
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        return dict(
+            engine=self.engine,
+            limit=self.effective_limit,
+            in_flight=self.in_flight,
+            queued=len(self._waiters),
+            baseline=self.baseline,
+        )
+
+    async def _acquire(self):
+        if not self._waiters and self.in_flight < self.effective_limit:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            ADMISSION_REJECTED.inc(self.engine, "queue_full")
+            raise Overloaded(self.engine, "queue full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        flow = current_flow.get()
+        self._waiters.push(waiter, flow)
+        logger.debug("admission queued", engine=self.engine, queued=len(self._waiters))
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            ADMISSION_REJECTED.inc(self.engine, "timeout")
+            raise Overloaded(self.engine, "queue timeout") from None
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted a slot just as the caller was cancelled.
+                self._release()
+            raise
+        finally:
+            if waiter.cancelled() and waiter in self._waiters:
+                self._waiters.remove(waiter)
+            waited = time.monotonic() - start
+            if flow is not None:
+                flow.waited += waited
+            ADMISSION_WAIT.observe(waited, self.engine)
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        woken = False
+        while self._waiters and self.in_flight < self.effective_limit:
+            waiter, _ = self._waiters.pop()
+            woken = True
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+        if woken:
+            self._waiters.notify()
+
+    def _sample(self, latency: float):
+        if not self.adaptive:
+            return
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            # Let the baseline drift up slowly so it follows a slower upstream.
+            self.baseline += (latency - self.baseline) * 0.01
+        if latency > self.baseline * self.latency_tolerance:
+            self._decrease()
+        else:
+            self.limit = min(self.max_in_flight, self.limit + 1 / self.limit)
+            self._wake()
+
+    def _decrease(self):
+        now = time.monotonic()
+        # Requests started under the old limit report late, back off once per
+        # baseline latency at most.
+        if now - self._last_decrease < (self.baseline or 0.0):
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_in_flight), self.limit * self.backoff)
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> t.AsyncIterator[Slot]:
+        """Hold an upstream slot, raising `Overloaded` if none frees up."""
+        await self._acquire()
+        slot = Slot(self)
+        try:
+            yield slot
+        except Exception:
+            if self.adaptive:
+                self._decrease()
+            raise
+        finally:
+            self._release()
@@ -1,12 +1,15 @@
 import typing as t
-import html
-import json
+import asyncio
+import time
 import structlog
-import traceback
 import functools as ft
 import enum
+import math
+from urllib.parse import urlsplit
 from uuid import uuid4
 
+started = time.perf_counter()
+
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,7 +21,8 @@ from telegram import (
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
 )
-from telegram.constants import ChatAction, ParseMode
+from telegram.constants import ChatAction
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     filters,
     ApplicationBuilder,
@@ -32,14 +36,29 @@ from telegram.ext import (
 import pydantic as pyd
 
 
-import bing
-import chatgpt
-
+import engines
+from admission import Overloaded
+import logs
+import metrics
+import outbound
+import resilience
+import sharding
+import webhook
+from httpserver import HTTPServer
+from stream import MessageStreamer
+from render import Renderer
+from sessions import SessionCache
+from persistence import SqlitePersistence
+from scheduler import ChatScheduler, ChatOrderedApplication
+from coalesce import MessageCoalescer
+from generations import Generations, Stopped
+from reaper import Reaper
+from errors import ErrorDigest
+import fairness
+from fairness import Accounting, Flow, QuotaExceeded, Quotas
+from cache import Answer, ResponseCache
+from record import SessionRecord
 
-BOT_TYPE_MAP = {
-    "bing": bing.Bot,
-    "chatgpt": chatgpt.Bot,
-}
 
 logger = structlog.get_logger(__name__)
 
@@ -47,7 +66,97 @@ logger = structlog.get_logger(__name__)
 class Config(pyd.BaseSettings):
     bot_token: str
     bot_data_path: str
+    base_url: t.Optional[str] = None
+    default_engine: str = "bing"
+    # Engines offered to chats, all known ones by default. They are loaded at
+    # startup, and those missing their configuration aren't offered. Other
+    # engines are loaded on first use, or at startup when in preload_engines.
+    engines: t.Optional[t.List[str]] = None
+    preload_engines: t.List[str] = []
+    persistence_backend: t.Literal["sqlite", "pickle"] = "sqlite"
     exception_send_chat_id: t.Optional[int] = None
+    # Exceptions are reported in digests every error_report_interval
+    # seconds, in detail once per error_report_window seconds.
+    error_report_interval: float = 60
+    error_report_window: float = 3600
+    error_report_max_messages: int = 5
+    stream_reply: bool = True
+    stream_edit_interval: float = 1.0
+    stream_group_edit_interval: float = 3.0
+    # Show the engines' markdown formatted rather than as it is.
+    render_markdown: bool = True
+    max_sessions: int = 1000
+    session_idle_ttl: float = 1800
+    max_concurrent_updates: int = 16
+    # Updates of a chat waiting beyond this many are dropped.
+    max_queued_per_chat: int = 16
+    # Updates the application takes in at once, mostly waiting in the
+    # ChatScheduler; keep it far above max_concurrent_updates.
+    max_pending_updates: int = 4096
+    metrics_host: str = "127.0.0.1"
+    metrics_port: t.Optional[int] = 9090
+    update_mode: t.Literal["polling", "webhook"] = "polling"
+    # Public URL Telegram posts updates to, required in webhook mode.
+    webhook_url: t.Optional[str] = None
+    # Local path of the webhook, the path of webhook_url by default.
+    webhook_path: t.Optional[str] = None
+    webhook_secret_token: t.Optional[str] = None
+    # The webhook port serves health checks too, metrics stay on metrics_port.
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8443
+    webhook_drop_pending_updates: bool = False
+    # More than one shard runs a front process dispatching updates to this
+    # many worker processes by chat id.
+    shards: int = 1
+    # Set by the front for worker processes.
+    shard_index: t.Optional[int] = None
+    # Worker i listens on 127.0.0.1:shard_base_port+i, metrics included.
+    shard_base_port: int = 8600
+    persistence_update_interval: float = 60
+    # Every reaper_interval seconds, drop the conversation of chats idle for
+    # chat_retention seconds and inline keyboards older than
+    # callback_data_ttl. 0 disables the reaper.
+    reaper_interval: float = 3600
+    chat_retention: float = 30 * 24 * 3600
+    callback_data_ttl: float = 24 * 3600
+    # Re-ask another engine while the chat's engine has its circuit open.
+    engine_fallback: bool = False
+    # Merge text messages sent within coalesce_window seconds of each other,
+    # or while the previous one is being answered, into one prompt.
+    coalesce_messages: bool = False
+    coalesce_window: float = 0.5
+    coalesce_max_batch: int = 4
+    # Answer repeated first-turn prompts from a cache.
+    response_cache: bool = False
+    response_cache_ttl: float = 3600
+    response_cache_max_entries: int = 1000
+    response_cache_max_bytes: int = 16 * 1024 * 1024
+    # Longer prompts are unlikely to repeat and are not cached.
+    response_cache_max_prompt_length: int = 200
+    # Keep the cache across restarts in this file, per shard when sharded.
+    response_cache_path: t.Optional[str] = None
+    # Telegram's limits on outgoing messages: overall per second, and per
+    # second in private chats and per minute in groups, bursts allowed. The
+    # overall rate is for the bot, shard workers each get their share of it.
+    outbound_rate_limit: bool = True
+    outbound_global_rate: float = 30
+    outbound_private_rate: float = 1
+    outbound_private_burst: float = 3
+    outbound_group_rate_per_minute: float = 20
+    outbound_group_burst: float = 3
+    # Share upstream capacity between users in proportion to their weight in
+    # fair_weights, by user or chat id, 1 if not listed. With fair_quota,
+    # users get that many prompts per fair_quota_period seconds, times their
+    # weight. Usage is served on /fairness next to the metrics.
+    fair_queueing: bool = False
+    fair_weights: t.Dict[int, float] = {}
+    fair_quota: int = 0
+    fair_quota_period: float = 3600
+    log_level: str = "INFO"
+    log_json: bool = False
+    log_max_field_length: int = 1024
+    # Event name -> fraction of events to keep, e.g. {"update": 0.1}.
+    log_sample_rates: t.Dict[str, float] = {}
 
     class Config:
         env_file = ".env"
@@ -56,14 +165,269 @@ class Config(pyd.BaseSettings):
 
 config = Config()  # type: ignore
 
+logs.setup(
+    level=config.log_level,
+    max_field_length=config.log_max_field_length,
+    sample_rates=config.log_sample_rates,
+    json=config.log_json,
+)
+
+engines.registry.discover()
+if config.engines is not None:
+    engines.registry.offer(config.engines)
+if config.default_engine not in engines.registry:
+    raise ValueError(f"default engine {config.default_engine} is not offered")
+
+if any(weight <= 0 for weight in config.fair_weights.values()):
+    raise ValueError("TELEGRAM_FAIR_WEIGHTS must be positive")
+if config.max_pending_updates <= config.max_concurrent_updates:
+    raise ValueError(
+        "TELEGRAM_MAX_PENDING_UPDATES must be above TELEGRAM_MAX_CONCURRENT_UPDATES"
+    )
+
+sessions = SessionCache(
+    max_sessions=config.max_sessions, idle_ttl=config.session_idle_ttl
+)
+scheduler = ChatScheduler(
+    config.max_concurrent_updates, max_queued_per_chat=config.max_queued_per_chat
+)
+generations = Generations()
+response_cache = None
+if config.response_cache:
+    response_cache = ResponseCache(
+        max_entries=config.response_cache_max_entries,
+        max_bytes=config.response_cache_max_bytes,
+        ttl=config.response_cache_ttl,
+        max_prompt_length=config.response_cache_max_prompt_length,
+        path=config.response_cache_path
+        if config.shard_index is None or config.response_cache_path is None
+        else f"{config.response_cache_path}.shard{config.shard_index}",
+    )
+quotas = None
+if config.fair_queueing and config.fair_quota > 0:
+    quotas = Quotas(config.fair_quota, config.fair_quota_period)
+accounting = Accounting(quotas)
+
+STARTUP_SECONDS = metrics.registry.gauge(
+    "startup_seconds", "Time from importing the app until it was initialized."
+)
+metrics.registry.gauge(
+    "active_sessions", "Live bot sessions.", fn=lambda: len(sessions)
+)
+metrics.registry.gauge(
+    "generations_running", "Answers being generated.", fn=lambda: len(generations)
+)
+metrics.registry.gauge(
+    "updates_in_flight", "Updates being processed.", fn=lambda: scheduler.in_flight
+)
+metrics.registry.gauge(
+    "updates_queued", "Updates waiting to be processed.", fn=lambda: scheduler.queued
+)
+metrics.registry.gauge(
+    "account_in_flight",
+    "Upstream requests in progress per account.",
+    ["engine", "account"],
+    fn=lambda: {
+        (engine, a["id"]): a["in_flight"]
+        for engine, module in engines.registry.loaded().items()
+        if hasattr(module, "accounts")
+        for a in module.accounts.health()
+    },
+)
+metrics.registry.gauge(
+    "account_available",
+    "Whether an upstream account is out of cooldown.",
+    ["engine", "account"],
+    fn=lambda: {
+        (engine, a["id"]): int(a["available"])
+        for engine, module in engines.registry.loaded().items()
+        if hasattr(module, "accounts")
+        for a in module.accounts.health()
+    },
+)
+
+is_front = config.shards > 1 and config.shard_index is None
+if config.shards > 1 and config.persistence_backend != "sqlite":
+    raise ValueError("sharding needs the sqlite persistence backend")
+
+# The webhook listener, public unless this is a shard worker.
+http_server = None
+# Metrics and other internal endpoints, never on a public listener.
+admin_server = None
+if config.update_mode == "webhook":
+    if config.webhook_url is None and config.shard_index is None:
+        raise ValueError("TELEGRAM_WEBHOOK_URL is required in webhook mode")
+    http_server = HTTPServer(config.webhook_host, config.webhook_port)
+    if config.shard_index is not None:
+        # Workers listen on the loopback, and share the metrics port setting.
+        admin_server = http_server
+if admin_server is None and config.metrics_port is not None:
+    admin_server = HTTPServer(config.metrics_host, config.metrics_port)
+if admin_server is not None:
+    admin_server.route("GET", "/metrics", metrics.metrics_endpoint)
+    if config.fair_queueing:
+        admin_server.route("GET", "/fairness", accounting.endpoint)
+servers: t.List[HTTPServer] = []
+for server in (http_server, admin_server):
+    if server is not None and server not in servers:
+        servers.append(server)
+
+
+async def post_init(app):
+    await engines.registry.preload(config.preload_engines)
+    if not engines.registry.offers(config.default_engine):
+        raise RuntimeError(f"default engine {config.default_engine} is unavailable")
+    engines.registry.start()
+    if response_cache is not None:
+        response_cache.load()
+    for server in servers:
+        await server.start()
+    elapsed = time.perf_counter() - started
+    STARTUP_SECONDS.set(elapsed)
+    logger.info("started", elapsed=elapsed, engines=engines.registry.init_times())
+
+
+async def post_shutdown(app):
+    for server in servers:
+        await server.stop()
+    await sessions.close_all()
+    await engines.registry.close()
+    if response_cache is not None:
+        response_cache.save()
+
+
+def interrupt(update: Update) -> bool:
+    """Stop answers on /stop, or on a newer prompt if the chat opted in."""
+    message = update.message
+    if message is None or message.text is None or message.from_user is None:
+        return False
+    if message.text.startswith("/"):
+        command, _, username = message.text.split()[0][1:].partition("@")
+        if username and username.lower() != (app.bot.username or "").lower():
+            # Addressed to another bot in the group.
+            return False
+        # /stop has nothing to wait for, the answer it stops holds the chat.
+        return command.lower() == "stop"
+    # Whether the chat opted in was taken from its data when the answer
+    # started, the data of chats may not be loaded yet here.
+    generations.supersede(message.chat_id, user_id=message.from_user.id)
+    return False
+
+
 app = ApplicationBuilder()
+coalescer = None
+if config.coalesce_messages:
+    coalescer = MessageCoalescer(config.coalesce_window, config.coalesce_max_batch)
+app = app.application_class(
+    ChatOrderedApplication,
+    kwargs=dict(scheduler=scheduler, coalescer=coalescer, interrupt=interrupt),
+)
+# Concurrency is bounded per chat and globally by the ChatScheduler. Updates
+# waiting for their chat hold one of the application's slots, so its bound is
+# kept far above the scheduler's.
+app = app.concurrent_updates(config.max_pending_updates)
 app = app.arbitrary_callback_data(True)
-persistence = PicklePersistence(filepath=config.bot_data_path)
+if config.persistence_backend == "sqlite":
+    persistence = SqlitePersistence(
+        filepath=config.bot_data_path,
+        update_interval=config.persistence_update_interval,
+        namespace=None if config.shard_index is None else f"shard{config.shard_index}",
+    )
+else:
+    persistence = PicklePersistence(
+        filepath=config.bot_data_path,
+        update_interval=config.persistence_update_interval,
+    )
 app = app.persistence(persistence)
 app = app.token(config.bot_token)
+if config.base_url is not None:
+    app = app.base_url(config.base_url)
+app = app.request(metrics.TimedRequest(connection_pool_size=256))
+if config.outbound_rate_limit:
+    app = app.rate_limiter(
+        outbound.OutboundScheduler(
+            global_rate=config.outbound_global_rate
+            / (config.shards if config.shard_index is not None else 1),
+            private_rate=config.outbound_private_rate,
+            private_burst=config.outbound_private_burst,
+            group_rate=config.outbound_group_rate_per_minute / 60,
+            group_burst=config.outbound_group_burst,
+            report_chat_id=config.exception_send_chat_id,
+        )
+    )
+app = app.post_init(post_init)
+app = app.post_shutdown(post_shutdown)
 app = app.build()
 
 
+async def visit_sessions(visit: t.Callable[[SessionRecord], None]):
+    """Call `visit` with every chat's saved session, loaded or stored."""
+
+    def visit_chat(chat_data: t.Any):
+        record = SessionRecord.load(chat_data.get("bot_data"))
+        if record is not None:
+            visit(record)
+
+    for chat_data in list(app.chat_data.values()):
+        visit_chat(chat_data)
+    if isinstance(app.persistence, SqlitePersistence):
+        await app.persistence.scan_chat_data(visit_chat)
+
+
+# Shard workers share the database, the first one collects for all of them.
+if config.shard_index in (None, 0):
+    engines.registry.visit_sessions = visit_sessions
+
+if config.reaper_interval > 0 and not is_front:
+    reaper = Reaper(
+        sessions,
+        engines.registry,
+        retention=config.chat_retention,
+        callback_data_ttl=config.callback_data_ttl,
+        # Shard workers share the database, the first one compacts it.
+        compact_stored=config.shard_index in (None, 0),
+    )
+    if app.job_queue is None:
+        raise RuntimeError(
+            "the reaper needs python-telegram-bot[job-queue],"
+            " install it or set TELEGRAM_REAPER_INTERVAL=0"
+        )
+    app.job_queue.run_repeating(
+        reaper.run, interval=config.reaper_interval, name="reaper"
+    )
+
+errors = ErrorDigest(
+    config.exception_send_chat_id,
+    window=config.error_report_window,
+    max_reports=config.error_report_max_messages,
+)
+if config.exception_send_chat_id is not None and not is_front:
+    if app.job_queue is None:
+        raise RuntimeError("exception reports need python-telegram-bot[job-queue]")
+    app.job_queue.run_repeating(
+        errors.run, interval=config.error_report_interval, name="error reports"
+    )
+
+front = None
+if is_front:
+    front = sharding.ShardFront(config.shards, config.shard_base_port)
+for server in servers:
+    server.route(
+        "GET",
+        "/healthz",
+        webhook.health_endpoint(app) if front is None else front.health_endpoint,
+    )
+if config.update_mode == "webhook":
+    assert http_server is not None
+    http_server.route(
+        "POST",
+        config.webhook_path or urlsplit(config.webhook_url or "").path or "/",
+        webhook.webhook_endpoint(app, config.webhook_secret_token)
+        if front is None
+        else front.webhook_endpoint(config.webhook_secret_token),
+    )
+
+
 def command_handler(command):
     """Decorator for command handlers."""
 
@@ -81,8 +445,12 @@ def send_action(action):
     def decorator(func):
         @ft.wraps(func)
         async def command_func(update, context, *args, **kwargs):
-            await context.bot.send_chat_action(
-                chat_id=update.effective_message.chat_id, action=action
+            # Don't hold up the handler, the action is cosmetic.
+            outbound.fire_and_forget(
+                context.bot.send_chat_action(
+                    chat_id=update.effective_message.chat_id, action=action
+                ),
+                "send chat action",
             )
             return await func(update, context, *args, **kwargs)
 
@@ -92,36 +460,95 @@ def send_action(action):
 
 
 def log(fn):
-    ft.wraps(fn)
-
+    @ft.wraps(fn)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.info(f"update: {update.to_json()}")
-        logger.info(f"bot_data: {context.bot_data}")
-        logger.info(f"chat_data: {context.chat_data}")
-        logger.info(f"user_data: {context.user_data}")
+        logger.info(
+            "update",
+            handler=fn.__name__,
+            update_id=update.update_id,
+            chat_id=update.effective_chat and update.effective_chat.id,
+            user_id=update.effective_user and update.effective_user.id,
+        )
+        logger.debug(
+            "update dump",
+            update=logs.Lazy(update.to_json),
+            bot_data=logs.Lazy(lambda: str(context.bot_data)),
+            chat_data=logs.Lazy(lambda: str(context.chat_data)),
+            user_data=logs.Lazy(lambda: str(context.user_data)),
+        )
         return await fn(update, context)
 
     return wrapper
 
 
-def get_or_create_chatbot(
+async def get_or_create_chatbot(
+    update: Update,
     context: ContextTypes.DEFAULT_TYPE,
-    engine="bing",
+    engine=None,
 ):
+    """The chat's session, switching to `engine` if its own is unavailable."""
     chat_data = context.chat_data
-    assert engine in BOT_TYPE_MAP
+    engine = engine or config.default_engine
+    assert engine in engines.registry
     assert chat_data is not None
-    bot_data = chat_data.get("bot_data", None)
-    if bot_data is None:
-        bot_id = str(uuid4())
-        return BOT_TYPE_MAP[engine](bot_id)
-    return BOT_TYPE_MAP[bot_data["info"]["engine"]].deserialize(bot_data)
+    record = SessionRecord.load(chat_data.get("bot_data", None))
+    if record is not None:
+        bot = sessions.get(record.bot_id)
+        if bot is not None:
+            return bot
+        try:
+            bot = engines.registry[record.engine].deserialize(record)
+        except engines.EngineUnavailable:
+            logger.warning(
+                "chat engine unavailable", engine=record.engine, fallback=engine
+            )
+        else:
+            sessions.put(bot)
+            return bot
+    bot_id = str(uuid4())
+    bot = engines.registry[engine](bot_id)
+    sessions.put(bot)
+    if record is not None:
+        save_bot(context, bot)
+        assert update.effective_chat is not None
+        await update.effective_chat.send_message(
+            f"{record.engine} 不可用，已切换到 {engine}"
+        )
+    return bot
+
+
+def get_fallback_chatbot(bot):
+    """Session of another engine standing in for `bot`, if one is healthy.
+
+    Fallback sessions only live in the session cache, the chat keeps its
+    engine once the original one recovers.
+    """
+    for engine in engines.registry:
+        if engine == bot.engine:
+            continue
+        if resilience.policy(engine).breaker.state == resilience.OPEN:
+            continue
+        bot_type = engines.registry[engine]
+        if bot_type.composite:
+            continue
+        bot_id = f"{bot.bot_id}:fallback:{engine}"
+        fallback = sessions.get(bot_id)
+        if fallback is None:
+            fallback = bot_type(bot_id)
+            sessions.put(fallback)
+        return fallback
+    return None
 
 
 def save_bot(context: ContextTypes.DEFAULT_TYPE, bot):
     chat_data = context.chat_data
     assert chat_data is not None
-    chat_data["bot_data"] = bot.serialize()
+    record = bot.serialize()
+    if chat_data.get("bot_data") is record and not record.dirty:
+        return
+    chat_data["bot_data"] = record
+    chat_data["last_active"] = time.time()
+    record.saved = record.version
 
 
 async def reply_markdown(update: Update, text: str, **kwargs):
@@ -140,28 +567,62 @@ async def reply_text(update: Update, text: str, **kwargs):
 
 @command_handler("reset")
 @log
+@metrics.timed
 async def reset_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     assert update.message is not None
-    bot = get_or_create_chatbot(context)
+    bot = await get_or_create_chatbot(update, context)
     await bot.reset()
     save_bot(context, bot)
 
     await reply_text(update, text="好了，我已经为新的对话重置了我的大脑。你现在想聊些什么?")
 
 
+@command_handler("stop")
+@log
+@metrics.timed
+async def stop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    assert update.message is not None
+    chat_id = update.message.chat_id
+    user = update.message.from_user
+    # Only the asker may stop an answer, in groups too. The stopped answer
+    # says so itself.
+    if generations.stop(chat_id, "command", user_id=user and user.id):
+        return
+    if generations.running(chat_id):
+        await reply_text(update, "只有提问的人可以停止回答.")
+    else:
+        await reply_text(update, "当前没有正在生成的回答.")
+
+
+@command_handler("autoStop")
+@log
+@metrics.timed
+async def auto_stop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_data = context.chat_data
+    assert chat_data is not None
+    chat_data["auto_stop"] = not chat_data.get("auto_stop", False)
+    if chat_data["auto_stop"]:
+        await reply_text(update, "已开启: 新的提问会停止正在生成的回答.")
+    else:
+        await reply_text(update, "已关闭: 新的提问会等待正在生成的回答.")
+
+
 @command_handler("settings")
 @log
+@metrics.timed
 async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     assert context.args is not None
 
     help_text = [
         r"\- /setStyle: 设置聊天风格",
         r"\- /setEngine 设置聊天引擎",
+        r"\- /autoStop: 开关新的提问自动停止正在生成的回答",
     ]
     text = "\n".join(help_text)
     await reply_markdown(update, text)
 
 
+@metrics.timed
 async def invalid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Informs the user that the button is no longer available."""
 
@@ -179,9 +640,10 @@ class ChatStyleChoices(enum.Enum):
 
 @command_handler("setStyle")
 @log
+@metrics.timed
 async def set_style_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    bot = get_or_create_chatbot(context)
-    if bot.engine not in ("bing"):
+    bot = await get_or_create_chatbot(update, context)
+    if bot.engine not in ("bing", "race"):
         await reply_text(update, "该聊天引擎不支持设置聊天风格.")
         return
 
@@ -192,12 +654,13 @@ async def set_style_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await reply_text(update, "请选择聊天风格.", reply_markup=reply_markup)
 
 
+@metrics.timed
 async def style_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     assert query is not None
 
     style_to_config = t.cast(ChatStyleChoices, query.data)  #  type: ignore
-    bot = get_or_create_chatbot(context)
+    bot = await get_or_create_chatbot(update, context)
     bot.style = style_to_config.value
     save_bot(context, bot)
 
@@ -207,21 +670,30 @@ async def style_button_callback(update: Update, context: ContextTypes.DEFAULT_TY
     return
 
 
-class ChatEngineChoices(enum.Enum):
-    bing = "bing"
-    chatgpt = "chatgpt"
+# Every engine, so buttons of engines no longer offered still parse.
+ChatEngineChoices = enum.Enum(  # type: ignore[misc]
+    "ChatEngineChoices",
+    {engine: engine for engine in engines.registry.names()},
+    module=__name__,
+)
 
 
 @command_handler("setEngine")
 @log
+@metrics.timed
 async def set_engine_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
-        [InlineKeyboardButton(e.value, callback_data=e) for e in ChatEngineChoices]
+        [
+            InlineKeyboardButton(e.value, callback_data=e)
+            for e in ChatEngineChoices
+            if engines.registry.offers(e.value)
+        ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await reply_text(update, "请选择聊天引擎.", reply_markup=reply_markup)
 
 
+@metrics.timed
 async def engine_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     assert query is not None
@@ -230,10 +702,18 @@ async def engine_button_callback(update: Update, context: ContextTypes.DEFAULT_T
     assert chat_data is not None
 
     engine = t.cast(ChatEngineChoices, query.data)  #  type: ignore
-    assert engine.value in BOT_TYPE_MAP
+    assert engine.value in engines.registry
+    if not engines.registry.offers(engine.value):
+        # Chosen on a keyboard sent before the engine became unavailable.
+        await query.answer(f"{engine.value} 不可用", show_alert=True)
+        return
 
+    record = SessionRecord.load(chat_data.get("bot_data", None))
+    if record is not None:
+        sessions.discard(record.bot_id)
     bot_id = str(uuid4())
-    bot = BOT_TYPE_MAP[engine.value](bot_id)
+    bot = engines.registry[engine.value](bot_id)
+    sessions.put(bot)
     save_bot(context, bot)
 
     await query.answer()
@@ -244,9 +724,14 @@ async def engine_button_callback(update: Update, context: ContextTypes.DEFAULT_T
 
 @command_handler("info")
 @log
+@metrics.timed
 async def info_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    bot = get_or_create_chatbot(context)
-    text = "\n".join([rf"\- {k}: {v}" for k, v in bot.info().items()])
+    bot = await get_or_create_chatbot(update, context)
+    lines = []
+    for k, v in bot.info().items():
+        k, v = escape_markdown(k, version=2), escape_markdown(str(v), version=2)
+        lines.append(rf"\- {k}: {v}")
+    text = "\n".join(lines)
 
     await reply_markdown(update, text)
     return
@@ -254,6 +739,7 @@ async def info_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @command_handler("chatId")
 @log
+@metrics.timed
 async def chat_id_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     assert update.message is not None
     await reply_text(update, f"当前聊天ID为: {update.message.chat_id}")
@@ -262,12 +748,14 @@ async def chat_id_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @command_handler("help")
 @log
+@metrics.timed
 async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = [
         r"\- /help: 帮助",
         r"\- /settings: 列出机器人设置",
         r"\- /info: 获取机器人信息",
         r"\- /reset: 重置对话",
+        r"\- /stop: 停止正在生成的回答",
         r"\- /chatID: 获取聊天ID",
     ]
     text = "\n".join(help_text)
@@ -275,78 +763,177 @@ async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return
 
 
+def get_flow(update: Update, on_position: t.Callable[[int], None]) -> Flow:
+    """The flow a prompt's upstream requests are scheduled in, per user."""
+    assert update.message is not None
+    chat_id = update.message.chat_id
+    user = update.message.from_user
+    weight = config.fair_weights.get(chat_id, 1.0)
+    if user is None:
+        return Flow(f"chat:{chat_id}", weight, on_position)
+    weight = max(weight, config.fair_weights.get(user.id, 1.0))
+    return Flow(f"user:{user.id}", weight, on_position)
+
+
 @log
 @send_action(ChatAction.TYPING)
+@metrics.timed
 async def ask_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     assert update.message is not None
 
     prompt = update.message.text
     if prompt is None or prompt.strip() == "":
         return
-    bot = get_or_create_chatbot(context)
+    bot = await get_or_create_chatbot(update, context)
+    if update.message.chat.type == update.message.chat.PRIVATE:
+        interval = config.stream_edit_interval
+    else:
+        interval = config.stream_group_edit_interval
+    streamer = MessageStreamer(
+        update.message,
+        interval=interval,
+        renderer=Renderer(markdown=config.render_markdown),
+        quote=True,
+    )
+
+    # The answer so far, shown when it is stopped.
+    partial = ""
+
+    async def ask(session) -> str:
+        nonlocal partial
+        text = "No response"
+        if session.composite:
+            stream = session.ask_stream(prompt)
+        else:
+            stream = resilience.policy(session.engine).ask_stream(session, prompt)
+        async for final, text in stream:
+            if not final:
+                partial = text
+                if config.stream_reply:
+                    streamer.push(text)
+        return text
+
+    answering = bot
+
+    async def answer() -> t.Tuple[Answer, bool]:
+        nonlocal answering
+        try:
+            text = await ask(bot)
+        except resilience.CircuitOpen:
+            fallback = get_fallback_chatbot(bot) if config.engine_fallback else None
+            if fallback is None:
+                raise
+            logger.warning("engine fallback", engine=bot.engine, to=fallback.engine)
+            resilience.FALLBACKS.inc(bot.engine, fallback.engine)
+            answering = fallback
+            text = await ask(fallback)
+        result = Answer(text, list(answering.suggested_questions))
+        # Fallback answers and failures are not what the chat's engine says.
+        return result, answering is bot and text != "No response"
+
+    cache_key = None
+    if response_cache is not None and bot.fresh:
+        cache_key = response_cache.key(bot.engine, getattr(bot, "style", None), prompt)
+
+    async def generate() -> Answer:
+        if cache_key is not None:
+            assert response_cache is not None
+            return await response_cache.fetch(cache_key, answer)
+        result, _ = await answer()
+        return result
+
+    def queued(position: int):
+        # Only until the answer starts streaming.
+        if not partial:
+            streamer.push(f"排队中，前面还有 {position} 个请求…")
+
+    flow = None
+    if config.fair_queueing:
+        flow = get_flow(update, queued)
+        if quotas is not None:
+            try:
+                quotas.take(flow.key, flow.weight)
+            except QuotaExceeded as exc:
+                accounting.rejected(flow)
+                await streamer.finish(
+                    f"额度已用完，请 {math.ceil(exc.retry_after)} 秒后再试"
+                )
+                return
+
+    asked = time.monotonic()
+    # The generation's task runs with a copy of this context.
+    token = fairness.current.set(flow)
     try:
-        text = await bot.ask(
-            prompt,
+        result = await generations.run(
+            update.message.chat_id,
+            update.message.from_user and update.message.from_user.id,
+            generate(),
+            auto_stop=bool(context.chat_data and context.chat_data.get("auto_stop")),
         )
+    except Stopped:
+        # Cancelled turns leave the session consistent, see Bot.ask_stream.
+        save_bot(context, bot)
+        await streamer.finish(f"{partial}\n\n（已停止）" if partial else "（已停止）")
+        return
+    except Overloaded as exc:
+        # Shed before reaching the upstream, the session is still intact.
+        logger.warning("request shed", engine=exc.engine, reason=exc.reason)
+        if flow is not None:
+            accounting.rejected(flow)
+            flow = None
+        await streamer.finish("忙，请稍后再试")
+        return
+    except resilience.CircuitOpen as exc:
+        # No fallback, the upstream wasn't asked and the session is intact.
+        logger.warning("engine unavailable", engine=exc.engine)
+        if flow is not None:
+            accounting.rejected(flow)
+            flow = None
+        await streamer.finish(f"{exc.engine} 暂时不可用，请稍后再试")
+        return
     except Exception:
-        text = "出错了"
-        await reply_text(update, text, quote=True)
+        # The live session may be half way through a turn, rebuild it from the
+        # last saved state next time.
+        sessions.discard(answering.bot_id)
+        await streamer.finish("出错了")
         raise
+    finally:
+        fairness.current.reset(token)
+        if flow is not None:
+            accounting.record(flow, time.monotonic() - asked)
 
     save_bot(context, bot)
 
-    keyboard = [[q] for q in bot.suggested_questions]
+    keyboard = [[q] for q in result.suggested_questions]
     if len(keyboard) > 0:
         reply_markup = ReplyKeyboardMarkup(keyboard)
     else:
         reply_markup = ReplyKeyboardRemove()
-    await reply_text(update, text, quote=True, reply_markup=reply_markup)
+    await streamer.finish(result.text, reply_markup=reply_markup)
 
 
+@metrics.timed
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Log the error and send a telegram message to notify the developer."""
-    # Log the error before we do anything else, so we can see it even if something breaks.
-
+    """Log the error and count it for the digests sent to the developer."""
     assert context.error is not None
+    key, new = errors.record(
+        context.error, update, context.chat_data, context.user_data
+    )
+    if not new:
+        # Repeats are counted in the digest, their traceback was logged.
+        logger.warning(
+            "Repeated exception while handling an update.",
+            error=repr(context.error),
+            fingerprint=key,
+        )
+        return
     try:
         raise context.error
     except:
-        logger.exception("Exception while handling an update.")
-
-    if config.exception_send_chat_id is not None:
-        # traceback.format_exception returns the usual python message about an exception, but as a
-        # list of strings rather than a single string, so we have to join them together.
-        tb_list = traceback.format_exception(
-            None, context.error, context.error.__traceback__
-        )
-        tb_string = "".join(tb_list)
-
-        # Build the message with some markup and additional information about what happened.
-        # You might need to add some logic to deal with messages longer than the 4096 character limit.
-        update_str = update.to_dict() if isinstance(update, Update) else str(update)
-        message = (
-            "An exception was raised while handling an update\n"
-            "<pre>update ="
-            f" {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
-            "</pre>\n\n"
-            f"<pre>context.chat_data = {html.escape(str(context.chat_data))}</pre>\n\n"
-            f"<pre>context.user_data = {html.escape(str(context.user_data))}</pre>\n\n"
-            f"<pre>{html.escape(tb_string)}</pre>"
-        )
-
-        # Finally, send the message
-        await context.bot.send_message(
-            chat_id=config.exception_send_chat_id,
-            text=message,
-            parse_mode=ParseMode.HTML,
-        )
+        logger.exception("Exception while handling an update.", fingerprint=key)
 
 
-def main():
-    logger.info(f"bot config: {config.dict()}")
-    logger.info(f"bing config: {bing.config.dict()}")
-    logger.info(f"chatgpt config: {chatgpt.config.dict()}")
-
+def add_handlers():
     ask_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), ask_callback)
     app.add_handler(ask_handler)
     app.add_handler(
@@ -360,7 +947,38 @@ def main():
     )
     app.add_error_handler(error_handler)
 
-    app.run_polling()
+
+def main():
+    logger.info("bot config", config=config.dict())
+    logger.info("engines", offered=list(engines.registry))
+
+    if front is not None:
+        asyncio.run(
+            sharding.run_front(
+                front,
+                servers,
+                f"{config.base_url or 'https://api.telegram.org/bot'}{config.bot_token}",
+                webhook_url=config.webhook_url
+                if config.update_mode == "webhook"
+                else None,
+                secret_token=config.webhook_secret_token,
+            )
+        )
+        return
+
+    add_handlers()
+    if config.update_mode == "webhook":
+        asyncio.run(
+            webhook.run_webhook(
+                app,
+                # Shard workers are fed by the front, not by Telegram.
+                config.webhook_url if config.shard_index is None else None,
+                secret_token=config.webhook_secret_token,
+                drop_pending_updates=config.webhook_drop_pending_updates,
+            )
+        )
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import typing as t
+import asyncio
 import json
-import copy
+import time
+from collections import deque
 
 import structlog
 import httpx
@@ -10,12 +12,44 @@ from EdgeGPT import ChatHub
 import pydantic as pyd
 
 import bot
+import metrics
+from admission import AdmissionController
+from record import SessionRecord
+from resilience import Policy
+from credentials import (
+    Account,
+    AccountThrottled,
+    AccountUnauthorized,
+    CredentialPool,
+    account_id,
+)
 
 logger = structlog.get_logger(__name__)
 
 
 class Config(pyd.BaseSettings):
     cookie_file: str = "./cookie.json"
+    cookie_files: t.List[str] = []
+    account_strategy: str = "least_in_flight"
+    throttle_cooldown: float = 60
+    unauthorized_cooldown: float = 3600
+    create_url: str = (
+        "https://edgeservices.bing.com/edgesvc/turing/conversation/create"
+    )
+    create_timeout: float = 30
+    context_pool_size: int = 4
+    context_ttl: float = 1800
+    max_in_flight: int = 32
+    max_queue: int = 64
+    queue_timeout: float = 10
+    adaptive_concurrency: bool = True
+    connect_timeout: float = 30
+    first_chunk_timeout: float = 60
+    idle_timeout: float = 60
+    total_timeout: float = 300
+    retries: int = 2
+    breaker_failures: int = 5
+    breaker_reset: float = 30
 
     class Config:
         env_file = ".env"
@@ -72,42 +106,144 @@ HEADERS_INIT_CONVER = {
 }
 
 
-async def create_conversation_context(cookies) -> t.Dict[str, t.Any]:
-    async with httpx.AsyncClient() as session:
-        session.headers.update(
-            {
-                "User-Agent": (
-                    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-                    " (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36"
-                ),
-            },
-        )
-        for cookie in cookies:
-            session.cookies.set(cookie["name"], cookie["value"])
-        url = "https://edgeservices.bing.com/edgesvc/turing/conversation/create"
-        # Send GET request
-        response = await session.get(
-            url,
-            timeout=30,
+_session: t.Optional[httpx.AsyncClient] = None
+
+
+def get_session() -> httpx.AsyncClient:
+    """Shared keep-alive client for the conversation endpoint."""
+    global _session
+    if _session is None or _session.is_closed:
+        _session = httpx.AsyncClient(
             headers=HEADERS_INIT_CONVER,
+            timeout=config.create_timeout,
+            limits=httpx.Limits(keepalive_expiry=60),
         )
-        if response.status_code != 200:
-            logger.warn(f"Status code:{response.status_code}, message:{response.text}")
-            raise RuntimeError("Authentication failed")
-        try:
-            context = response.json()
-            if context["result"]["value"] == "UnauthorizedRequest":
-                raise RuntimeError(context["result"]["message"])
-        except (json.decoder.JSONDecodeError, RuntimeError) as exc:
-            raise RuntimeError(
-                "Authentication failed. You have not been accepted into the beta.",
-            ) from exc
-        context["invocation_id"] = 0
-        return context
+    return _session
+
+
+async def create_conversation_context(account: Account) -> t.Dict[str, t.Any]:
+    session = get_session()
+    url = config.create_url
+    cookie = "; ".join(f"{c['name']}={c['value']}" for c in account.secret)
+    # Send GET request
+    response = await session.get(url, headers={"cookie": cookie})
+    if response.status_code == 429:
+        raise AccountThrottled(response.text)
+    if response.status_code in (401, 403):
+        raise AccountUnauthorized(response.text)
+    if response.status_code != 200:
+        logger.warn(f"Status code:{response.status_code}, message:{response.text}")
+        raise RuntimeError("Authentication failed")
+    try:
+        context = response.json()
+    except json.decoder.JSONDecodeError as exc:
+        raise RuntimeError(
+            "Authentication failed. You have not been accepted into the beta.",
+        ) from exc
+    if context["result"]["value"] == "UnauthorizedRequest":
+        raise AccountUnauthorized(context["result"]["message"])
+    context["invocation_id"] = 0
+    context["account"] = account.id
+    return context
+
+
+async def create_pooled_context() -> t.Dict[str, t.Any]:
+    account = accounts.pick()
+    async with accounts.use(account):
+        return await create_conversation_context(account)
+
+
+def check_result(response: t.Dict[str, t.Any]):
+    """Raise if the final ChatHub response says the account is unusable."""
+    result = response.get("item", {}).get("result", {})
+    value = result.get("value")
+    if value == "Throttled":
+        raise AccountThrottled(result.get("message"))
+    if value in ("UnauthorizedRequest", "Forbidden"):
+        raise AccountUnauthorized(result.get("message"))
+
+
+class ContextPool:
+    """Pool of fresh conversation contexts, refilled in the background.
+
+    `get` hands out a pooled context that is younger than `ttl` seconds and
+    only creates one inline when the pool is empty.
+    """
+
+    def __init__(
+        self,
+        create: t.Callable[[], t.Awaitable[t.Dict[str, t.Any]]],
+        size: int = 4,
+        ttl: float = 1800,
+        accept: t.Optional[t.Callable[[t.Dict[str, t.Any]], bool]] = None,
+    ) -> None:
+        self._create = create
+        self._accept = accept
+        self.size = size
+        self.ttl = ttl
+        self._contexts: t.Deque[t.Tuple[float, t.Dict[str, t.Any]]] = deque()
+        self._refill_task: t.Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+    def start(self):
+        self._refill()
+
+    async def get(self) -> t.Dict[str, t.Any]:
+        deadline = time.monotonic() - self.ttl
+        while self._contexts:
+            created_at, context = self._contexts.popleft()
+            if created_at > deadline and (
+                self._accept is None or self._accept(context)
+            ):
+                self.hits += 1
+                self._refill()
+                return context
+        self.misses += 1
+        self._refill()
+        return await self._create()
+
+    def _refill(self):
+        if self.size <= 0:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.get_running_loop().create_task(
+                self._refill_loop()
+            )
+
+    async def _refill_loop(self):
+        backoff = 1.0
+        while True:
+            deadline = time.monotonic() - self.ttl
+            while self._contexts and self._contexts[0][0] <= deadline:
+                self._contexts.popleft()
+            if len(self._contexts) >= self.size:
+                return
+            try:
+                context = await self._create()
+            except Exception:
+                logger.exception("create pooled conversation failed")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            backoff = 1.0
+            self._contexts.append((time.monotonic(), context))
+
+    async def close(self):
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            try:
+                await self._refill_task
+            except asyncio.CancelledError:
+                pass
+            self._refill_task = None
+        self._contexts.clear()
 
 
 class Bot(bot.Bot):
-    _cookies = None
     engine = "bing"
 
     def __init__(
@@ -122,44 +258,69 @@ class Bot(bot.Bot):
             self._client = None
         self._count = count
 
-    async def ask(self, prompt: str) -> str:
-
-        async def ask(
-            prompt: str,
-            conversation_style: t.Optional[str] = None,
-        ) -> t.Optional[t.Dict[str, t.Any]]:
-            """
-            Ask a question to the bot
-            """
-            if self._context is None:
-                self._context = await create_conversation_context(self._cookies)
-                self._client = Client(self._context)
-            assert self._client is not None
-            response = None
-            async for final, response in self._client.ask_stream(
-                prompt=prompt,
-                conversation_style=conversation_style,  # type: ignore
-            ):
-                if final:
-                    break
+    @property
+    def fresh(self) -> bool:
+        return self._client is None or self._client.request.invocation_id == 0
 
-            await self._client.close()
-            return response  # type: ignore
+    def _account(self) -> t.Optional[Account]:
+        assert self._context is not None
+        # Contexts saved before accounts were tracked belong to `cookie_file`.
+        return accounts.get(self._context.get("account", default_account))
+
+    async def ask_stream(self, prompt: str) -> t.AsyncIterator[t.Tuple[bool, str]]:
+        response = None
+        async with admission.slot() as slot:
+            with metrics.UpstreamTimer(self.engine) as timer:
+                if self._context is not None and self._account() is None:
+                    # The account owning this conversation is gone, start over.
+                    await self.reset()
+                if self._context is None:
+                    self._context = await policy.connect(context_pool.get())
+                    self._client = Client(self._context)
+                assert self._client is not None
+                account = self._account()
+                assert account is not None
+                timer.connected()
+
+                self._count += 1
+                invocation_id = self._client.request.invocation_id
+                async with accounts.use(account):
+                    try:
+                        async for final, response in self._client.ask_stream(
+                            prompt=prompt,
+                            conversation_style=self.style,  # type: ignore
+                        ):
+                            timer.chunk()
+                            slot.chunk()
+                            if final:
+                                break
+                            if response:
+                                yield False, response
+                    except BaseException:
+                        if response is None:
+                            # Failed or stopped before Bing answered, the next
+                            # ask takes this turn's place.
+                            self._client.request.invocation_id = invocation_id
+                            self._count -= 1
+                        raise
+                    finally:
+                        await self._client.close()
+                    if response is not None:
+                        check_result(response)
 
-        self._count += 1
-        response = await ask(prompt, conversation_style=self.style)  # type: ignore
         if response is None:
-            return "No response"
-        logger.info(f"[bot:{self.bot_id}] receive response: [{response}]")
+            yield True, "No response"
+            return
+        logger.debug("bing response", bot_id=self.bot_id, response=response)
         answer = response["item"]["messages"][1]
         self.suggested_questions = [res["text"] for res in answer["suggestedResponses"]]
-        # return answer["text"]
-        return answer["adaptiveCards"][0]["body"][0]["text"]
+        # yield True, answer["text"]
+        yield True, answer["adaptiveCards"][0]["body"][0]["text"]
 
     async def reset(self):
         if self._client is not None:
             await self._client.close()
-        self._context = await create_conversation_context(self._cookies)
+        self._context = await policy.connect(context_pool.get())
         self._client = Client(self._context)
 
     async def close(self):
@@ -178,28 +339,74 @@ class Bot(bot.Bot):
             bot_id=self.bot_id, engine=self.engine, style=self.style, count=self._count
         )
 
-    def serialize(self) -> t.Dict[str, t.Any]:
-        if self._context is not None:
+    def serialize(self) -> SessionRecord:
+        context = self._context
+        if context is not None:
             assert self._client is not None
-            context = copy.deepcopy(dict(**self._context))
-            context["invocation_id"] = self._client.request.invocation_id
-        else:
-            context = None
-        info = self.info()
-        return dict(info=info, context=context)
+            # A shallow copy, the context's values are never changed in place.
+            context = dict(context, invocation_id=self._client.request.invocation_id)
+        return self._save(
+            count=self._count, settings=dict(style=self.style), context=context
+        )
 
     @classmethod
-    def deserialize(cls, data: t.Dict[str, t.Any]) -> Bot:
-        info = data["info"]
-        context = data["context"]
-        return cls(
-            bot_id=info["bot_id"],
-            style=info["style"],
-            count=info["count"],
-            context=context,
+    def deserialize(cls, record: SessionRecord) -> Bot:
+        bot = cls(
+            bot_id=record.bot_id,
+            style=record.settings.get("style", "balanced"),
+            count=record.count,
+            context=record.context,
         )
+        bot._record = record
+        return bot
+
+
+def start():
+    context_pool.start()
+
+
+async def close():
+    await context_pool.close()
+    if _session is not None:
+        await _session.aclose()
+
+
+def load_accounts() -> t.List[Account]:
+    result = []
+    for path in config.cookie_files or [config.cookie_file]:
+        with open(path, "r") as f:
+            result.append(Account(account_id(path), json.load(f)))
+    return result
 
 
 config = Config()
-with open(config.cookie_file, "r") as f:
-    Bot._cookies = json.load(f)
+default_account = account_id(config.cookie_file)
+accounts = CredentialPool(
+    load_accounts(),
+    strategy=config.account_strategy,
+    throttle_cooldown=config.throttle_cooldown,
+    unauthorized_cooldown=config.unauthorized_cooldown,
+)
+admission = AdmissionController(
+    "bing",
+    max_in_flight=config.max_in_flight,
+    max_queue=config.max_queue,
+    queue_timeout=config.queue_timeout,
+    adaptive=config.adaptive_concurrency,
+)
+policy = Policy(
+    "bing",
+    connect_timeout=config.connect_timeout,
+    first_chunk_timeout=config.first_chunk_timeout,
+    idle_timeout=config.idle_timeout,
+    total_timeout=config.total_timeout,
+    retries=config.retries,
+    breaker_failures=config.breaker_failures,
+    breaker_reset=config.breaker_reset,
+)
+context_pool = ContextPool(
+    create_pooled_context,
+    size=config.context_pool_size,
+    ttl=config.context_ttl,
+    accept=lambda context: accounts.accounts[context["account"]].available,
+)
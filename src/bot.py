@@ -2,9 +2,13 @@ from __future__ import annotations
 
 import typing as t
 
+from record import SessionRecord
+
 
 class Bot:
     engine = "unknown"
+    # Made of other engines' sessions and applying their policies itself.
+    composite = False
 
     def __init__(
         self,
@@ -15,19 +19,53 @@ class Bot:
         self.bot_id = bot_id
         self.count = count
         self.suggested_questions = []
+        self.closed = False
+        self._record: t.Optional[SessionRecord] = None
+
+    @property
+    def fresh(self) -> bool:
+        """Whether the conversation has no turns yet."""
+        return False
 
     async def ask(self, prompt: str) -> str:
+        text = "No response"
+        async for _, text in self.ask_stream(prompt):
+            pass
+        return text
+
+    async def ask_stream(self, prompt: str) -> t.AsyncIterator[t.Tuple[bool, str]]:
+        """Yield `(final, text)` pairs, `text` being the whole answer so far."""
         raise NotImplementedError
+        yield
 
     async def reset(self):
         raise NotImplementedError
 
+    async def close(self):
+        self.closed = True
+
     def info(self):
         return dict(bot_id=self.bot_id, engine=self.engine, count=self.count)
 
-    def serialize(self) -> t.Dict[str, t.Any]:
+    def _save(self, **fields) -> SessionRecord:
+        """The session's record, with `fields` updated."""
+        if self._record is None:
+            self._record = SessionRecord(self.bot_id, self.engine, **fields)
+        else:
+            self._record.update(**fields)
+        return self._record
+
+    def serialize(self) -> SessionRecord:
+        """The session's record, the same one as long as the session lives."""
         raise NotImplementedError
 
     @classmethod
-    def deserialize(cls, data: t.Dict[str, t.Any]) -> Bot:
+    def deserialize(cls, record: SessionRecord) -> Bot:
         raise NotImplementedError
+
+    @classmethod
+    def compact(cls, record: SessionRecord) -> SessionRecord:
+        """Record without the conversation, keeping the settings."""
+        if record.context is None:
+            return record
+        return record.replace(context=None)
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+import structlog
+
+import metrics
+
+logger = structlog.get_logger(__name__)
+
+Key = t.Tuple[str, str, str]
+
+caches: t.List[ResponseCache] = []
+
+CACHE_LOOKUPS = metrics.registry.counter(
+    "response_cache_lookups_total",
+    "Response cache lookups by result: hit, miss or shared in-flight answer.",
+    ["result"],
+)
+metrics.registry.gauge(
+    "response_cache_entries",
+    "Cached answers.",
+    fn=lambda: sum(len(c) for c in caches),
+)
+metrics.registry.gauge(
+    "response_cache_bytes",
+    "Approximate size of the cached answers.",
+    fn=lambda: sum(c.size for c in caches),
+)
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = "?？!！.。~～…"
+
+
+def normalize(prompt: str) -> str:
+    """Fold case, width and whitespace so trivially different prompts match."""
+    prompt = unicodedata.normalize("NFKC", prompt).casefold()
+    prompt = _SPACES.sub(" ", prompt).strip()
+    return prompt.rstrip(_TRAILING_PUNCTUATION).rstrip()
+
+
+class Answer:
+    __slots__ = ("text", "suggested_questions", "created_at", "size")
+
+    def __init__(
+        self,
+        text: str,
+        suggested_questions: t.List[str],
+        created_at: t.Optional[float] = None,
+    ) -> None:
+        self.text = text
+        self.suggested_questions = suggested_questions
+        # Wall clock time, so the ttl still holds after a restart.
+        self.created_at = time.time() if created_at is None else created_at
+        self.size = len(text.encode()) + sum(
+            len(q.encode()) for q in suggested_questions
+        )
+
+
+class ResponseCache:
+    """Answers to first turns, keyed by engine, style and normalized prompt.
+
+    Only turns without prior conversation context are cacheable, the answer
+    does not depend on anything but the prompt there. Entries expire after
+    `ttl` seconds and are evicted in LRU order once there are more than
+    `max_entries` of them or they take more than `max_bytes`. Concurrent
+    misses on the same key share a single upstream ask.
+
+    A cache hit leaves the session without context, so the conversation
+    starts with the next uncached prompt.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        max_bytes: int = 16 * 1024 * 1024,
+        ttl: float = 3600,
+        max_prompt_length: int = 200,
+        path: t.Optional[str] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_prompt_length = max_prompt_length
+        self.path = path
+        self.size = 0
+        self._answers: OrderedDict[Key, Answer] = OrderedDict()
+        self._flights: t.Dict[Key, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        caches.append(self)
+
+    def __len__(self) -> int:
+        return len(self._answers)
+
+    def key(
+        self, engine: str, style: t.Optional[str], prompt: str
+    ) -> t.Optional[Key]:
+        """Cache key of a prompt, None if the prompt is not worth caching."""
+        normalized = normalize(prompt)
+        if not normalized or len(normalized) > self.max_prompt_length:
+            return None
+        return (engine, style or "", normalized)
+
+    def get(self, key: Key) -> t.Optional[Answer]:
+        answer = self._answers.get(key)
+        if answer is None:
+            return None
+        if time.time() - answer.created_at >= self.ttl:
+            self._remove(key)
+            return None
+        self._answers.move_to_end(key)
+        return answer
+
+    def put(self, key: Key, answer: Answer):
+        if answer.size > self.max_bytes:
+            return
+        if key in self._answers:
+            self._remove(key)
+        self._answers[key] = answer
+        self.size += answer.size
+        while len(self._answers) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self._answers)))
+            self.evictions += 1
+
+    def _remove(self, key: Key):
+        self.size -= self._answers.pop(key).size
+
+    async def fetch(
+        self,
+        key: Key,
+        ask: t.Callable[[], t.Awaitable[t.Tuple[Answer, bool]]],
+    ) -> Answer:
+        """Cached answer for `key`, asking upstream with `ask` on a miss.
+
+        `ask` returns the answer and whether it may be cached. Callers missing
+        while another ask for `key` is in flight wait for its answer instead;
+        if that ask fails or is not cacheable, one of them asks again.
+        """
+        while True:
+            answer = self.get(key)
+            if answer is not None:
+                self.hits += 1
+                CACHE_LOOKUPS.inc("hit")
+                return answer
+            flight = self._flights.get(key)
+            if flight is None:
+                break
+            answer = await asyncio.shield(flight)
+            if answer is not None:
+                self.shared += 1
+                CACHE_LOOKUPS.inc("shared")
+                return answer
+
+        self.misses += 1
+        CACHE_LOOKUPS.inc("miss")
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        result = None
+        try:
+            answer, cacheable = await ask()
+            if cacheable:
+                self.put(key, answer)
+                result = answer
+            return answer
+        finally:
+            del self._flights[key]
+            flight.set_result(result)
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            logger.exception("load response cache failed", path=self.path)
+            return
+        now = time.time()
+        for entry in entries:
+            answer = Answer(
+                entry["text"], entry["suggested_questions"], entry["created_at"]
+            )
+            if now - answer.created_at < self.ttl:
+                self.put(tuple(entry["key"]), answer)  # type: ignore
+        logger.info("response cache loaded", path=self.path, entries=len(self))
+
+    def save(self):
+        if self.path is None:
+            return
+        now = time.time()
+        entries = [
+            dict(
+                key=list(key),
+                text=answer.text,
+                suggested_questions=answer.suggested_questions,
+                created_at=answer.created_at,
+            )
+            for key, answer in self._answers.items()
+            if now - answer.created_at < self.ttl
+        ]
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def stats(self) -> t.Dict[str, int]:
+        return dict(
+            entries=len(self),
+            bytes=self.size,
+            hits=self.hits,
+            misses=self.misses,
+            shared=self.shared,
+            evictions=self.evictions,
+        )
@@ -1,22 +1,207 @@
 from __future__ import annotations
 
 import typing as t
+import contextlib
+import datetime
+import re
+import time
 
 from revChatGPT.V1 import AsyncChatbot
 import pydantic as pyd
+import structlog
 
 import bot
+import engines
+import metrics
+from admission import AdmissionController
+from housekeeping import Housekeeper
+from record import SessionRecord
+from resilience import Policy
+from credentials import (
+    Account,
+    AccountThrottled,
+    AccountUnauthorized,
+    CredentialPool,
+    account_id,
+)
 
 
 class Config(pyd.BaseSettings):
-    access_token: str
+    access_token: t.Optional[str] = None
+    access_tokens: t.List[str] = []
+    base_url: t.Optional[str] = None
+    account_strategy: str = "least_in_flight"
+    throttle_cooldown: float = 60
+    unauthorized_cooldown: float = 3600
+    max_in_flight: int = 32
+    max_queue: int = 64
+    queue_timeout: float = 10
+    adaptive_concurrency: bool = True
+    connect_timeout: float = 30
+    first_chunk_timeout: float = 60
+    idle_timeout: float = 60
+    total_timeout: float = 300
+    retries: int = 2
+    breaker_failures: int = 5
+    breaker_reset: float = 30
+    # Conversations are renamed and deleted in the background, in batches
+    # every housekeeping_interval seconds.
+    housekeeping_interval: float = 5
+    housekeeping_max_batch: int = 20
+    housekeeping_retries: int = 5
+    # Every gc_interval seconds, delete the bot's conversations not updated
+    # for gc_max_age seconds that no saved session refers to any more, e.g.
+    # those of chats the reaper compacted. 0 disables it.
+    gc_interval: float = 6 * 3600
+    gc_max_age: float = 30 * 24 * 3600
+    gc_max_pages: int = 10
 
     class Config:
         env_file = ".env"
         env_prefix = "chatgpt_"
 
 
+logger = structlog.get_logger(__name__)
+
+TITLE = "[chatbot][id:{bot_id}]"
+_TITLE = re.compile(r"^\[chatbot\]\[id:[^\]]+\]$")
+
+
 config = Config()  # type: ignore
+default_account = account_id(config.access_token) if config.access_token else None
+accounts = CredentialPool(
+    [
+        Account(account_id(token), token)
+        for token in config.access_tokens or [config.access_token]
+        if token
+    ],
+    strategy=config.account_strategy,
+    throttle_cooldown=config.throttle_cooldown,
+    unauthorized_cooldown=config.unauthorized_cooldown,
+)
+admission = AdmissionController(
+    "chatgpt",
+    max_in_flight=config.max_in_flight,
+    max_queue=config.max_queue,
+    queue_timeout=config.queue_timeout,
+    adaptive=config.adaptive_concurrency,
+)
+policy = Policy(
+    "chatgpt",
+    connect_timeout=config.connect_timeout,
+    first_chunk_timeout=config.first_chunk_timeout,
+    idle_timeout=config.idle_timeout,
+    total_timeout=config.total_timeout,
+    retries=config.retries,
+    breaker_failures=config.breaker_failures,
+    breaker_reset=config.breaker_reset,
+)
+
+
+def connect(account_id: str) -> t.Optional[AsyncChatbot]:
+    """Client for housekeeping with `account_id`, None while it's cooling down."""
+    account = accounts.accounts[account_id]
+    if not account.available:
+        return None
+    kwargs = {}
+    if config.base_url is not None:
+        kwargs["base_url"] = config.base_url
+    return AsyncChatbot(config=dict(access_token=account.secret), **kwargs)
+
+
+async def disconnect(client: AsyncChatbot):
+    await client.session.aclose()  # type: ignore
+
+
+def _updated_at(conversation: t.Dict[str, t.Any]) -> float:
+    value = conversation.get("update_time") or conversation.get("create_time")
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not value:
+        return 0.0
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def _in_use(record: SessionRecord, conversations: t.Set[str]):
+    if record.engine == Bot.engine and record.context:
+        conversation_id = record.context.get("conversation_id")
+        if conversation_id is not None:
+            conversations.add(conversation_id)
+    for sub in record.bots.values():
+        _in_use(sub, conversations)
+
+
+async def collect(housekeeper: Housekeeper):
+    """Delete the bot's stale conversations no saved session refers to."""
+    assert engines.registry.visit_sessions is not None
+    in_use: t.Set[str] = set()
+    await engines.registry.visit_sessions(lambda r: _in_use(r, in_use))
+    cutoff = time.time() - config.gc_max_age
+    for account in list(accounts.accounts.values()):
+        client = connect(account.id)
+        if client is None:
+            continue
+        found = 0
+        try:
+            for page in range(config.gc_max_pages):
+                conversations = await client.get_conversations(
+                    offset=page * 100, limit=100
+                )
+                for conversation in conversations:
+                    title = conversation.get("title") or ""
+                    if (
+                        _TITLE.match(title)
+                        and _updated_at(conversation) < cutoff
+                        and conversation["id"] not in in_use
+                    ):
+                        housekeeper.delete(account.id, conversation["id"])
+                        found += 1
+                if len(conversations) < 100:
+                    break
+        except Exception as exc:
+            logger.warning(
+                "collect conversations failed", account=account.id, error=repr(exc)
+            )
+        finally:
+            await disconnect(client)
+        logger.info("collected conversations", account=account.id, orphaned=found)
+
+
+housekeeper = Housekeeper(
+    "chatgpt",
+    connect,
+    disconnect,
+    interval=config.housekeeping_interval,
+    max_batch=config.housekeeping_max_batch,
+    retries=config.housekeeping_retries,
+    collect=collect,
+    collect_interval=config.gc_interval,
+)
+
+
+def start():
+    if engines.registry.visit_sessions is None:
+        # Saved sessions unknown, or another process collects.
+        housekeeper.collect = None
+    housekeeper.start()
+
+
+async def close():
+    await housekeeper.close()
+
+
+@contextlib.contextmanager
+def account_errors():
+    """Translate revChatGPT errors about the account into credential errors."""
+    try:
+        yield
+    except Exception as exc:
+        code = getattr(exc, "code", None)
+        if code == 429:
+            raise AccountThrottled(str(exc)) from exc
+        if code in (401, 403):
+            raise AccountUnauthorized(str(exc)) from exc
+        raise
 
 
 class Bot(bot.Bot):
@@ -31,53 +216,111 @@ class Bot(bot.Bot):
             else dict(conversation_id=None, parent_id=None)
         )
 
-    async def _init_bot(self):
+    @property
+    def fresh(self) -> bool:
+        return self._context["conversation_id"] is None
+
+    def _bind_account(self) -> Account:
+        """Return the account owning the conversation, binding one if needed."""
+        # Contexts saved before accounts were tracked belong to `access_token`.
+        account = accounts.get(self._context.get("account", default_account))
+        if account is None or self._context["conversation_id"] is None:
+            if account is None or not account.available:
+                # New conversation, or the account owning it is gone.
+                account = accounts.pick()
+            self._context = dict(
+                conversation_id=None, parent_id=None, account=account.id
+            )
+        else:
+            self._context["account"] = account.id
+        return account
+
+    async def _init_bot(self, account: Account):
         if self._bot is None:
+            kwargs = {}
+            if config.base_url is not None:
+                kwargs["base_url"] = config.base_url
             self._bot = AsyncChatbot(
-                config=config.dict(),
+                config=dict(access_token=account.secret),
                 conversation_id=self._context["conversation_id"],
                 parent_id=self._context["parent_id"],
+                **kwargs,
             )
-            if self._context["conversation_id"] is None:
-                await self._bot.clear_conversations()
 
-                response = await self._ask_bot("chatgpt")
-                if response is None:
-                    raise RuntimeError("chatgpt init failed")
-            title = f"[chatbot][id:{self.bot_id}]"
-            await self._bot.change_title(self._context["conversation_id"], title)  # type: ignore
-
-    async def _ask_bot(self, prompt: str) -> t.Optional[dict[str, t.Any]]:
+    async def _ask_bot(self, prompt: str) -> t.AsyncIterator[t.Dict[str, t.Any]]:
+        new = self._context["conversation_id"] is None
         response = None
-        async for r in self._bot.ask(prompt):  # type: ignore
-            response = r
+        try:
+            async for response in self._bot.ask(prompt):  # type: ignore
+                yield response
+        except BaseException:
+            if new and response is not None:
+                # The first turn didn't complete, the conversation is dropped.
+                housekeeper.delete(
+                    self._context["account"], response["conversation_id"]
+                )
+            raise
         if response is not None:
             self._context["conversation_id"] = response["conversation_id"]
             self._context["parent_id"] = response["parent_id"]
-        return response
+            if new:
+                housekeeper.change_title(
+                    self._context["account"],
+                    response["conversation_id"],
+                    TITLE.format(bot_id=self.bot_id),
+                )
 
-    async def ask(self, prompt: str) -> str:
-        await self._init_bot()
-        response = await self._ask_bot(prompt)
-        await self._bot.session.aclose()  # type: ignore
-        self._bot = None
+    async def ask_stream(self, prompt: str) -> t.AsyncIterator[t.Tuple[bool, str]]:
+        if self._bot is not None:
+            account = accounts.accounts[self._context["account"]]
+        else:
+            account = self._bind_account()
+        response = None
+        async with admission.slot() as slot:
+            with metrics.UpstreamTimer(self.engine) as timer:
+                async with accounts.use(account):
+                    with account_errors():
+                        await policy.connect(self._init_bot(account))
+                        timer.connected()
+                        async for response in self._ask_bot(prompt):
+                            timer.chunk()
+                            slot.chunk()
+                            yield False, response["message"]
         if response is None:
-            return "No response"
-        return response["message"]
+            yield True, "No response"
+            return
+        yield True, response["message"]
 
     async def reset(self):
         conv_id = self._context["conversation_id"]
+        account_id = self._context.get("account", default_account)
         self._context = dict(conversation_id=None, parent_id=None)
+        if conv_id is not None and account_id is not None:
+            housekeeper.delete(account_id, conv_id)
         if self._bot is not None:
-            if conv_id is not None:
-                await self._bot.delete_conversation(conv_id)
             await self._bot.session.aclose()  # type: ignore
             self._bot = None
 
-    def serialize(self):
-        return dict(info=self.info(), context=self._context)
+    async def close(self):
+        if self.closed:
+            return
+
+        if self._bot is not None:
+            await self._bot.session.aclose()  # type: ignore
+            self._bot = None
+
+        self.closed = True
+
+    def serialize(self) -> SessionRecord:
+        # The context is changed in place, the record gets a copy.
+        return self._save(count=self.count, context=dict(self._context))
 
     @classmethod
-    def deserialize(cls, data: t.Dict[str, t.Any]) -> Bot:
-        info = data["info"]
-        return cls(bot_id=info["bot_id"], count=info["count"], context=data["context"])
+    def deserialize(cls, record: SessionRecord) -> Bot:
+        bot = cls(
+            bot_id=record.bot_id,
+            count=record.count,
+            context=dict(record.context) if record.context is not None else None,
+        )
+        bot._record = record
+        return bot
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import time
+
+import structlog
+from telegram import Message, Update
+
+import metrics
+
+logger = structlog.get_logger(__name__)
+
+COALESCED = metrics.registry.counter(
+    "coalesced_messages_total", "Text messages merged into an earlier one."
+)
+
+Key = t.Tuple[int, int]
+
+
+class Batch:
+    __slots__ = ("updates", "last", "closed", "touched")
+
+    def __init__(self, update: Update) -> None:
+        self.updates = [update]
+        self.last = time.monotonic()
+        self.closed = False
+        self.touched = asyncio.Event()
+
+    def add(self, update: Update):
+        self.updates.append(update)
+        self.last = time.monotonic()
+        self.touched.set()
+
+    def close(self):
+        self.closed = True
+        self.touched.set()
+
+
+class MessageCoalescer:
+    """Merge quick successive text messages of a user into one prompt.
+
+    A text message opens a batch for its chat and user. Further text messages
+    join it until the batch gets its turn in the chat and no message arrived
+    for `window` seconds, it holds `max_batch` messages, or another kind of
+    update arrives in the chat. The batch is then handled as a single message
+    with the texts joined by newlines, replying to the last one.
+    """
+
+    def __init__(self, window: float = 0.5, max_batch: int = 4) -> None:
+        self.window = window
+        self.max_batch = max_batch
+        self._open: t.Dict[Key, Batch] = {}
+
+    @staticmethod
+    def key(update: Update) -> t.Optional[Key]:
+        """Key of a coalescable update, None for any other update."""
+        message = update.message
+        if message is None or message.text is None or message.from_user is None:
+            return None
+        if message.text.startswith("/"):
+            return None
+        return (message.chat_id, message.from_user.id)
+
+    def add(self, key: Key, update: Update) -> t.Optional[Batch]:
+        """Add `update` to the open batch, or return a new batch to schedule."""
+        batch = self._open.get(key)
+        if (
+            batch is not None
+            and not batch.closed
+            and len(batch.updates) < self.max_batch
+        ):
+            batch.add(update)
+            COALESCED.inc()
+            return None
+        batch = self._open[key] = Batch(update)
+        return batch
+
+    def flush(self, chat_id: int):
+        """Stop waiting for more messages in `chat_id`, to keep update order.
+
+        Messages arriving later open new batches, scheduled after the update
+        that flushed.
+        """
+        for key in [key for key in self._open if key[0] == chat_id]:
+            self._open.pop(key).close()
+
+    async def ready(self, key: Key, batch: Batch):
+        """Wait out the debounce window once the batch is next in its chat."""
+        while not batch.closed and len(batch.updates) < self.max_batch:
+            remaining = batch.last + self.window - time.monotonic()
+            if remaining <= 0:
+                break
+            batch.touched.clear()
+            try:
+                await asyncio.wait_for(batch.touched.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        self.close(key, batch)
+
+    def close(self, key: Key, batch: Batch):
+        """Let no more messages join `batch`."""
+        batch.closed = True
+        if self._open.get(key) is batch:
+            del self._open[key]
+
+    @staticmethod
+    def merge(batch: Batch) -> Update:
+        last = batch.updates[-1]
+        if len(batch.updates) == 1:
+            return last
+        assert last.message is not None
+        data = last.message.to_dict()
+        # Entity offsets refer to the single message text.
+        data.pop("entities", None)
+        data["text"] = "\n".join(
+            u.message.text for u in batch.updates if u.message and u.message.text
+        )
+        bot = last.get_bot()
+        merged = Update(update_id=last.update_id, message=Message.de_json(data, bot))
+        merged.set_bot(bot)
+        logger.debug(
+            "messages coalesced",
+            chat_id=last.message.chat_id,
+            count=len(batch.updates),
+        )
+        return merged
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import typing as t
+import contextlib
+import hashlib
+import itertools
+import time
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+class AccountThrottled(RuntimeError):
+    """The upstream account hit its rate limit."""
+
+
+class AccountUnauthorized(RuntimeError):
+    """The upstream account's credentials were rejected."""
+
+
+def account_id(secret: str) -> str:
+    """Stable id for a secret that is safe to persist and log."""
+    return hashlib.sha256(secret.encode()).hexdigest()[:12]
+
+
+class Account:
+    def __init__(self, id: str, secret: t.Any) -> None:
+        self.id = id
+        self.secret = secret
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.last_error: t.Optional[str] = None
+
+    @property
+    def available(self) -> bool:
+        return self.cooldown_until <= time.monotonic()
+
+    def health(self) -> t.Dict[str, t.Any]:
+        return dict(
+            id=self.id,
+            available=self.available,
+            cooldown=max(0.0, self.cooldown_until - time.monotonic()),
+            in_flight=self.in_flight,
+            requests=self.requests,
+            failures=self.failures,
+            last_error=self.last_error,
+        )
+
+
+class CredentialPool:
+    """Route upstream requests over several accounts of one engine.
+
+    New conversations go to an available account picked by `strategy`
+    (`least_in_flight` or `round_robin`); a conversation stays bound to the
+    account that created it. Throttled accounts are cooled down for
+    `throttle_cooldown` seconds and unauthorized ones for
+    `unauthorized_cooldown` seconds.
+    """
+
+    def __init__(
+        self,
+        accounts: t.Iterable[Account],
+        strategy: str = "least_in_flight",
+        throttle_cooldown: float = 60,
+        unauthorized_cooldown: float = 3600,
+    ) -> None:
+        self.accounts: t.Dict[str, Account] = {a.id: a for a in accounts}
+        if not self.accounts:
+            raise ValueError("credential pool needs at least one account")
+        if strategy not in ("least_in_flight", "round_robin"):
+            raise ValueError(f"unknown strategy: {strategy}")
+        self.strategy = strategy
+        self.throttle_cooldown = throttle_cooldown
+        self.unauthorized_cooldown = unauthorized_cooldown
+        self._round_robin = itertools.cycle(list(self.accounts))
+
+    def get(self, id: t.Optional[str]) -> t.Optional[Account]:
+        if id is None:
+            return None
+        return self.accounts.get(id)
+
+    def pick(self) -> Account:
+        """Pick an account for a new conversation."""
+        available = [a for a in self.accounts.values() if a.available]
+        if not available:
+            # Everything is cooling down, use whatever recovers first.
+            return min(self.accounts.values(), key=lambda a: a.cooldown_until)
+        if self.strategy == "round_robin":
+            for id in self._round_robin:
+                account = self.accounts[id]
+                if account.available:
+                    return account
+        return min(available, key=lambda a: (a.in_flight, a.requests))
+
+    def cooldown(self, account: Account, duration: float, reason: str):
+        account.cooldown_until = max(
+            account.cooldown_until, time.monotonic() + duration
+        )
+        account.last_error = reason
+        logger.warn(f"[account:{account.id}] cooling down {duration}s: {reason}")
+
+    @contextlib.asynccontextmanager
+    async def use(self, account: Account) -> t.AsyncIterator[Account]:
+        account.in_flight += 1
+        account.requests += 1
+        try:
+            yield account
+        except AccountThrottled as exc:
+            account.failures += 1
+            self.cooldown(account, self.throttle_cooldown, f"throttled: {exc}")
+            raise
+        except AccountUnauthorized as exc:
+            account.failures += 1
+            self.cooldown(account, self.unauthorized_cooldown, f"unauthorized: {exc}")
+            raise
+        except Exception as exc:
+            account.failures += 1
+            account.last_error = repr(exc)
+            raise
+        finally:
+            account.in_flight -= 1
+
+    def health(self) -> t.List[t.Dict[str, t.Any]]:
+        return [a.health() for a in self.accounts.values()]
@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import importlib
+import threading
+import time
+from importlib import metadata
+from types import ModuleType
+
+import structlog
+
+import bot
+import metrics
+from record import SessionRecord
+
+logger = structlog.get_logger(__name__)
+
+# Entry point group third-party engines are discovered in, by name. The value
+# names the engine module, optionally with its `Bot` class: "pkg.mod:Bot".
+ENTRY_POINT_GROUP = "tg_chatbot.engines"
+
+BUILTIN = {
+    "bing": "bing",
+    "chatgpt": "chatgpt",
+    "race": "race",
+}
+
+
+def _entry_points(group: str) -> t.Iterable[metadata.EntryPoint]:
+    eps = metadata.entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=group)
+    # Python 3.9 returns a dict of groups.
+    return t.cast(t.Dict[str, t.List[metadata.EntryPoint]], eps).get(group, [])
+
+
+class EngineUnavailable(RuntimeError):
+    """The engine failed to load, it isn't retried until a restart."""
+
+    def __init__(self, engine: str) -> None:
+        super().__init__(f"engine {engine} is unavailable")
+        self.engine = engine
+
+
+class Engine:
+    __slots__ = ("name", "target", "module", "bot_type", "init_seconds", "error")
+
+    def __init__(self, name: str, target: str) -> None:
+        self.name = name
+        self.target = target
+        self.module: t.Optional[ModuleType] = None
+        self.bot_type: t.Optional[t.Type[bot.Bot]] = None
+        self.init_seconds: t.Optional[float] = None
+        self.error: t.Optional[Exception] = None
+
+
+class EngineRegistry(t.Mapping[str, t.Type[bot.Bot]]):
+    """Chat engines by name, each imported and set up on first use.
+
+    An engine is a module with a `Bot` class, and optionally `config`,
+    `accounts`, `REQUIRES`, the engines it is built on, a `start()` run once
+    the application is up and an async `close()` run on shutdown. Importing
+    the module is what initialises it, reading its config and credentials,
+    so a deployment only pays for the engines its chats use.
+
+    Looking an engine up loads it, iterating the registry does not, and
+    only iterates the engines offered to chats. `preload` loads the offered
+    engines off the event loop at startup. An engine that can't be loaded,
+    usually for lack of configuration, is no longer offered and looking it
+    up raises `EngineUnavailable`. Engines are started on the event loop,
+    whichever thread loads them.
+
+    `visit_sessions`, set by the application, calls a function with every
+    chat's saved `SessionRecord`, for engines to tell what is still in use.
+    Only one of the processes sharing a database sets it, engines don't
+    collect anything without it.
+    """
+
+    visit_sessions: t.Optional[
+        t.Callable[[t.Callable[[SessionRecord], None]], t.Awaitable[None]]
+    ] = None
+
+    def __init__(self, engines: t.Mapping[str, str] = BUILTIN) -> None:
+        self._engines = {
+            name: Engine(name, target) for name, target in engines.items()
+        }
+        self._offered: t.Optional[t.List[str]] = None
+        # Loop the engines are started on, once `start` was called.
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+        # Engines are loaded on a thread by `preload`.
+        self._lock = threading.RLock()
+
+    def register(self, name: str, target: str):
+        """Add the engine in module `target`, "module" or "module:Bot"."""
+        if name in self._engines and self._engines[name].module is not None:
+            raise ValueError(f"engine {name} is already loaded")
+        self._engines[name] = Engine(name, target)
+
+    def discover(self, group: str = ENTRY_POINT_GROUP):
+        """Register the engines installed packages declare as entry points."""
+        for ep in _entry_points(group):
+            self.register(ep.name, ep.value)
+
+    def offer(self, names: t.Iterable[str]):
+        """Offer only the engines in `names` to chats.
+
+        The others can still be looked up, by chats that used them before or
+        by engines built on them.
+        """
+        names = list(names)
+        unknown = [name for name in names if name not in self._engines]
+        if unknown:
+            raise ValueError(f"unknown engines: {', '.join(unknown)}")
+        self._offered = names
+
+    def names(self) -> t.List[str]:
+        """Every registered engine, offered or not."""
+        return list(self._engines)
+
+    def _available(self) -> t.List[str]:
+        names = self._offered if self._offered is not None else self._engines
+        return [name for name in names if self._engines[name].error is None]
+
+    def __iter__(self) -> t.Iterator[str]:
+        return iter(self._available())
+
+    def __len__(self) -> int:
+        return len(self._available())
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._engines
+
+    def offers(self, name: str) -> bool:
+        return (
+            name in self._engines
+            and self._engines[name].error is None
+            and (self._offered is None or name in self._offered)
+        )
+
+    def __getitem__(self, name: str) -> t.Type[bot.Bot]:
+        return self.load(name).bot_type  # type: ignore[return-value]
+
+    def load(self, name: str) -> Engine:
+        with self._lock:
+            return self._load(name)
+
+    def _load(self, name: str) -> Engine:
+        engine = self._engines[name]
+        if engine.bot_type is not None:
+            return engine
+        if engine.error is not None:
+            raise EngineUnavailable(name) from engine.error
+        module_name, _, attr = engine.target.partition(":")
+        start = time.perf_counter()
+        try:
+            module = importlib.import_module(module_name)
+            bot_type = getattr(module, attr or "Bot")
+            for required in getattr(module, "REQUIRES", ()):
+                self._load(required)
+        except Exception as exc:
+            engine.error = exc
+            logger.warning("engine unavailable", engine=name, error=repr(exc))
+            raise EngineUnavailable(name) from exc
+        if self._loop is not None and hasattr(module, "start"):
+            self._loop.call_soon_threadsafe(module.start)
+        engine.init_seconds = time.perf_counter() - start
+        engine.module, engine.bot_type = module, bot_type
+        config = getattr(module, "config", None)
+        accounts = getattr(module, "accounts", None)
+        logger.info(
+            "engine loaded",
+            engine=name,
+            elapsed=engine.init_seconds,
+            config=config.dict() if config is not None else None,
+            accounts=accounts.health() if accounts is not None else None,
+        )
+        return engine
+
+    def _preload(self, names: t.List[str]) -> t.Dict[str, Exception]:
+        failed = {}
+        for name in names:
+            try:
+                self.load(name)
+            except EngineUnavailable as exc:
+                failed[name] = t.cast(Exception, exc.__cause__)
+        return failed
+
+    async def preload(self, names: t.Iterable[str] = ()) -> t.Dict[str, Exception]:
+        """Load the offered engines and `names` on a thread, before `start`.
+
+        Returns the errors of the engines that failed to load, which are no
+        longer offered.
+        """
+        return await asyncio.to_thread(
+            self._preload, list(dict.fromkeys([*self, *names]))
+        )
+
+    def loaded(self) -> t.Dict[str, ModuleType]:
+        """Modules of the engines loaded so far, by name."""
+        return {
+            name: engine.module
+            for name, engine in self._engines.items()
+            if engine.module is not None
+        }
+
+    def init_times(self) -> t.Dict[str, float]:
+        return {
+            name: engine.init_seconds
+            for name, engine in self._engines.items()
+            if engine.init_seconds is not None
+        }
+
+    def start(self):
+        """Start the engines loaded so far, and the others once loaded.
+
+        Called on the event loop, which engines loaded later are started on.
+        """
+        self._loop = asyncio.get_running_loop()
+        for module in self.loaded().values():
+            if hasattr(module, "start"):
+                module.start()
+
+    async def close(self):
+        for name, module in self.loaded().items():
+            if hasattr(module, "close"):
+                try:
+                    await module.close()
+                except Exception:
+                    logger.exception("close engine failed", engine=name)
+
+
+registry = EngineRegistry()
+
+metrics.registry.gauge(
+    "engine_init_seconds",
+    "Time taken to import and set up each engine loaded.",
+    ["engine"],
+    fn=lambda: {(name,): elapsed for name, elapsed in registry.init_times().items()},
+)
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import typing as t
+import collections
+import hashlib
+import html
+import json
+import os
+import reprlib
+import time
+import traceback
+
+import structlog
+from telegram import Update
+from telegram.constants import ParseMode
+from telegram.ext import CallbackContext
+
+import metrics
+from render import MESSAGE_LIMIT
+
+logger = structlog.get_logger(__name__)
+
+ERRORS = metrics.registry.counter(
+    "errors_total", "Exceptions raised while handling updates.", ["type"]
+)
+ERROR_REPORTS = metrics.registry.counter(
+    "error_reports_sent_total", "Exception report messages sent."
+)
+
+# Budgets of the parts of a report, in characters.
+_UPDATE_LIMIT = 800
+_DATA_LIMIT = 400
+
+_repr = reprlib.Repr()
+_repr.maxlevel = 3
+_repr.maxdict = 8
+_repr.maxlist = 8
+_repr.maxstring = 60
+_repr.maxother = 60
+
+
+def fingerprint(error: BaseException) -> str:
+    """Identify an exception by its type and the code it was raised through."""
+    parts = [f"{type(error).__module__}.{type(error).__qualname__}"]
+    for frame, lineno in traceback.walk_tb(error.__traceback__):
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{lineno}")
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()[:12]
+
+
+def _truncate(text: str, limit: int, tail: bool = False) -> str:
+    if len(text) <= limit:
+        return text
+    return "…" + text[-limit + 1 :] if tail else text[: limit - 1] + "…"
+
+
+def _pre(text: str) -> str:
+    return f"<pre>{html.escape(text, quote=False)}</pre>"
+
+
+class _Error:
+    __slots__ = ("name", "count", "first_seen", "last_seen", "reported", "sample")
+
+    def __init__(self, name: str, now: float) -> None:
+        self.name = name
+        self.count = 0
+        self.first_seen = now
+        self.last_seen = now
+        self.reported: t.Optional[float] = None
+        # The first occurrence since the last report, formatted when reported.
+        self.sample: t.Optional[t.Tuple[BaseException, object, t.Any, t.Any]] = None
+
+
+class ErrorDigest:
+    """Aggregate exceptions into periodic reports, as a `JobQueue` job.
+
+    Handling an exception only fingerprints and counts it. Each run sends a
+    detailed report of the first occurrence of each exception not reported
+    in the last `window` seconds, with its count, and a single summary of
+    how often the others happened since, at most `max_reports` messages of
+    bounded size in all.
+    """
+
+    def __init__(
+        self,
+        chat_id: t.Optional[int],
+        window: float = 3600,
+        max_reports: int = 5,
+        max_fingerprints: int = 256,
+    ) -> None:
+        self.chat_id = chat_id
+        self.window = window
+        self.max_reports = max_reports
+        self.max_fingerprints = max_fingerprints
+        self._errors: t.OrderedDict[str, _Error] = collections.OrderedDict()
+
+    def record(
+        self,
+        error: BaseException,
+        update: object = None,
+        chat_data: t.Any = None,
+        user_data: t.Any = None,
+    ) -> t.Tuple[str, bool]:
+        """Count `error`, return its fingerprint and if it is new in the window."""
+        now = time.time()
+        key = fingerprint(error)
+        ERRORS.inc(type(error).__name__)
+        entry = self._errors.get(key)
+        if entry is None:
+            entry = self._errors[key] = _Error(type(error).__name__, now)
+            while len(self._errors) > self.max_fingerprints:
+                self._errors.popitem(last=False)
+        self._errors.move_to_end(key)
+        first = entry.sample is None and (
+            entry.reported is None or entry.reported < now - self.window
+        )
+        if first:
+            entry.sample = (
+                error,
+                update,
+                dict(chat_data) if chat_data else chat_data,
+                dict(user_data) if user_data else user_data,
+            )
+        if entry.count == 0:
+            entry.first_seen = now
+        entry.count += 1
+        entry.last_seen = now
+        return key, first
+
+    def _details(self, key: str, entry: _Error) -> str:
+        error, update, chat_data, user_data = t.cast(
+            t.Tuple[BaseException, object, t.Any, t.Any], entry.sample
+        )
+        update_str = _truncate(
+            json.dumps(update.to_dict(), indent=2, ensure_ascii=False)
+            if isinstance(update, Update)
+            else str(update),
+            _UPDATE_LIMIT,
+        )
+        since = time.strftime("%H:%M:%S", time.localtime(entry.first_seen))
+        header = (
+            f"<b>{html.escape(entry.name)}</b> ({key}) raised {entry.count} times"
+            f" while handling updates since {since}\n"
+        )
+        chat_str = _truncate(_repr.repr(chat_data), _DATA_LIMIT)
+        user_str = _truncate(_repr.repr(user_data), _DATA_LIMIT)
+        parts = [
+            _pre(f"update = {update_str}"),
+            _pre(f"context.chat_data = {chat_str}"),
+            _pre(f"context.user_data = {user_str}"),
+        ]
+        used = len(header) + len(update_str) + 2 * _DATA_LIMIT + 100
+        tb_string = "".join(
+            traceback.format_exception(None, error, error.__traceback__)
+        )
+        # The end of a traceback tells the most.
+        tb_string = _truncate(tb_string, MESSAGE_LIMIT - used, tail=True)
+        return header + "\n".join([*parts, _pre(tb_string)])
+
+    def reports(self) -> t.List[str]:
+        """Messages reporting the exceptions counted since the last ones."""
+        now = time.time()
+        pending = sorted(
+            ((k, e) for k, e in self._errors.items() if e.count),
+            key=lambda item: item[1].count,
+            reverse=True,
+        )
+        messages: t.List[str] = []
+        summary: t.List[str] = []
+        for key, entry in pending:
+            if entry.sample is not None and len(messages) < self.max_reports - 1:
+                messages.append(self._details(key, entry))
+                entry.reported = now
+            else:
+                summary.append(
+                    f"{entry.count} × <b>{html.escape(entry.name)}</b> ({key})"
+                )
+            entry.count = 0
+            entry.sample = None
+        if summary:
+            text = "Exceptions raised since the last report:\n" + "\n".join(summary)
+            if len(text) > MESSAGE_LIMIT:
+                text = text[: text.rfind("\n", 0, MESSAGE_LIMIT - 20)] + "\n…"
+            messages.append(text)
+
+        # Forget exceptions quiet for a whole window.
+        for key in [
+            k for k, e in self._errors.items() if e.last_seen < now - self.window
+        ]:
+            del self._errors[key]
+        return messages
+
+    async def run(self, context: CallbackContext):
+        messages = self.reports()
+        if self.chat_id is None:
+            return
+        for message in messages:
+            try:
+                await context.bot.send_message(
+                    chat_id=self.chat_id, text=message, parse_mode=ParseMode.HTML
+                )
+                ERROR_REPORTS.inc()
+            except Exception:
+                logger.exception("send exception report failed")
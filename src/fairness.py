@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import collections
+import contextvars
+import heapq
+import itertools
+import json
+import time
+
+from httpserver import Request, Response
+import metrics
+from outbound import TokenBucket
+
+FAIR_WAIT = metrics.registry.histogram(
+    "fair_queue_wait_seconds",
+    "Time requests waited for an upstream slot, by the weight of their flow.",
+    ["weight"],
+)
+QUOTA_REJECTED = metrics.registry.counter(
+    "quota_rejected_total", "Prompts refused because their user's quota ran out."
+)
+
+
+class Flow:
+    """Who upstream requests are made for, sharing capacity by `weight`.
+
+    `on_position` is called with the number of requests ahead of this
+    flow's while one of them waits for a slot.
+    """
+
+    __slots__ = ("key", "weight", "on_position", "position", "waited")
+
+    def __init__(
+        self,
+        key: str,
+        weight: float = 1.0,
+        on_position: t.Optional[t.Callable[[int], None]] = None,
+    ) -> None:
+        self.key = key
+        self.weight = weight
+        self.on_position = on_position
+        self.position: t.Optional[int] = None
+        # Seconds spent waiting for upstream slots.
+        self.waited = 0.0
+
+    def moved(self, position: int):
+        if position != self.position:
+            self.position = position
+            if self.on_position is not None:
+                self.on_position(position)
+
+
+# The flow the upstream requests of the current task are made for.
+current: contextvars.ContextVar[t.Optional[Flow]] = contextvars.ContextVar(
+    "flow", default=None
+)
+
+_DEFAULT = Flow("")
+
+
+class FairQueue:
+    """Waiters for a slot, served by start-time fair queueing.
+
+    Each request is tagged with a virtual start time, the later of the
+    queue's virtual time and the finish tag of its flow's previous request,
+    and finishes `1 / weight` later. The request with the earliest start is
+    served first, so backlogged flows share slots in proportion to their
+    weights and a flow that was idle isn't behind the busy ones.
+    """
+
+    def __init__(self) -> None:
+        self._heap: t.List[t.Tuple[float, int, asyncio.Future, Flow]] = []
+        self._finish: t.Dict[str, float] = {}
+        self._vtime = 0.0
+        self._seq = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __bool__(self) -> bool:
+        return bool(self._heap)
+
+    def __contains__(self, waiter: object) -> bool:
+        return any(entry[2] is waiter for entry in self._heap)
+
+    def push(self, waiter: asyncio.Future, flow: t.Optional[Flow] = None):
+        flow = flow or _DEFAULT
+        start = max(self._vtime, self._finish.get(flow.key, 0.0))
+        self._finish[flow.key] = start + 1 / max(flow.weight, 1e-3)
+        heapq.heappush(self._heap, (start, next(self._seq), waiter, flow))
+        self.notify()
+
+    def pop(self) -> t.Tuple[asyncio.Future, Flow]:
+        start, _, waiter, flow = heapq.heappop(self._heap)
+        self._vtime = start
+        if not self._heap:
+            # Idle, no flow is ahead any more.
+            self._finish.clear()
+        elif len(self._finish) > 4 * len(self._heap):
+            self._finish = {k: f for k, f in self._finish.items() if f > start}
+        return waiter, flow
+
+    def remove(self, waiter: asyncio.Future):
+        self._heap = [entry for entry in self._heap if entry[2] is not waiter]
+        heapq.heapify(self._heap)
+        self.notify()
+
+    def notify(self):
+        """Tell the waiting flows the position of their first request."""
+        seen: t.Set[int] = set()
+        for position, entry in enumerate(sorted(self._heap)):
+            flow = entry[3]
+            if id(flow) not in seen:
+                seen.add(id(flow))
+                flow.moved(position)
+
+
+class QuotaExceeded(RuntimeError):
+    """The user asked more than their quota allows."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"quota exceeded, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class Quotas:
+    """Allow each user `quota` prompts per `period` seconds.
+
+    Quotas are multiplied by the user's weight and refill continuously.
+    """
+
+    def __init__(self, quota: int, period: float, max_users: int = 100000) -> None:
+        self.quota = quota
+        self.period = period
+        self.max_users = max_users
+        self._buckets: t.OrderedDict[str, TokenBucket] = collections.OrderedDict()
+
+    def take(self, key: str, weight: float = 1.0):
+        """Use a prompt of `key`'s quota, raise `QuotaExceeded` if none is left."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            # At least one prompt, whatever the weight.
+            burst = max(self.quota * max(weight, 1e-3), 1)
+            bucket = self._buckets[key] = TokenBucket(burst / self.period, burst)
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(key)
+        delay = bucket.delay()
+        if delay > 0:
+            QUOTA_REJECTED.inc()
+            raise QuotaExceeded(delay)
+        bucket.take()
+
+    def remaining(self, key: str) -> t.Optional[float]:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return None
+        bucket.delay()
+        return bucket.tokens
+
+
+class Usage:
+    __slots__ = ("weight", "prompts", "rejected", "waited", "latency", "last")
+
+    def __init__(self, weight: float) -> None:
+        self.weight = weight
+        self.prompts = 0
+        self.rejected = 0
+        self.waited = 0.0
+        self.latency = 0.0
+        self.last = 0.0
+
+
+class Accounting:
+    """Per user usage, to tune weights and quotas by.
+
+    Keeps the `max_users` users that asked last.
+    """
+
+    def __init__(self, quotas: t.Optional[Quotas] = None, max_users: int = 10000):
+        self.quotas = quotas
+        self.max_users = max_users
+        self._usage: t.OrderedDict[str, Usage] = collections.OrderedDict()
+
+    def _get(self, flow: Flow) -> Usage:
+        usage = self._usage.get(flow.key)
+        if usage is None:
+            usage = self._usage[flow.key] = Usage(flow.weight)
+            while len(self._usage) > self.max_users:
+                self._usage.popitem(last=False)
+        self._usage.move_to_end(flow.key)
+        usage.weight = flow.weight
+        usage.last = time.time()
+        return usage
+
+    def rejected(self, flow: Flow):
+        self._get(flow).rejected += 1
+
+    def record(self, flow: Flow, latency: float):
+        usage = self._get(flow)
+        usage.prompts += 1
+        usage.waited += flow.waited
+        usage.latency += latency
+        FAIR_WAIT.observe(flow.waited, f"{flow.weight:g}")
+
+    def top(self, n: int = 100) -> t.List[t.Dict[str, t.Any]]:
+        """The `n` users with the most prompts."""
+        users = heapq.nlargest(n, self._usage.items(), key=lambda i: i[1].prompts)
+        return [
+            dict(
+                key=key,
+                weight=u.weight,
+                prompts=u.prompts,
+                rejected=u.rejected,
+                mean_wait=u.waited / u.prompts if u.prompts else None,
+                mean_latency=u.latency / u.prompts if u.prompts else None,
+                quota_remaining=(
+                    self.quotas.remaining(key) if self.quotas is not None else None
+                ),
+                last=u.last,
+            )
+            for key, u in users
+        ]
+
+    async def endpoint(self, request: Request) -> Response:
+        try:
+            n = int(request.query.get("n", "100"))
+        except ValueError:
+            return Response("bad n\n", status=400)
+        body = json.dumps(dict(users=self.top(n)), indent=2)
+        return Response(body, content_type="application/json")
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+
+import structlog
+
+import metrics
+
+logger = structlog.get_logger(__name__)
+
+T = t.TypeVar("T")
+
+STOPPED = metrics.registry.counter(
+    "generations_stopped_total", "Answers stopped while being generated.", ["reason"]
+)
+
+
+class Stopped(Exception):
+    """The answer was stopped before it was complete."""
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(f"generation stopped: {reason}")
+        self.reason = reason
+
+
+class Generation:
+    __slots__ = ("task", "user_id", "auto_stop", "reason")
+
+    def __init__(
+        self, task: asyncio.Future, user_id: t.Optional[int], auto_stop: bool
+    ) -> None:
+        self.task = task
+        self.user_id = user_id
+        self.auto_stop = auto_stop
+        self.reason: t.Optional[str] = None
+
+
+class Generations:
+    """Answers being generated, at most one per chat, so they can be stopped.
+
+    The answer runs in a task of its own. Stopping it cancels that task, which
+    closes the upstream stream on its way out, and makes `run` raise
+    `Stopped` in the handler waiting for it. Answers run with `auto_stop`
+    are also stopped by `supersede`, when a newer prompt arrives.
+    """
+
+    def __init__(self) -> None:
+        self._running: t.Dict[int, Generation] = {}
+
+    def __len__(self) -> int:
+        return len(self._running)
+
+    def running(self, chat_id: int) -> bool:
+        generation = self._running.get(chat_id)
+        return generation is not None and not generation.task.done()
+
+    async def run(
+        self,
+        chat_id: int,
+        user_id: t.Optional[int],
+        aw: t.Awaitable[T],
+        auto_stop: bool = False,
+    ) -> T:
+        task = asyncio.ensure_future(aw)
+        generation = self._running[chat_id] = Generation(task, user_id, auto_stop)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if generation.reason is None:
+                # The handler itself was cancelled.
+                raise
+            raise Stopped(generation.reason) from None
+        finally:
+            if self._running.get(chat_id) is generation:
+                del self._running[chat_id]
+            if not task.done():
+                task.cancel()
+
+    def stop(
+        self, chat_id: int, reason: str, user_id: t.Optional[int] = None
+    ) -> bool:
+        """Stop the answer generated in `chat_id`, for `user_id` if given."""
+        generation = self._running.get(chat_id)
+        if generation is None or generation.task.done():
+            return False
+        if user_id is not None and generation.user_id != user_id:
+            return False
+        if generation.reason is None:
+            generation.reason = reason
+            STOPPED.inc(reason)
+            logger.info("stop generation", chat_id=chat_id, reason=reason)
+        generation.task.cancel()
+        return True
+
+    def supersede(self, chat_id: int, user_id: t.Optional[int] = None) -> bool:
+        """Stop the answer in `chat_id` if it was run with `auto_stop`."""
+        generation = self._running.get(chat_id)
+        if generation is None or not generation.auto_stop:
+            return False
+        return self.stop(chat_id, "superseded", user_id=user_id)
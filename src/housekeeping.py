@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import time
+
+import structlog
+
+import metrics
+
+logger = structlog.get_logger(__name__)
+
+REQUESTS = metrics.registry.counter(
+    "housekeeping_requests_total",
+    "Background conversation housekeeping requests.",
+    ["engine", "op", "result"],
+)
+PENDING = metrics.registry.gauge(
+    "housekeeping_pending",
+    "Conversation housekeeping requests waiting to be sent.",
+    ["engine"],
+)
+
+
+class _Request:
+    __slots__ = ("op", "args", "attempts", "not_before")
+
+    def __init__(self, op: str, args: t.Tuple[t.Any, ...]) -> None:
+        self.op = op
+        self.args = args
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+class Housekeeper:
+    """Send an engine's conversation housekeeping in the background.
+
+    Requests like renaming or deleting a conversation are queued per account
+    and conversation, a later request replacing a pending one, so deleting a
+    conversation drops its pending rename. Every `interval` seconds one task
+    sends up to `max_batch` due requests per account, calling the method
+    named by the request's op on a client from `connect(account_id)`, closed
+    with `disconnect`. `connect` returns None while the account can't be
+    used and raises `KeyError` once it's gone. Failed requests are retried
+    with exponential backoff, at most `retries` times.
+
+    `collect`, if given, is run every `collect_interval` seconds to queue
+    the deletion of conversations left behind.
+    """
+
+    def __init__(
+        self,
+        engine: str,
+        connect: t.Callable[[str], t.Optional[t.Any]],
+        disconnect: t.Callable[[t.Any], t.Awaitable[None]],
+        interval: float = 5,
+        max_batch: int = 20,
+        retries: int = 5,
+        backoff: float = 30,
+        collect: t.Optional[t.Callable[[Housekeeper], t.Awaitable[None]]] = None,
+        collect_interval: float = 6 * 3600,
+    ) -> None:
+        self.engine = engine
+        self.connect = connect
+        self.disconnect = disconnect
+        self.interval = interval
+        self.max_batch = max_batch
+        self.retries = retries
+        self.backoff = backoff
+        self.collect = collect
+        self.collect_interval = collect_interval
+        self._pending: t.Dict[str, t.Dict[str, _Request]] = {}
+        self._next_collect = 0.0
+        self._task: t.Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return sum(len(requests) for requests in self._pending.values())
+
+    def submit(self, account_id: str, op: str, conversation_id: str, *args):
+        self._pending.setdefault(account_id, {})[conversation_id] = _Request(
+            op, (conversation_id, *args)
+        )
+        PENDING.set(len(self), self.engine)
+
+    def change_title(self, account_id: str, conversation_id: str, title: str):
+        self.submit(account_id, "change_title", conversation_id, title)
+
+    def delete(self, account_id: str, conversation_id: str):
+        self.submit(account_id, "delete_conversation", conversation_id)
+
+    def start(self):
+        if self._task is None:
+            self._next_collect = time.monotonic() + self.interval
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        """Stop, sending what is due once more."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self.flush()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.collect is not None and self.collect_interval > 0:
+                if time.monotonic() >= self._next_collect:
+                    self._next_collect = time.monotonic() + self.collect_interval
+                    try:
+                        await self.collect(self)
+                    except Exception:
+                        logger.exception("collect conversations failed")
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("housekeeping failed")
+
+    async def flush(self):
+        """Send the requests that are due."""
+        now = time.monotonic()
+        for account_id in list(self._pending):
+            due = [
+                (conversation_id, request)
+                for conversation_id, request in self._pending[account_id].items()
+                if request.not_before <= now
+            ][: self.max_batch]
+            if due:
+                await self._send(account_id, due)
+        PENDING.set(len(self), self.engine)
+
+    async def _send(self, account_id: str, due: t.List[t.Tuple[str, _Request]]):
+        pending = self._pending[account_id]
+        try:
+            client = self.connect(account_id)
+        except KeyError:
+            logger.warning(
+                "housekeeping account gone", engine=self.engine, account=account_id
+            )
+            for _, request in due:
+                REQUESTS.inc(self.engine, request.op, "dropped")
+            del self._pending[account_id]
+            return
+        if client is None:
+            # The account is cooling down, try again later.
+            return
+        try:
+            for conversation_id, request in due:
+                try:
+                    await getattr(client, request.op)(*request.args)
+                except Exception as exc:
+                    self._failed(account_id, conversation_id, request, exc)
+                else:
+                    REQUESTS.inc(self.engine, request.op, "ok")
+                    if pending.get(conversation_id) is request:
+                        del pending[conversation_id]
+        finally:
+            await self.disconnect(client)
+            if not pending:
+                self._pending.pop(account_id, None)
+
+    def _failed(
+        self,
+        account_id: str,
+        conversation_id: str,
+        request: _Request,
+        exc: Exception,
+    ):
+        request.attempts += 1
+        pending = self._pending[account_id]
+        if request.attempts > self.retries:
+            REQUESTS.inc(self.engine, request.op, "dropped")
+            logger.warning(
+                "housekeeping request dropped",
+                engine=self.engine,
+                op=request.op,
+                conversation_id=conversation_id,
+                error=repr(exc),
+            )
+            if pending.get(conversation_id) is request:
+                del pending[conversation_id]
+            return
+        REQUESTS.inc(self.engine, request.op, "retried")
+        request.not_before = time.monotonic() + self.backoff * 2 ** (
+            request.attempts - 1
+        )
@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+from urllib.parse import parse_qs, urlsplit
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+MAX_BODY_SIZE = 1 << 20
+MAX_HEADERS = 100
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class Request:
+    def __init__(
+        self,
+        method: str,
+        target: str,
+        headers: t.Dict[str, str],
+        body: bytes,
+    ) -> None:
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        self.headers = headers
+        self.body = body
+
+
+class Response:
+    """Response with a fixed `body`, or a chunked one read from `stream`."""
+
+    def __init__(
+        self,
+        body: t.Union[bytes, str] = b"",
+        status: int = 200,
+        content_type: str = "text/plain; charset=utf-8",
+        headers: t.Optional[t.Dict[str, str]] = None,
+        stream: t.Optional[t.AsyncIterator[bytes]] = None,
+    ) -> None:
+        self.body = body.encode() if isinstance(body, str) else body
+        self.status = status
+        self.headers = {"content-type": content_type, **(headers or {})}
+        self.stream = stream
+
+
+Handler = t.Callable[[Request], t.Awaitable[Response]]
+
+
+class HTTPServer:
+    """Small asyncio HTTP/1.1 server for internal endpoints and the webhook.
+
+    Routes match the exact path, or any path under it when registered with a
+    trailing `/`. Connections are kept alive unless the client asks otherwise,
+    and closed after `idle_timeout` seconds without a request. A request's
+    headers must arrive within `header_timeout` seconds and its body within
+    `body_timeout`. Beyond `max_connections` new connections are refused.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        header_timeout: float = 10,
+        body_timeout: float = 30,
+        idle_timeout: float = 60,
+        max_connections: int = 256,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self._routes: t.Dict[t.Tuple[str, str], Handler] = {}
+        self._server: t.Optional[asyncio.AbstractServer] = None
+        self._connections: t.Set[asyncio.StreamWriter] = set()
+
+    def route(self, method: str, path: str, handler: Handler):
+        self._routes[(method.upper(), path)] = handler
+
+    def _find(self, method: str, path: str) -> t.Tuple[t.Optional[Handler], bool]:
+        handler = self._routes.get((method, path))
+        if handler is not None:
+            return handler, True
+        path_exists = False
+        for (m, p), h in self._routes.items():
+            if p == path or (p.endswith("/") and path.startswith(p)):
+                path_exists = True
+                if m == method:
+                    return h, True
+        return None, path_exists
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        if self.port == 0:
+            self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"http server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in self._connections:
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if len(self._connections) >= self.max_connections:
+            logger.warning("http server connection limit reached", host=self.host)
+            writer.close()
+            return
+        self._connections.add(writer)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if isinstance(request, Response):
+                    await self._write_response(writer, request, keep_alive=False)
+                    break
+                handler, path_exists = self._find(request.method, request.path)
+                if handler is None:
+                    response = Response(status=405 if path_exists else 404)
+                else:
+                    try:
+                        response = await handler(request)
+                    except Exception:
+                        logger.exception(f"{request.method} {request.path} failed")
+                        response = Response(status=500)
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                await self._write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+            ConnectionError,
+            ValueError,
+        ):
+            pass
+        except asyncio.CancelledError:
+            # Server shutting down with a handler still running.
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_request(
+        self, reader: asyncio.StreamReader
+    ) -> t.Optional[t.Union[Request, Response]]:
+        # Raises asyncio.TimeoutError when the client is idle or too slow.
+        line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            return Response(status=400)
+        headers = await asyncio.wait_for(
+            self._read_headers(reader), self.header_timeout
+        )
+        if headers is None:
+            return Response(status=431)
+        length = int(headers.get("content-length", 0) or 0)
+        if length > MAX_BODY_SIZE:
+            return Response(status=413)
+        body = (
+            await asyncio.wait_for(reader.readexactly(length), self.body_timeout)
+            if length
+            else b""
+        )
+        return Request(method.upper(), target, headers, body)
+
+    @staticmethod
+    async def _read_headers(
+        reader: asyncio.StreamReader,
+    ) -> t.Optional[t.Dict[str, str]]:
+        headers = {}
+        for _ in range(MAX_HEADERS + 1):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return None
+
+    @staticmethod
+    async def _write_response(
+        writer: asyncio.StreamWriter, response: Response, keep_alive: bool
+    ):
+        reason = REASONS.get(response.status, "")
+        headers = {
+            **response.headers,
+            "connection": "keep-alive" if keep_alive else "close",
+        }
+        if response.stream is None:
+            headers["content-length"] = str(len(response.body))
+        else:
+            headers["transfer-encoding"] = "chunked"
+        head = f"HTTP/1.1 {response.status} {reason}\r\n" + "".join(
+            f"{k}: {v}\r\n" for k, v in headers.items()
+        )
+        if response.stream is None:
+            writer.write(head.encode("latin-1") + b"\r\n" + response.body)
+            await writer.drain()
+            return
+
+        writer.write(head.encode("latin-1") + b"\r\n")
+        async for chunk in response.stream:
+            if chunk:
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
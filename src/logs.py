@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import typing as t
+import logging
+import random
+
+import structlog
+
+
+class Lazy:
+    """Log field computed only when the event is actually emitted."""
+
+    __slots__ = ("fn",)
+
+    def __init__(self, fn: t.Callable[[], t.Any]) -> None:
+        self.fn = fn
+
+
+def sample(rates: t.Dict[str, float]):
+    """Drop events named in `rates` with probability `1 - rate`."""
+
+    def processor(logger, method_name, event_dict):
+        rate = rates.get(event_dict.get("event", ""))
+        if rate is not None and random.random() >= rate:
+            raise structlog.DropEvent
+        return event_dict
+
+    return processor
+
+
+def bound_fields(max_length: int):
+    """Render `Lazy` fields and truncate long field values.
+
+    The event name and formatted tracebacks are kept whole.
+    """
+
+    def processor(logger, method_name, event_dict):
+        for key, value in event_dict.items():
+            if isinstance(value, Lazy):
+                value = value.fn()
+            if key in ("event", "exception"):
+                continue
+            if not isinstance(value, (int, float, bool, type(None))):
+                value = str(value)
+                if len(value) > max_length:
+                    value = f"{value[:max_length]}...({len(value)} chars)"
+            event_dict[key] = value
+        return event_dict
+
+    return processor
+
+
+def setup(
+    level: str = "INFO",
+    max_field_length: int = 1024,
+    sample_rates: t.Optional[t.Dict[str, float]] = None,
+    json: bool = False,
+):
+    """Configure structlog and the stdlib logging used by libraries.
+
+    Events below `level` are discarded before any field is formatted.
+    """
+    min_level = logging.getLevelName(level.upper())
+    logging.basicConfig(format="%(message)s", level=min_level)
+    logging.getLogger("httpx").setLevel(max(min_level, logging.WARNING))
+
+    renderer = (
+        structlog.processors.JSONRenderer(ensure_ascii=False)
+        if json
+        else structlog.dev.ConsoleRenderer()
+    )
+    structlog.configure(
+        processors=[
+            sample(sample_rates or {}),
+            structlog.processors.add_log_level,
+            structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S", utc=False),
+            structlog.processors.StackInfoRenderer(),
+            structlog.processors.format_exc_info,
+            bound_fields(max_field_length),
+            renderer,
+        ],
+        wrapper_class=structlog.make_filtering_bound_logger(min_level),
+        cache_logger_on_first_use=True,
+    )
@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import typing as t
+import bisect
+import functools as ft
+import math
+import time
+
+from telegram.request import HTTPXRequest
+
+from httpserver import Request, Response
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+Labels = t.Tuple[str, ...]
+
+
+def _format_labels(names: t.Sequence[str], values: t.Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            n, str(v).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+        )
+        for n, v in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: t.Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def samples(self) -> t.Iterator[t.Tuple[str, Labels, Labels, float]]:
+        raise NotImplementedError
+
+    def render(self) -> t.List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            labels = _format_labels(names, values)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: t.Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: t.Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield "", self.label_names, labels, value
+
+
+class Gauge(Metric):
+    """Gauge set explicitly, or computed by `fn` on every scrape.
+
+    `fn` returns a number for unlabeled gauges, or a mapping from label
+    values to numbers.
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: t.Sequence[str] = (),
+        fn: t.Optional[t.Callable[[], t.Any]] = None,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self._values: t.Dict[Labels, float] = {}
+        self.fn = fn
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        values = self._values
+        if self.fn is not None:
+            result = self.fn()
+            values = result if isinstance(result, dict) else {(): result}
+        for labels, value in values.items():
+            yield "", self.label_names, labels, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: t.Sequence[str] = (),
+        buckets: t.Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # label values -> (bucket counts, sum, count)
+        self._values: t.Dict[Labels, t.List[t.Any]] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        names = self.label_names + ("le",)
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield "_bucket", names, labels + (_format_value(bound),), cumulative
+            yield "_bucket", names, labels + ("+Inf",), count
+            yield "_sum", self.label_names, labels, total
+            yield "_count", self.label_names, labels, count
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: t.Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: t.Sequence[str] = ()) -> Counter:
+        return t.cast(Counter, self.register(Counter(name, help, labels)))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        labels: t.Sequence[str] = (),
+        fn: t.Optional[t.Callable[[], t.Any]] = None,
+    ) -> Gauge:
+        return t.cast(Gauge, self.register(Gauge(name, help, labels, fn)))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: t.Sequence[str] = (),
+        buckets: t.Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return t.cast(Histogram, self.register(Histogram(name, help, labels, buckets)))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_LATENCY = registry.histogram(
+    "handler_latency_seconds", "Time spent in update handlers.", ["handler"]
+)
+HANDLER_ERRORS = registry.counter(
+    "handler_errors_total", "Update handlers that raised.", ["handler"]
+)
+UPSTREAM_LATENCY = registry.histogram(
+    "upstream_latency_seconds",
+    "Upstream ask latency by phase: connect, first_chunk and total.",
+    ["engine", "phase"],
+)
+UPSTREAM_ERRORS = registry.counter(
+    "upstream_errors_total", "Failed upstream asks.", ["engine", "error"]
+)
+UPSTREAM_IN_FLIGHT = registry.gauge(
+    "upstream_in_flight", "Upstream asks in progress.", ["engine"]
+)
+TELEGRAM_LATENCY = registry.histogram(
+    "telegram_request_latency_seconds",
+    "Latency of Telegram Bot API requests.",
+    ["method"],
+)
+
+
+def timed(fn):
+    """Record latency and errors of an update handler."""
+
+    @ft.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(fn.__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, fn.__name__)
+
+    return wrapper
+
+
+class UpstreamTimer:
+    """Time the phases of one upstream ask.
+
+    Use as a context manager around the ask, call `connected` once the
+    upstream connection is ready and `chunk` for every received chunk.
+    """
+
+    def __init__(self, engine: str) -> None:
+        self.engine = engine
+        self.start = 0.0
+        self.first_chunk: t.Optional[float] = None
+
+    def __enter__(self) -> UpstreamTimer:
+        self.start = time.perf_counter()
+        UPSTREAM_IN_FLIGHT.inc(self.engine)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        UPSTREAM_IN_FLIGHT.dec(self.engine)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            UPSTREAM_ERRORS.inc(self.engine, exc_type.__name__)
+        elif exc_type is None:
+            UPSTREAM_LATENCY.observe(
+                time.perf_counter() - self.start, self.engine, "total"
+            )
+
+    def connected(self):
+        UPSTREAM_LATENCY.observe(time.perf_counter() - self.start, self.engine, "connect")
+
+    def chunk(self):
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter() - self.start
+            UPSTREAM_LATENCY.observe(self.first_chunk, self.engine, "first_chunk")
+
+
+class TimedRequest(HTTPXRequest):
+    """`HTTPXRequest` that records the latency of every Bot API call."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            TELEGRAM_LATENCY.observe(
+                time.perf_counter() - start, url.rsplit("/", 1)[-1]
+            )
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    return Response(
+        registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,345 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import heapq
+import itertools
+import time
+
+import structlog
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = structlog.get_logger(__name__)
+
+# Lower values are sent first.
+PRIORITY_REPLY = 0
+PRIORITY_ACTION = 1
+PRIORITY_REPORT = 2
+PRIORITY_NAMES = {
+    PRIORITY_REPLY: "reply",
+    PRIORITY_ACTION: "action",
+    PRIORITY_REPORT: "report",
+}
+
+limiters: t.List[OutboundScheduler] = []
+
+OUTBOUND_WAIT = metrics.registry.histogram(
+    "outbound_wait_seconds",
+    "Time Bot API requests waited for the rate limits.",
+    ["priority"],
+)
+OUTBOUND_RETRY_AFTER = metrics.registry.counter(
+    "outbound_retry_after_total",
+    "Bot API requests answered with 429 Too Many Requests.",
+    ["endpoint"],
+)
+CHAT_ACTIONS_COALESCED = metrics.registry.counter(
+    "chat_actions_coalesced_total", "Chat actions not sent because one is showing."
+)
+metrics.registry.gauge(
+    "outbound_queued",
+    "Bot API requests waiting for the global rate limit.",
+    ["priority"],
+    fn=lambda: {
+        (PRIORITY_NAMES[p],): sum(
+            1
+            for priority, _, waiter in limiter._waiters
+            if priority == p and not waiter.done()
+        )
+        for limiter in limiters
+        for p in PRIORITY_NAMES
+    },
+)
+
+_background: t.Set[asyncio.Task] = set()
+
+
+def fire_and_forget(aw: t.Awaitable[t.Any], what: str):
+    """Run `aw` in the background, logging its failure."""
+
+    async def run():
+        try:
+            await aw
+        except Exception:
+            logger.exception(f"{what} failed")
+
+    task = asyncio.get_running_loop().create_task(run())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available."""
+        now = time.monotonic()
+        self._refill(now)
+        delay = self.blocked_until - now
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return max(delay, 0.0)
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.blocked_until
+
+
+class _Chat:
+    __slots__ = ("bucket", "lock")
+
+    def __init__(self, bucket: TokenBucket) -> None:
+        self.bucket = bucket
+        self.lock = asyncio.Lock()
+
+
+class OutboundScheduler(BaseRateLimiter[int]):
+    """Keep Bot API requests within Telegram's global and per-chat limits.
+
+    Requests to a chat take a token of the chat's bucket, `private_rate` per
+    second in private chats and `group_rate` in groups and channels, in the
+    order they were made. They then queue for a token of the global bucket,
+    `global_rate` per second, where replies go before chat actions and those
+    before error reports sent to `report_chat_id`. A 429 answer blocks the
+    chat for the time Telegram asks and the request is sent again, up to
+    `max_retries` times. Requests without a chat are not limited.
+
+    A chat action is not sent again while the same one is still showing,
+    that is for `action_ttl` seconds or until a message is sent to the chat.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        private_rate: float = 1,
+        private_burst: float = 3,
+        group_rate: float = 20 / 60,
+        group_burst: float = 3,
+        report_chat_id: t.Optional[int] = None,
+        max_retries: int = 3,
+        action_ttl: float = 4,
+        max_chats: int = 10000,
+    ) -> None:
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.report_chat_id = report_chat_id
+        self.max_retries = max_retries
+        self.action_ttl = action_ttl
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, max(global_rate, 1))
+        self._chats: t.Dict[t.Union[int, str], _Chat] = {}
+        self._waiters: t.List[t.Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: t.Optional[asyncio.Event] = None
+        self._dispatcher: t.Optional[asyncio.Task] = None
+        self._actions: t.Dict[t.Tuple[t.Union[int, str], str], asyncio.Future] = {}
+        self._action_shown: t.Dict[t.Union[int, str], t.Tuple[str, float]] = {}
+        limiters.append(self)
+
+    async def initialize(self) -> None:
+        # Called by the application and by the updater.
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        # Let whatever is left go out unthrottled rather than hang.
+        for _, _, waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def _dispatch(self):
+        assert self._wakeup is not None
+        while True:
+            while not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            delay = self._global.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():
+                # The request was cancelled while queued.
+                continue
+            self._global.take()
+            waiter.set_result(None)
+
+    async def _acquire_global(self, priority: int):
+        if self._dispatcher is None:
+            return
+        assert self._wakeup is not None
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        self._wakeup.set()
+        await waiter
+
+    def _chat(self, chat_id: t.Union[int, str]) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= self.max_chats:
+                self._sweep()
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            else:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            chat = self._chats[chat_id] = _Chat(bucket)
+        return chat
+
+    def _sweep(self):
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.lock.locked() and chat.bucket.idle:
+                del self._chats[chat_id]
+        now = time.monotonic()
+        for chat_id, (_, shown_at) in list(self._action_shown.items()):
+            if now - shown_at >= self.action_ttl:
+                del self._action_shown[chat_id]
+
+    async def _acquire_chat(self, chat_id: t.Union[int, str]):
+        chat = self._chat(chat_id)
+        async with chat.lock:
+            while True:
+                delay = chat.bucket.delay()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            chat.bucket.take()
+
+    async def _send(
+        self,
+        callback: t.Callable[..., t.Coroutine[t.Any, t.Any, t.Any]],
+        args: t.Any,
+        kwargs: t.Dict[str, t.Any],
+        endpoint: str,
+        chat_id: t.Union[int, str],
+        priority: int,
+    ) -> t.Any:
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            if priority != PRIORITY_ACTION:
+                await self._acquire_chat(chat_id)
+            await self._acquire_global(priority)
+            OUTBOUND_WAIT.observe(time.monotonic() - start, PRIORITY_NAMES[priority])
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                retry_after = float(t.cast(float, exc.retry_after))
+                OUTBOUND_RETRY_AFTER.inc(endpoint)
+                self._chat(chat_id).bucket.block(retry_after)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logger.warning(
+                    "rate limited by telegram",
+                    endpoint=endpoint,
+                    chat_id=chat_id,
+                    retry_after=retry_after,
+                    attempt=attempt,
+                )
+                continue
+            if priority != PRIORITY_ACTION:
+                # Any message ends the chat action shown in the chat.
+                self._action_shown.pop(chat_id, None)
+            return result
+
+    async def _send_action(
+        self,
+        callback: t.Callable[..., t.Coroutine[t.Any, t.Any, t.Any]],
+        args: t.Any,
+        kwargs: t.Dict[str, t.Any],
+        chat_id: t.Union[int, str],
+        action: str,
+    ) -> t.Any:
+        key = (chat_id, action)
+        pending = self._actions.get(key)
+        shown = self._action_shown.get(chat_id)
+        if pending is not None:
+            CHAT_ACTIONS_COALESCED.inc()
+            return await asyncio.shield(pending)
+        if (
+            shown is not None
+            and shown[0] == action
+            and time.monotonic() - shown[1] < self.action_ttl
+        ):
+            CHAT_ACTIONS_COALESCED.inc()
+            return True
+
+        if len(self._action_shown) >= self.max_chats:
+            self._sweep()
+        pending = self._actions[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._send(
+                callback, args, kwargs, "sendChatAction", chat_id, PRIORITY_ACTION
+            )
+            self._action_shown[chat_id] = (action, time.monotonic())
+            pending.set_result(result)
+            return result
+        except BaseException as exc:
+            if isinstance(exc, Exception):
+                pending.set_exception(exc)
+                # Waiters, if any, retrieve it.
+                pending.exception()
+            else:
+                pending.cancel()
+            raise
+        finally:
+            del self._actions[key]
+
+    async def process_request(
+        self,
+        callback: t.Callable[..., t.Coroutine[t.Any, t.Any, t.Any]],
+        args: t.Any,
+        kwargs: t.Dict[str, t.Any],
+        endpoint: str,
+        data: t.Dict[str, t.Any],
+        rate_limit_args: t.Optional[int],
+    ) -> t.Any:
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        if endpoint == "sendChatAction":
+            return await self._send_action(
+                callback, args, kwargs, chat_id, str(data.get("action"))
+            )
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif chat_id == self.report_chat_id:
+            priority = PRIORITY_REPORT
+        else:
+            priority = PRIORITY_REPLY
+        return await self._send(callback, args, kwargs, endpoint, chat_id, priority)
@@ -0,0 +1,468 @@
+from __future__ import annotations
+
+import typing as t
+import argparse
+import asyncio
+import hashlib
+import importlib
+import os
+import pickle
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import structlog
+from telegram.ext import BasePersistence, PersistenceInput
+
+from record import SessionRecord
+
+logger = structlog.get_logger(__name__)
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+# Persistent ids PicklePersistence uses in place of the Bot instance.
+_REPLACED_KNOWN_BOT = "a known bot replaced by PTB's PicklePersistence"
+_REPLACED_UNKNOWN_BOT = "an unknown bot replaced by PTB's PicklePersistence"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_data (
+    chat_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key BLOB NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+
+class _MigrationUnpickler(pickle.Unpickler):
+    def __init__(self, file, main_module: t.Optional[str] = None) -> None:
+        super().__init__(file)
+        self._main_module = main_module
+
+    def persistent_load(self, pid):
+        if pid in (_REPLACED_KNOWN_BOT, _REPLACED_UNKNOWN_BOT):
+            return None
+        raise pickle.UnpicklingError("Found unknown persistent id when unpickling!")
+
+    def find_class(self, module, name):
+        # Handler enums are pickled as `__main__.X` when app.py runs as a script.
+        if module == "__main__" and self._main_module is not None:
+            module = self._main_module
+            importlib.import_module(module)
+        return super().find_class(module, name)
+
+
+def _dumps(data: t.Any) -> bytes:
+    return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _digest(blob: bytes) -> bytes:
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+_SCALARS = (str, int, float, bool, type(None))
+
+
+def _signature(data: t.Any) -> t.Optional[t.Tuple[t.Any, ...]]:
+    """Stand-in for the pickle of chat or user data, if cheap to compute.
+
+    Only for data made of scalars and session records, whose version tells
+    whether they changed.
+    """
+    if not isinstance(data, dict):
+        return None
+    items = []
+    for key, value in data.items():
+        if isinstance(value, SessionRecord):
+            items.append((key, value.signature))
+        elif isinstance(value, _SCALARS):
+            items.append((key, value))
+        else:
+            return None
+    return tuple(items)
+
+
+def is_sqlite_file(path: str) -> bool:
+    if os.path.getsize(path) == 0:
+        return True
+    with open(path, "rb") as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def import_pickle(
+    conn: sqlite3.Connection, pickle_path: str, main_module: t.Optional[str] = None
+) -> t.Dict[str, int]:
+    """Import a single file `PicklePersistence` into an open database."""
+    with open(pickle_path, "rb") as f:
+        data = _MigrationUnpickler(f, main_module=main_module).load()
+
+    chat_data = data.get("chat_data") or {}
+    user_data = data.get("user_data") or {}
+    conversations = data.get("conversations") or {}
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO chat_data (chat_id, data, updated_at)"
+            " VALUES (?, ?, ?)",
+            ((chat_id, _dumps(d), now) for chat_id, d in chat_data.items()),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO user_data (user_id, data, updated_at)"
+            " VALUES (?, ?, ?)",
+            ((user_id, _dumps(d), now) for user_id, d in user_data.items()),
+        )
+        for key in ("bot_data", "callback_data"):
+            if data.get(key) is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, data) VALUES (?, ?)",
+                    (key, _dumps(data[key])),
+                )
+        for name, states in conversations.items():
+            conn.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state)"
+                " VALUES (?, ?, ?)",
+                ((name, _dumps(k), _dumps(v)) for k, v in states.items()),
+            )
+    return dict(
+        chat_data=len(chat_data),
+        user_data=len(user_data),
+        conversations=sum(len(v) for v in conversations.values()),
+    )
+
+
+def connect(filepath: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(filepath, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class SqlitePersistence(BasePersistence):
+    """Persistence backed by a SQLite database in WAL mode.
+
+    Unlike `PicklePersistence` only the chats and users that actually changed
+    are written, chat and user data are loaded per chat on first access, and
+    all disk I/O runs on a dedicated thread instead of the event loop. Data is
+    pickled on the event loop though, as handlers may change it meanwhile. Data
+    made of scalars and session records isn't even pickled when unchanged.
+
+    If `filepath` holds a single file `PicklePersistence`, it's moved aside to
+    `<filepath>.pickle` and imported on first use.
+
+    Several processes can share one database as long as each owns a distinct
+    set of chats. Callback data is per process and stored under `namespace`.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        store_data: t.Optional[PersistenceInput] = None,
+        update_interval: float = 60,
+        namespace: t.Optional[str] = None,
+    ) -> None:
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath = filepath
+        self._callback_data_key = (
+            "callback_data" if namespace is None else f"{namespace}:callback_data"
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="persistence"
+        )
+        self._conn: t.Optional[sqlite3.Connection] = None
+        self._loaded_chats: t.Set[int] = set()
+        self._loaded_users: t.Set[int] = set()
+        self._digests: t.Dict[t.Tuple[str, t.Any], bytes] = {}
+        self._signatures: t.Dict[t.Tuple[str, t.Any], t.Tuple[t.Any, ...]] = {}
+
+    async def _run(self, fn: t.Callable, *args) -> t.Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            pickle_path = None
+            if os.path.exists(self.filepath) and not is_sqlite_file(self.filepath):
+                pickle_path = f"{self.filepath}.pickle"
+                logger.info(f"migrating pickle persistence to {pickle_path}")
+                os.replace(self.filepath, pickle_path)
+            self._conn = connect(self.filepath)
+            if pickle_path is not None:
+                counts = import_pickle(self._conn, pickle_path)
+                logger.info(f"imported pickle persistence: {counts}")
+        return self._conn
+
+    def _load_row(self, table: str, column: str, key: t.Any) -> t.Optional[t.Any]:
+        row = (
+            self._db()
+            .execute(f"SELECT data FROM {table} WHERE {column} = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        self._digests[(table, key)] = _digest(row[0])
+        return pickle.loads(row[0])
+
+    def _write_row(self, table: str, column: str, key: t.Any, blob: bytes):
+        digest = _digest(blob)
+        if self._digests.get((table, key)) == digest:
+            return
+        conn = self._db()
+        with conn:
+            if table == "kv":
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, data) VALUES (?, ?)", (key, blob)
+                )
+            else:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {table} ({column}, data, updated_at)"
+                    " VALUES (?, ?, ?)",
+                    (key, blob, time.time()),
+                )
+        self._digests[(table, key)] = digest
+
+    def _delete_row(self, table: str, column: str, key: t.Any):
+        conn = self._db()
+        with conn:
+            conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (key,))
+        self._digests.pop((table, key), None)
+
+    def _load_conversations(self, name: str) -> t.Dict[t.Any, t.Any]:
+        rows = self._db().execute(
+            "SELECT key, state FROM conversations WHERE name = ?", (name,)
+        )
+        return {pickle.loads(key): pickle.loads(state) for key, state in rows}
+
+    def _write_conversation(
+        self, name: str, key: bytes, new_state: t.Optional[bytes]
+    ):
+        conn = self._db()
+        with conn:
+            if new_state is None:
+                conn.execute(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?",
+                    (name, key),
+                )
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversations (name, key, state)"
+                    " VALUES (?, ?, ?)",
+                    (name, key, new_state),
+                )
+
+    def size(self) -> int:
+        """Bytes on disk, write-ahead log included."""
+        return sum(
+            os.path.getsize(path)
+            for path in (self.filepath, f"{self.filepath}-wal")
+            if os.path.exists(path)
+        )
+
+    def _compact_chat_data(
+        self,
+        before: float,
+        compact: t.Callable[[t.Any, float], t.Optional[t.Any]],
+        vacuum_ratio: float,
+    ) -> t.Dict[str, t.Any]:
+        conn = self._db()
+        size_before = self.size()
+        rows = conn.execute(
+            "SELECT chat_id, data, updated_at FROM chat_data WHERE updated_at < ?",
+            (before,),
+        ).fetchall()
+        compacted = reclaimed = 0
+        for chat_id, blob, updated_at in rows:
+            if chat_id in self._loaded_chats:
+                # The application owns the loaded copy.
+                continue
+            data = compact(pickle.loads(blob), updated_at)
+            if data is None:
+                continue
+            new_blob = _dumps(data)
+            with conn:
+                # Keep updated_at, compacting is no activity.
+                conn.execute(
+                    "UPDATE chat_data SET data = ? WHERE chat_id = ?",
+                    (new_blob, chat_id),
+                )
+            compacted += 1
+            reclaimed += len(blob) - len(new_blob)
+        free, total = (
+            conn.execute("PRAGMA freelist_count").fetchone()[0],
+            conn.execute("PRAGMA page_count").fetchone()[0],
+        )
+        vacuumed = total > 0 and free / total > vacuum_ratio
+        if vacuumed:
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return dict(
+            compacted=compacted,
+            reclaimed=reclaimed,
+            size_before=size_before,
+            size_after=self.size(),
+            vacuumed=vacuumed,
+        )
+
+    async def compact_chat_data(
+        self,
+        before: float,
+        compact: t.Callable[[t.Any, float], t.Optional[t.Any]],
+        vacuum_ratio: float = 0.25,
+    ) -> t.Dict[str, t.Any]:
+        """Rewrite chat data not loaded and unchanged since `before`.
+
+        `compact` is called with the data and the time it was last written,
+        on the persistence thread, and returns the new data or None to keep
+        it. The database is vacuumed once more than `vacuum_ratio` of it is
+        free.
+        """
+        return await self._run(self._compact_chat_data, before, compact, vacuum_ratio)
+
+    def _scan_chat_data(self, visit: t.Callable[[t.Any], None]):
+        rows = self._db().execute("SELECT chat_id, data FROM chat_data")
+        for chat_id, blob in rows:
+            if chat_id not in self._loaded_chats:
+                visit(pickle.loads(blob))
+
+    async def scan_chat_data(self, visit: t.Callable[[t.Any], None]):
+        """Call `visit` with the stored data of every chat not loaded.
+
+        `visit` runs on the persistence thread.
+        """
+        await self._run(self._scan_chat_data, visit)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.close()
+            self._conn = None
+
+    async def get_user_data(self) -> t.Dict[int, t.Any]:
+        # Loaded lazily in refresh_user_data.
+        return {}
+
+    async def get_chat_data(self) -> t.Dict[int, t.Any]:
+        # Loaded lazily in refresh_chat_data.
+        return {}
+
+    async def get_bot_data(self) -> t.Dict[t.Any, t.Any]:
+        data = await self._run(self._load_row, "kv", "key", "bot_data")
+        return data if data is not None else {}
+
+    async def get_callback_data(self) -> t.Optional[t.Any]:
+        return await self._run(self._load_row, "kv", "key", self._callback_data_key)
+
+    async def get_conversations(self, name: str) -> t.Dict[t.Any, t.Any]:
+        return await self._run(self._load_conversations, name)
+
+    async def update_conversation(self, name: str, key: t.Any, new_state: t.Any):
+        await self._run(
+            self._write_conversation,
+            name,
+            _dumps(key),
+            None if new_state is None else _dumps(new_state),
+        )
+
+    async def _update_data(self, table: str, column: str, key: int, data: t.Any):
+        signature = _signature(data)
+        if signature is not None and self._signatures.get((table, key)) == signature:
+            return
+        await self._run(self._write_row, table, column, key, _dumps(data))
+        if signature is not None:
+            self._signatures[(table, key)] = signature
+        else:
+            self._signatures.pop((table, key), None)
+
+    async def update_user_data(self, user_id: int, data: t.Any):
+        self._loaded_users.add(user_id)
+        await self._update_data("user_data", "user_id", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: t.Any):
+        self._loaded_chats.add(chat_id)
+        await self._update_data("chat_data", "chat_id", chat_id, data)
+
+    async def update_bot_data(self, data: t.Any):
+        await self._run(self._write_row, "kv", "key", "bot_data", _dumps(data))
+
+    async def update_callback_data(self, data: t.Any):
+        await self._run(
+            self._write_row, "kv", "key", self._callback_data_key, _dumps(data)
+        )
+
+    async def drop_chat_data(self, chat_id: int):
+        self._loaded_chats.discard(chat_id)
+        self._signatures.pop(("chat_data", chat_id), None)
+        await self._run(self._delete_row, "chat_data", "chat_id", chat_id)
+
+    async def drop_user_data(self, user_id: int):
+        self._loaded_users.discard(user_id)
+        self._signatures.pop(("user_data", user_id), None)
+        await self._run(self._delete_row, "user_data", "user_id", user_id)
+
+    def _remember(self, table: str, key: int, data: t.Any):
+        signature = _signature(data)
+        if signature is not None:
+            self._signatures[(table, key)] = signature
+
+    async def refresh_user_data(self, user_id: int, user_data: t.Any):
+        if user_id in self._loaded_users:
+            return
+        data = await self._run(self._load_row, "user_data", "user_id", user_id)
+        self._loaded_users.add(user_id)
+        if data:
+            user_data.update(data)
+            self._remember("user_data", user_id, data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: t.Any):
+        if chat_id in self._loaded_chats:
+            return
+        data = await self._run(self._load_row, "chat_data", "chat_id", chat_id)
+        self._loaded_chats.add(chat_id)
+        if data:
+            chat_data.update(data)
+            self._remember("chat_data", chat_id, data)
+
+    async def refresh_bot_data(self, bot_data: t.Any):
+        pass
+
+    async def flush(self):
+        await self._run(self._close)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import a PicklePersistence file into a SQLite database."
+    )
+    parser.add_argument("pickle_path")
+    parser.add_argument("db_path")
+    parser.add_argument(
+        "--main-module",
+        default="app",
+        help="module that defined the `__main__` classes in the pickle file",
+    )
+    args = parser.parse_args()
+
+    conn = connect(args.db_path)
+    try:
+        counts = import_pickle(conn, args.pickle_path, main_module=args.main_module)
+    finally:
+        conn.close()
+    print(f"imported {counts} into {args.db_path}")
+
+
+if __name__ == "__main__":
+    main()
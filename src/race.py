@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import time
+
+import pydantic as pyd
+import structlog
+
+import bot
+import engines
+import metrics
+import resilience
+from record import SessionRecord
+
+logger = structlog.get_logger(__name__)
+
+# The engines raced, loaded by the registry along with this one.
+ENGINES = ("bing", "chatgpt")
+REQUIRES = ENGINES
+
+RACES = metrics.registry.counter("race_total", "Race mode asks.")
+RACE_WINS = metrics.registry.counter(
+    "race_wins_total", "Race mode asks won per engine.", ["engine"]
+)
+RACE_LATENCY = metrics.registry.histogram(
+    "race_win_latency_seconds",
+    "Time until the winning engine's first chunk or complete answer.",
+    ["engine"],
+)
+
+
+class Config(pyd.BaseSettings):
+    # "first_chunk" streams the engine answering first, "complete" waits for
+    # the first whole answer.
+    win_on: t.Literal["first_chunk", "complete"] = "first_chunk"
+
+    class Config:
+        env_file = ".env"
+        env_prefix = "race_"
+
+
+config = Config()
+
+
+class Bot(bot.Bot):
+    """Ask Bing and ChatGPT at once and answer with the faster one.
+
+    Both sub-sessions are kept and persisted. The losing ask is cancelled,
+    which leaves its conversation as it was before the turn for ChatGPT and
+    one unanswered turn further for Bing.
+    """
+
+    engine = "race"
+    composite = True
+
+    def __init__(
+        self,
+        bot_id: str,
+        count=0,
+        bots: t.Optional[t.Dict[str, bot.Bot]] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(bot_id=bot_id, count=count, **kwargs)
+        self.bots = bots or {
+            engine: engines.registry[engine](f"{bot_id}:{engine}")
+            for engine in ENGINES
+        }
+        self.winner: t.Optional[str] = None
+        # Signatures of the sessions' records when last saved.
+        self._versions: t.Optional[t.Dict[str, t.Tuple[str, int]]] = None
+
+    @property
+    def style(self) -> str:
+        return t.cast(t.Any, self.bots["bing"]).style
+
+    @style.setter
+    def style(self, value: str):
+        t.cast(t.Any, self.bots["bing"]).style = value
+
+    @property
+    def fresh(self) -> bool:
+        return all(b.fresh for b in self.bots.values())
+
+    async def _pump(
+        self,
+        engine: str,
+        prompt: str,
+        queue: asyncio.Queue[t.Tuple[str, t.Any, t.Optional[BaseException]]],
+    ):
+        session = self.bots[engine]
+        try:
+            policy = resilience.policy(engine)
+            async for item in policy.ask_stream(session, prompt):
+                await queue.put((engine, item, None))
+        except Exception as exc:
+            await queue.put((engine, None, exc))
+        else:
+            await queue.put((engine, None, None))
+
+    async def ask_stream(self, prompt: str) -> t.AsyncIterator[t.Tuple[bool, str]]:
+        self.count += 1
+        RACES.inc()
+        start = time.perf_counter()
+        queue: asyncio.Queue = asyncio.Queue()
+        tasks = {
+            engine: asyncio.create_task(self._pump(engine, prompt, queue))
+            for engine in self.bots
+        }
+        winner: t.Optional[str] = None
+        finished: t.Set[str] = set()
+        errors: t.List[BaseException] = []
+        try:
+            while True:
+                engine, item, error = await queue.get()
+                if winner is not None and engine != winner:
+                    continue
+                if item is None:
+                    if winner is not None:
+                        # The winner is done.
+                        if error is not None:
+                            raise error
+                        return
+                    finished.add(engine)
+                    if error is not None:
+                        errors.append(error)
+                        logger.warning(
+                            "race engine failed", engine=engine, error=repr(error)
+                        )
+                    if len(finished) == len(tasks):
+                        if errors:
+                            raise errors[0]
+                        yield True, "No response"
+                        return
+                    continue
+                final, text = item
+                if winner is None and (final or config.win_on == "first_chunk"):
+                    winner = engine
+                    self.winner = engine
+                    RACE_WINS.inc(engine)
+                    RACE_LATENCY.observe(time.perf_counter() - start, engine)
+                    await self._cancel(tasks, keep=engine)
+                if engine == winner:
+                    if final:
+                        self.suggested_questions = self.bots[engine].suggested_questions
+                    yield final, text
+        finally:
+            await self._cancel(tasks)
+
+    @staticmethod
+    async def _cancel(tasks: t.Dict[str, asyncio.Task], keep: t.Optional[str] = None):
+        losers = [task for engine, task in tasks.items() if engine != keep]
+        for task in losers:
+            task.cancel()
+        await asyncio.gather(*losers, return_exceptions=True)
+
+    async def reset(self):
+        await asyncio.gather(*(b.reset() for b in self.bots.values()))
+
+    async def close(self):
+        if self.closed:
+            return
+        await asyncio.gather(
+            *(b.close() for b in self.bots.values()), return_exceptions=True
+        )
+        self.closed = True
+
+    def info(self):
+        info = dict(
+            bot_id=self.bot_id, engine=self.engine, count=self.count, winner=self.winner
+        )
+        for engine, session in self.bots.items():
+            for k, v in session.info().items():
+                if k not in ("bot_id", "engine"):
+                    info[f"{engine}.{k}"] = v
+        return info
+
+    def serialize(self) -> SessionRecord:
+        bots = {engine: b.serialize() for engine, b in self.bots.items()}
+        record = self._save(count=self.count, bots=bots)
+        versions = {engine: r.signature for engine, r in bots.items()}
+        if versions != self._versions:
+            self._versions = versions
+            record.touch()
+        return record
+
+    @classmethod
+    def deserialize(cls, record: SessionRecord) -> Bot:
+        bots = {
+            engine: engines.registry[engine].deserialize(r)
+            for engine, r in record.bots.items()
+        }
+        bot = cls(bot_id=record.bot_id, count=record.count, bots=bots)
+        bot._record = record
+        bot._versions = {engine: r.signature for engine, r in record.bots.items()}
+        return bot
+
+    @classmethod
+    def compact(cls, record: SessionRecord) -> SessionRecord:
+        bots = {
+            engine: engines.registry[engine].compact(r)
+            for engine, r in record.bots.items()
+        }
+        if all(bots[engine] is r for engine, r in record.bots.items()):
+            return record
+        return record.replace(bots=bots)
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import typing as t
+import gc
+import os
+import pickle
+import resource
+import time
+
+import structlog
+from telegram.ext import CallbackContext
+
+import bot
+import metrics
+from engines import EngineUnavailable
+from persistence import SqlitePersistence
+from record import SessionRecord
+from sessions import SessionCache
+
+logger = structlog.get_logger(__name__)
+
+REAPED_SESSIONS = metrics.registry.counter(
+    "reaper_sessions_closed_total", "Idle sessions closed by the reaper."
+)
+REAPED_CHATS = metrics.registry.counter(
+    "reaper_chats_compacted_total", "Idle chats whose conversation was dropped."
+)
+REAPED_BYTES = metrics.registry.counter(
+    "reaper_bytes_reclaimed_total", "Pickled chat data bytes reclaimed."
+)
+REAPED_CALLBACK_DATA = metrics.registry.counter(
+    "reaper_callback_data_pruned_total", "Stale inline keyboards forgotten."
+)
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Reaper:
+    """Reclaim what chats that went quiet hold on to, as a `JobQueue` job.
+
+    Each run closes the sessions idle for longer than the session cache's
+    idle ttl, drops the conversation of chats without a turn for
+    `retention` seconds, keeping their engine and settings, and forgets
+    inline keyboards older than `callback_data_ttl`.
+
+    Chats are idle since `chat_data["last_active"]`, or since their data was
+    last written for chats persisted before that was recorded. Chats only
+    stored in SQLite are compacted too with `compact_stored`, which exactly
+    one of the processes sharing a database should set. Chats of engines that
+    can't be loaded are left alone.
+    """
+
+    def __init__(
+        self,
+        sessions: SessionCache,
+        bot_types: t.Mapping[str, t.Type[bot.Bot]],
+        retention: float = 30 * 24 * 3600,
+        callback_data_ttl: float = 24 * 3600,
+        compact_stored: bool = True,
+    ) -> None:
+        self.sessions = sessions
+        self.bot_types = bot_types
+        self.retention = retention
+        self.callback_data_ttl = callback_data_ttl
+        self.compact_stored = compact_stored
+
+    def compact(self, chat_data: t.Any, last_active: float) -> t.Optional[t.Any]:
+        """Compacted copy of `chat_data` if idle past retention, else None."""
+        if chat_data.get("last_active", last_active) >= time.time() - self.retention:
+            return None
+        record = SessionRecord.load(chat_data.get("bot_data"))
+        if record is None:
+            return None
+        try:
+            compacted = self.bot_types[record.engine].compact(record)
+        except EngineUnavailable:
+            # Kept as it is, for the engine to get back.
+            return None
+        if compacted is record:
+            return None
+        return dict(chat_data, bot_data=compacted)
+
+    async def run(self, context: CallbackContext):
+        app = context.application
+        start = time.monotonic()
+        rss_before = rss_bytes()
+        closed = self.sessions.sweep()
+
+        now = time.time()
+        compacted = reclaimed = 0
+        changed = []
+        for chat_id, chat_data in app.chat_data.items():
+            if chat_data.get("bot_data") is None:
+                continue
+            if "last_active" not in chat_data:
+                # Start the clock for chats saved before it was recorded.
+                chat_data["last_active"] = now
+                changed.append(chat_id)
+                continue
+            new = self.compact(chat_data, now)
+            if new is None:
+                continue
+            self.sessions.discard(new["bot_data"].bot_id)
+            reclaimed += len(pickle.dumps(chat_data)) - len(pickle.dumps(new))
+            chat_data.update(new)
+            compacted += 1
+            changed.append(chat_id)
+        if changed:
+            app.mark_data_for_update_persistence(chat_ids=changed)
+
+        stored: t.Dict[str, t.Any] = {}
+        if self.compact_stored and isinstance(app.persistence, SqlitePersistence):
+            stored = await app.persistence.compact_chat_data(
+                now - self.retention, self.compact
+            )
+            compacted += stored["compacted"]
+            reclaimed += stored["reclaimed"]
+
+        pruned = 0
+        cache = getattr(app.bot, "callback_data_cache", None)
+        if cache is not None:
+            keyboards = len(cache.persistence_data[0])
+            cache.clear_callback_data(time_cutoff=now - self.callback_data_ttl)
+            pruned = keyboards - len(cache.persistence_data[0])
+
+        gc.collect()
+        rss_after = rss_bytes()
+        REAPED_SESSIONS.inc(amount=closed)
+        REAPED_CHATS.inc(amount=compacted)
+        REAPED_BYTES.inc(amount=reclaimed)
+        REAPED_CALLBACK_DATA.inc(amount=pruned)
+        logger.info(
+            "reaped idle state",
+            sessions_closed=closed,
+            chats_compacted=compacted,
+            bytes_reclaimed=reclaimed,
+            callback_data_pruned=pruned,
+            rss_before=rss_before,
+            rss_after=rss_after,
+            persistence_size_before=stored.get("size_before"),
+            persistence_size_after=stored.get("size_after"),
+            vacuumed=stored.get("vacuumed", False),
+            elapsed=time.monotonic() - start,
+        )
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import typing as t
+
+# Version of the pickled layout of `SessionRecord`.
+FORMAT = 1
+
+_FIELDS = ("bot_id", "engine", "count", "settings", "context", "bots")
+
+
+class SessionRecord:
+    """A chat's session as saved in `chat_data["bot_data"]`.
+
+    `settings` are what the user chose, kept when the session is compacted,
+    `context` is the engine's conversation and `bots` the records of the
+    sessions a composite engine is made of. Field values are replaced,
+    never changed in place, so records can share them without copies.
+
+    `version` grows with every change. Saving an unchanged record is a no-op
+    and persistence can tell a chat changed without pickling it.
+    """
+
+    __slots__ = (*_FIELDS, "version", "saved")
+
+    def __init__(
+        self,
+        bot_id: str,
+        engine: str,
+        count: int = 0,
+        settings: t.Optional[t.Dict[str, t.Any]] = None,
+        context: t.Optional[t.Dict[str, t.Any]] = None,
+        bots: t.Optional[t.Dict[str, SessionRecord]] = None,
+        version: int = 0,
+    ) -> None:
+        self.bot_id = bot_id
+        self.engine = engine
+        self.count = count
+        self.settings = settings or {}
+        self.context = context
+        self.bots = bots or {}
+        self.version = version
+        # Version last saved to chat_data, not persisted.
+        self.saved = version
+
+    @property
+    def signature(self) -> t.Tuple[str, int]:
+        """Identifies the record's state, within a process."""
+        return self.bot_id, self.version
+
+    @property
+    def dirty(self) -> bool:
+        return self.saved != self.version
+
+    def update(self, **fields) -> bool:
+        """Set the fields that changed, return whether any did."""
+        changed = False
+        for name, value in fields.items():
+            current = getattr(self, name)
+            if current is not value and current != value:
+                setattr(self, name, value)
+                changed = True
+        if changed:
+            self.version += 1
+        return changed
+
+    def touch(self):
+        """Record a change made in the records of `bots`."""
+        self.version += 1
+
+    def replace(self, **fields) -> SessionRecord:
+        """A copy of the record with `fields` changed."""
+        values = {name: getattr(self, name) for name in _FIELDS}
+        values.update(fields)
+        return SessionRecord(**values, version=self.version + 1)
+
+    @classmethod
+    def load(cls, data: t.Any) -> t.Optional[SessionRecord]:
+        """Record saved in `chat_data["bot_data"]`, from older dicts too."""
+        if data is None or isinstance(data, SessionRecord):
+            return data
+        info = data["info"]
+        return cls(
+            bot_id=info["bot_id"],
+            engine=info["engine"],
+            count=info.get("count", 0),
+            # Composite engines flattened their sessions' info as "engine.key".
+            settings={
+                k: v
+                for k, v in info.items()
+                if k not in ("bot_id", "engine", "count", "winner") and "." not in k
+            },
+            context=data.get("context"),
+            bots={
+                engine: t.cast(SessionRecord, cls.load(d))
+                for engine, d in data.get("bots", {}).items()
+            },
+        )
+
+    def __reduce__(self):
+        return _restore, (
+            FORMAT,
+            *(getattr(self, name) for name in _FIELDS),
+            self.version,
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"SessionRecord(bot_id={self.bot_id!r}, engine={self.engine!r},"
+            f" count={self.count}, version={self.version})"
+        )
+
+
+def _restore(format: int, *values) -> SessionRecord:
+    *fields, version = values
+    return SessionRecord(*fields, version=version)
@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import typing as t
+import html
+import re
+from html.parser import HTMLParser
+
+import markdown
+
+# Telegram's limit on the text of a message, in UTF-16 code units.
+MESSAGE_LIMIT = 4096
+
+_FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})[ \t]*([\w+#.-]*)")
+_REFERENCE = re.compile(r"^ {0,3}\[([^\]]+)\]:\s*(\S+).*$", re.M)
+# Bing cites sources as [^1^] and defines them as "[1]: url".
+_CITATION = re.compile(r"\[\^(\d+)\^\]")
+_TAG = re.compile(r"<[^>]*>")
+
+# sane_lists keeps the number an ordered list starts with.
+_md = markdown.Markdown(extensions=["sane_lists"])
+# Engines answer questions about HTML, show it rather than interpreting it.
+_md.preprocessors.deregister("html_block")
+_md.inlinePatterns.deregister("html")
+
+# Tags Telegram understands, by the tags python-markdown emits.
+_INLINE = {
+    "b": "b",
+    "strong": "b",
+    "i": "i",
+    "em": "i",
+    "u": "u",
+    "ins": "u",
+    "s": "s",
+    "del": "s",
+    "strike": "s",
+}
+_HEADINGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+
+
+def length(text: str) -> int:
+    """Length of `text` as Telegram counts it."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def plain(rendered: str) -> str:
+    """Text of rendered HTML, for when Telegram rejects the markup."""
+    return html.unescape(_TAG.sub("", rendered))
+
+
+class _TelegramHTML(HTMLParser):
+    """Reduce python-markdown's HTML to the subset Telegram accepts."""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.out: t.List[str] = []
+        self._open: t.Dict[str, int] = {}
+        self._lists: t.List[t.List[t.Any]] = []
+        self._links: t.List[bool] = []
+        self._pre = 0
+
+    def _newline(self):
+        if self.out and not self.out[-1].endswith("\n"):
+            self.out.append("\n")
+
+    def _rstrip(self):
+        while self.out and self.out[-1].endswith("\n"):
+            self.out[-1] = self.out[-1].rstrip("\n")
+            if not self.out[-1]:
+                self.out.pop()
+
+    def _tag(self, tag: str, opening: bool):
+        # Telegram rejects a tag nested in itself, e.g. bold in a heading.
+        depth = self._open.get(tag, 0)
+        if opening:
+            self._open[tag] = depth + 1
+            if depth == 0:
+                self.out.append(f"<{tag}>")
+        elif depth > 0:
+            self._open[tag] = depth - 1
+            if depth == 1:
+                self.out.append(f"</{tag}>")
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        if tag in _INLINE:
+            self._tag(_INLINE[tag], True)
+        elif tag in _HEADINGS:
+            self._newline()
+            self._tag("b", True)
+        elif tag == "code":
+            self.out.append("<code>")
+        elif tag == "pre":
+            self._newline()
+            self._pre += 1
+            self.out.append("<pre>")
+        elif tag == "a":
+            href = attributes.get("href")
+            # Links can't be nested either.
+            href = href if not any(self._links) else None
+            self._links.append(bool(href))
+            if href:
+                self.out.append(f'<a href="{html.escape(href)}">')
+        elif tag in ("ul", "ol"):
+            self._newline()
+            start = attributes.get("start") or "1"
+            self._lists.append([tag == "ol", int(start) if start.isdigit() else 1])
+        elif tag == "li":
+            self._newline()
+            indent = "  " * max(len(self._lists) - 1, 0)
+            if self._lists and self._lists[-1][0]:
+                bullet = f"{self._lists[-1][1]}. "
+                self._lists[-1][1] += 1
+            else:
+                bullet = "• "
+            self.out.append(indent + bullet)
+        elif tag == "blockquote":
+            self._newline()
+            self.out.append("<blockquote>")
+        elif tag == "br":
+            self.out.append("\n")
+        elif tag == "hr":
+            self._newline()
+            self.out.append("——————\n")
+        elif tag == "img":
+            self.out.append(html.escape(attributes.get("alt") or ""))
+
+    def handle_endtag(self, tag):
+        if tag in _INLINE:
+            self._tag(_INLINE[tag], False)
+        elif tag in _HEADINGS:
+            self._tag("b", False)
+            self._newline()
+        elif tag == "code":
+            self.out.append("</code>")
+        elif tag == "pre":
+            self._rstrip()
+            self._pre -= 1
+            self.out.append("</pre>\n")
+        elif tag == "a":
+            if self._links and self._links.pop():
+                self.out.append("</a>")
+        elif tag in ("ul", "ol"):
+            if self._lists:
+                self._lists.pop()
+            self._newline()
+        elif tag in ("p", "li"):
+            self._newline()
+        elif tag == "blockquote":
+            self._rstrip()
+            self.out.append("</blockquote>\n")
+
+    def handle_data(self, data):
+        if not self._pre and not data.strip() and "\n" in data:
+            # Whitespace between block elements.
+            return
+        self.out.append(html.escape(data, quote=False))
+
+    def result(self) -> str:
+        self.close()
+        self._rstrip()
+        return "".join(self.out)
+
+
+def _closes(line: str, fence: str) -> bool:
+    line = line.strip()
+    return line.startswith(fence) and not line.strip(fence[0])
+
+
+def _code_block(info: str, body: str) -> str:
+    language = f' class="language-{html.escape(info)}"' if info else ""
+    return f"<pre><code{language}>{html.escape(body, quote=False)}</code></pre>"
+
+
+class Renderer:
+    """Render an engine's markdown answer as Telegram HTML messages.
+
+    The answer is cut into blocks at blank lines outside code fences, each
+    block is rendered on its own and the results are packed into messages
+    of at most `limit` characters. Blocks too long for a message are split
+    at line breaks, within code blocks too. Rendered blocks are kept
+    between calls, so re-rendering a growing answer only renders its tail.
+
+    With `markdown` off the answer is shown as it is.
+    """
+
+    def __init__(self, markdown: bool = True, limit: int = MESSAGE_LIMIT) -> None:
+        self.markdown = markdown
+        self.limit = limit
+        self._cache: t.Dict[str, t.List[t.Tuple[str, int]]] = {}
+
+    @staticmethod
+    def blocks(text: str) -> t.List[str]:
+        """Split markdown at blank lines, keeping code fences whole."""
+        blocks: t.List[str] = []
+        lines: t.List[str] = []
+        fence: t.Optional[str] = None
+        for line in text.split("\n"):
+            if fence is None:
+                match = _FENCE.match(line)
+                if match:
+                    if lines:
+                        blocks.append("\n".join(lines))
+                        lines = []
+                    fence = match.group(1)
+                elif not line.strip():
+                    if lines:
+                        blocks.append("\n".join(lines))
+                        lines = []
+                    continue
+                elif line[:1] in (" ", "\t") and not lines and blocks:
+                    # Continues the list item or code of the previous block.
+                    lines = [blocks.pop(), ""]
+                lines.append(line)
+            else:
+                lines.append(line)
+                if _closes(line, fence):
+                    blocks.append("\n".join(lines))
+                    lines = []
+                    fence = None
+        if lines:
+            blocks.append("\n".join(lines))
+        return blocks
+
+    def _convert(self, block: str, references: str) -> str:
+        match = _FENCE.match(block)
+        if match:
+            lines = block.split("\n")[1:]
+            if lines and _closes(lines[-1], match.group(1)):
+                lines = lines[:-1]
+            return _code_block(match.group(2), "\n".join(lines))
+        if not self.markdown:
+            return html.escape(block, quote=False)
+        _md.reset()
+        parser = _TelegramHTML()
+        parser.feed(_md.convert(block + references))
+        return parser.result()
+
+    def _split(self, block: str) -> t.List[str]:
+        """Halve a block's source, keeping code fences around each half."""
+        lines = block.split("\n")
+        match = _FENCE.match(block)
+        if match:
+            fence = match.group(1)
+            body = lines[1:]
+            if body and _closes(body[-1], fence):
+                body = body[:-1]
+            if len(body) > 1:
+                halves = [body[: len(body) // 2], body[len(body) // 2 :]]
+            else:
+                line = body[0] if body else ""
+                halves = [[line[: len(line) // 2]], [line[len(line) // 2 :]]]
+            return ["\n".join([lines[0], *half, fence]) for half in halves]
+        if len(lines) > 1:
+            half = len(lines) // 2
+            return ["\n".join(lines[:half]), "\n".join(lines[half:])]
+        # One long line, cut at a space near the middle if there is one.
+        half = len(block) // 2
+        space = block.rfind(" ", 0, half)
+        cut = space if space > half // 2 else half
+        return [block[:cut], block[cut:]]
+
+    def _render(self, block: str, references: str) -> t.List[t.Tuple[str, int]]:
+        """Rendered pieces of a block, each with its length."""
+        rendered = self._convert(block, references)
+        size = length(plain(rendered))
+        if size <= self.limit or len(block) < 2:
+            return [(rendered, size)]
+        pieces = []
+        for part in self._split(block):
+            pieces.extend(self._render(part, references))
+        return pieces
+
+    def render(self, text: str) -> t.List[str]:
+        """Messages showing `text`, at least one."""
+        references = ""
+        if self.markdown:
+            definitions = dict(_REFERENCE.findall(text))
+            text = _CITATION.sub(
+                lambda m: rf"[\[{m.group(1)}\]]({definitions[m.group(1)]})"
+                if m.group(1) in definitions
+                else f"[{m.group(1)}]",
+                text,
+            )
+            text = _REFERENCE.sub("", text)
+            if definitions:
+                references = "\n\n" + "\n".join(
+                    f"[{k}]: {v}" for k, v in definitions.items()
+                )
+
+        cache: t.Dict[str, t.List[t.Tuple[str, int]]] = {}
+        messages: t.List[str] = []
+        parts: t.List[str] = []
+        size = 0
+        for block in self.blocks(text):
+            key = block + references
+            pieces = cache.get(key)
+            if pieces is None:
+                pieces = self._cache.get(key)
+                if pieces is None:
+                    pieces = self._render(block, references)
+                cache[key] = pieces
+            for rendered, piece_size in pieces:
+                if not rendered:
+                    continue
+                separator = 2 if parts else 0
+                if parts and size + separator + piece_size > self.limit:
+                    messages.append("\n\n".join(parts))
+                    parts, size, separator = [], 0, 0
+                parts.append(rendered)
+                size += separator + piece_size
+        if parts:
+            messages.append("\n\n".join(parts))
+        # Only keep the blocks of the latest text.
+        self._cache = cache
+        return messages or [html.escape(text.strip(), quote=False) or "…"]
@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import random
+import time
+
+import httpx
+import structlog
+
+import metrics
+from admission import Overloaded
+
+if t.TYPE_CHECKING:
+    import bot
+
+logger = structlog.get_logger(__name__)
+
+T = t.TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class UpstreamTimeout(RuntimeError):
+    """An upstream ask took longer than allowed in `phase`."""
+
+    def __init__(self, engine: str, phase: str, timeout: float) -> None:
+        super().__init__(f"{engine} {phase} timed out after {timeout}s")
+        self.engine = engine
+        self.phase = phase
+
+
+class CircuitOpen(RuntimeError):
+    """The engine's circuit breaker is open, the upstream wasn't asked."""
+
+    def __init__(self, engine: str) -> None:
+        super().__init__(f"{engine} circuit breaker is open")
+        self.engine = engine
+
+
+# Errors worth asking again, as long as nothing was streamed yet.
+TRANSIENT_ERRORS: t.Tuple[t.Type[BaseException], ...] = (
+    UpstreamTimeout,
+    asyncio.TimeoutError,
+    ConnectionError,
+    httpx.TransportError,
+)
+
+policies: t.Dict[str, Policy] = {}
+
+UPSTREAM_TIMEOUTS = metrics.registry.counter(
+    "upstream_timeouts_total", "Upstream asks timed out.", ["engine", "phase"]
+)
+UPSTREAM_RETRIES = metrics.registry.counter(
+    "upstream_retries_total", "Upstream asks retried.", ["engine"]
+)
+FALLBACKS = metrics.registry.counter(
+    "engine_fallbacks_total", "Asks answered by a fallback engine.", ["engine", "to"]
+)
+metrics.registry.gauge(
+    "circuit_state",
+    "Circuit breaker state per engine: 0 closed, 1 half open, 2 open.",
+    ["engine"],
+    fn=lambda: {(e,): _STATE_VALUES[p.breaker.state] for e, p in policies.items()},
+)
+
+
+class CircuitBreaker:
+    """Stop asking an engine after `failure_threshold` failures in a row.
+
+    After `reset_timeout` seconds one trial request is let through; its
+    success closes the breaker again, its failure keeps it open.
+    """
+
+    def __init__(
+        self, engine: str, failure_threshold: int = 5, reset_timeout: float = 30
+    ) -> None:
+        self.engine = engine
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.failure_threshold:
+            return CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self):
+        state = self.state
+        if state == OPEN or (state == HALF_OPEN and self._trial):
+            raise CircuitOpen(self.engine)
+        if state == HALF_OPEN:
+            self._trial = True
+
+    def abandon(self):
+        """Forget a request that ended without success or failure."""
+        self._trial = False
+
+    def success(self):
+        if self.failures >= self.failure_threshold:
+            logger.info("circuit closed", engine=self.engine)
+        self.failures = 0
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.failures >= self.failure_threshold:
+            if self.failures == self.failure_threshold:
+                logger.warning("circuit opened", engine=self.engine)
+            self.opened_at = time.monotonic()
+
+
+class Policy:
+    """Timeouts, retries and circuit breaker of one engine.
+
+    `connect_timeout` bounds setting up the conversation, `first_chunk_timeout`
+    the wait for the first chunk, `idle_timeout` the gap between chunks and
+    `total_timeout` the whole answer. Asks failing with a transient error
+    before anything was streamed are retried up to `retries` times after a
+    jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        engine: str,
+        connect_timeout: float = 30,
+        first_chunk_timeout: float = 60,
+        idle_timeout: float = 60,
+        total_timeout: float = 300,
+        retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 5,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30,
+    ) -> None:
+        self.engine = engine
+        self.connect_timeout = connect_timeout
+        self.first_chunk_timeout = first_chunk_timeout
+        self.idle_timeout = idle_timeout
+        self.total_timeout = total_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = CircuitBreaker(engine, breaker_failures, breaker_reset)
+        policies[engine] = self
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2**attempt))
+
+    async def connect(self, aw: t.Awaitable[T]) -> T:
+        """Await the connect phase `aw` within `connect_timeout`."""
+        try:
+            return await asyncio.wait_for(aw, self.connect_timeout)
+        except asyncio.TimeoutError:
+            UPSTREAM_TIMEOUTS.inc(self.engine, "connect")
+            raise UpstreamTimeout(
+                self.engine, "connect", self.connect_timeout
+            ) from None
+
+    async def _timed(self, stream: t.AsyncIterator[T]) -> t.AsyncIterator[T]:
+        start = time.monotonic()
+        phase, timeout = "first_chunk", self.first_chunk_timeout
+        it = stream.__aiter__()
+        try:
+            while True:
+                remaining = self.total_timeout - (time.monotonic() - start)
+                if remaining < timeout:
+                    phase, timeout = "total", remaining
+                try:
+                    item = await asyncio.wait_for(it.__anext__(), max(timeout, 0))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    UPSTREAM_TIMEOUTS.inc(self.engine, phase)
+                    if phase == "total":
+                        timeout = self.total_timeout
+                    raise UpstreamTimeout(self.engine, phase, timeout) from None
+                yield item
+                phase, timeout = "idle", self.idle_timeout
+        finally:
+            aclose = getattr(it, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def ask_stream(
+        self, session: bot.Bot, prompt: str
+    ) -> t.AsyncIterator[t.Tuple[bool, str]]:
+        """`session.ask_stream` with timeouts, retries and the circuit breaker.
+
+        Raises `CircuitOpen` without asking when the breaker is open, or when
+        this ask opened it before anything was streamed.
+        """
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            streamed = False
+            try:
+                async for item in self._timed(session.ask_stream(prompt)):
+                    streamed = True
+                    yield item
+            except Overloaded:
+                self.breaker.abandon()
+                raise
+            except BaseException as exc:
+                if not isinstance(exc, Exception):
+                    # Cancelled, or the caller stopped reading.
+                    self.breaker.abandon()
+                    raise
+                self.breaker.failure()
+                if streamed:
+                    raise
+                if self.breaker.state != CLOSED:
+                    raise CircuitOpen(self.engine) from exc
+                if attempt >= self.retries or not isinstance(exc, TRANSIENT_ERRORS):
+                    raise
+                attempt += 1
+                UPSTREAM_RETRIES.inc(self.engine)
+                delay = self.backoff(attempt)
+                logger.warning(
+                    "retrying upstream ask",
+                    engine=self.engine,
+                    attempt=attempt,
+                    delay=delay,
+                    error=repr(exc),
+                )
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.success()
+            return
+
+
+def policy(engine: str) -> Policy:
+    p = policies.get(engine)
+    if p is None:
+        p = Policy(engine)
+    return p
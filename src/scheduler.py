@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import time
+from collections import OrderedDict
+
+import structlog
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+from coalesce import MessageCoalescer
+
+logger = structlog.get_logger(__name__)
+
+SHED = metrics.registry.counter(
+    "updates_shed_total", "Updates dropped because their chat's queue was full."
+)
+
+
+class ChatStats:
+    __slots__ = ("depth", "max_depth", "processed", "wait_total", "wait_max")
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.max_depth = 0
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def dict(self) -> t.Dict[str, t.Any]:
+        return dict(
+            depth=self.depth,
+            max_depth=self.max_depth,
+            processed=self.processed,
+            wait_avg=self.wait_total / self.processed if self.processed else 0.0,
+            wait_max=self.wait_max,
+        )
+
+
+class ChatScheduler:
+    """Run updates of different chats concurrently, keeping each chat in order.
+
+    At most `max_concurrent` updates are processed at once. Updates of the same
+    chat wait on a per chat FIFO lock, so a turn always sees the state saved by
+    the previous one. A chat with `max_queued_per_chat` updates already
+    waiting drops further ones, so a single busy chat can't take up all of the
+    application's update slots.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 16,
+        max_tracked_chats: int = 1000,
+        max_queued_per_chat: int = 16,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queued_per_chat = max_queued_per_chat
+        self.max_tracked_chats = max_tracked_chats
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._locks: t.Dict[int, asyncio.Lock] = {}
+        # Updates holding or waiting for each chat's lock. Unlike the stats,
+        # never evicted: the lock is dropped only once nobody uses it.
+        self._users: t.Dict[int, int] = {}
+        self._stats: OrderedDict[int, ChatStats] = OrderedDict()
+        self.in_flight = 0
+
+    def _chat_stats(self, chat_id: int) -> ChatStats:
+        stats = self._stats.get(chat_id)
+        if stats is None:
+            stats = self._stats[chat_id] = ChatStats()
+            while len(self._stats) > self.max_tracked_chats:
+                self._stats.popitem(last=False)
+        else:
+            self._stats.move_to_end(chat_id)
+        return stats
+
+    async def run(
+        self,
+        chat_id: t.Optional[int],
+        coroutine: t.Coroutine,
+        ready: t.Optional[t.Callable[[], t.Awaitable[t.Any]]] = None,
+    ):
+        """Run `coroutine` in order with the other updates of `chat_id`.
+
+        `ready` is awaited once it's the chat's turn, before taking one of the
+        `max_concurrent` slots. Returns None without running `coroutine` if the
+        chat's queue is full.
+        """
+        if chat_id is None:
+            async with self._semaphore:
+                return await coroutine
+
+        if self._users.get(chat_id, 0) > self.max_queued_per_chat:
+            coroutine.close()
+            SHED.inc()
+            logger.warning("update shed", chat_id=chat_id)
+            return None
+        stats = self._chat_stats(chat_id)
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._users[chat_id] = self._users.get(chat_id, 0) + 1
+        stats.depth += 1
+        stats.max_depth = max(stats.max_depth, stats.depth)
+        start = time.monotonic()
+        started = False
+        try:
+            async with lock:
+                if ready is not None:
+                    await ready()
+                async with self._semaphore:
+                    wait = time.monotonic() - start
+                    stats.processed += 1
+                    stats.wait_total += wait
+                    stats.wait_max = max(stats.wait_max, wait)
+                    logger.debug(
+                        "update scheduled", chat_id=chat_id, wait=wait, depth=stats.depth
+                    )
+                    self.in_flight += 1
+                    started = True
+                    try:
+                        return await coroutine
+                    finally:
+                        self.in_flight -= 1
+        finally:
+            if not started:
+                coroutine.close()
+            stats.depth -= 1
+            self._users[chat_id] -= 1
+            if self._users[chat_id] == 0:
+                del self._users[chat_id]
+                del self._locks[chat_id]
+
+    @property
+    def queued(self) -> int:
+        return sum(self._users.values()) - self.in_flight
+
+    def stats(self, chat_id: t.Optional[int] = None) -> t.Dict[t.Any, t.Any]:
+        if chat_id is not None:
+            stats = self._stats.get(chat_id)
+            return stats.dict() if stats is not None else ChatStats().dict()
+        return {chat_id: stats.dict() for chat_id, stats in self._stats.items()}
+
+
+class ChatOrderedApplication(Application):
+    """`Application` that processes updates through a `ChatScheduler`.
+
+    With a `coalescer`, quick successive text messages are merged into one.
+    `interrupt` sees every update as it arrives, before it waits for the
+    chat's earlier updates; updates it returns true for are processed right
+    away, e.g. a command stopping the answer being generated.
+    """
+
+    def __init__(
+        self,
+        *,
+        scheduler: ChatScheduler,
+        coalescer: t.Optional[MessageCoalescer] = None,
+        interrupt: t.Optional[t.Callable[[Update], bool]] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+        self.coalescer = coalescer
+        self.interrupt = interrupt
+
+    async def process_update(self, update: object) -> None:
+        chat_id = None
+        if isinstance(update, Update) and update.effective_chat is not None:
+            chat_id = update.effective_chat.id
+            if self.interrupt is not None and self.interrupt(update):
+                await super().process_update(update)
+                return
+        if self.coalescer is not None and chat_id is not None:
+            assert isinstance(update, Update)
+            key = self.coalescer.key(update)
+            if key is None:
+                self.coalescer.flush(chat_id)
+            else:
+                batch = self.coalescer.add(key, update)
+                if batch is None:
+                    # Joined a batch that is already scheduled.
+                    return
+                coalescer = self.coalescer
+                try:
+                    await self.scheduler.run(
+                        chat_id,
+                        self._process_batch(batch),
+                        ready=lambda: coalescer.ready(key, batch),
+                    )
+                finally:
+                    # Don't let later messages join a batch that was shed.
+                    coalescer.close(key, batch)
+                return
+        await self.scheduler.run(chat_id, super().process_update(update))
+
+    async def _process_batch(self, batch):
+        assert self.coalescer is not None
+        await super().process_update(self.coalescer.merge(batch))
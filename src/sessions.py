@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import time
+from collections import OrderedDict
+
+import structlog
+
+import bot
+
+logger = structlog.get_logger(__name__)
+
+
+class SessionCache:
+    """Keep live bots, and their upstream connections, warm between turns.
+
+    Sessions are keyed by `bot_id` and evicted in LRU order once there are more
+    than `max_sessions` of them or they have been idle for `idle_ttl` seconds.
+    Evicted bots are closed in the background.
+    """
+
+    def __init__(self, max_sessions: int = 1000, idle_ttl: float = 1800) -> None:
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions: OrderedDict[str, t.Tuple[bot.Bot, float]] = OrderedDict()
+        self._closing: t.Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, bot_id: str) -> t.Optional[bot.Bot]:
+        self.sweep()
+        entry = self._sessions.get(bot_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._sessions[bot_id] = (entry[0], time.monotonic())
+        self._sessions.move_to_end(bot_id)
+        return entry[0]
+
+    def put(self, session: bot.Bot):
+        old = self._sessions.pop(session.bot_id, None)
+        if old is not None and old[0] is not session:
+            self._close(old[0])
+        self._sessions[session.bot_id] = (session, time.monotonic())
+        self.sweep()
+
+    def discard(self, bot_id: str):
+        entry = self._sessions.pop(bot_id, None)
+        if entry is not None:
+            self._close(entry[0])
+
+    def sweep(self) -> int:
+        """Evict sessions over the size bound or past the idle ttl."""
+        evicted = 0
+        deadline = time.monotonic() - self.idle_ttl
+        while self._sessions:
+            bot_id, (session, last_used) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and last_used > deadline:
+                break
+            del self._sessions[bot_id]
+            self._close(session)
+            evicted += 1
+        return evicted
+
+    async def close_all(self):
+        sessions = [session for session, _ in self._sessions.values()]
+        self._sessions.clear()
+        for session in sessions:
+            self._close(session)
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    def _close(self, session: bot.Bot):
+        task = asyncio.get_running_loop().create_task(self._close_session(session))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close_session(session: bot.Bot):
+        logger.debug("close session", bot_id=session.bot_id)
+        try:
+            await session.close()
+        except Exception:
+            logger.exception(f"[bot:{session.bot_id}] close session failed")
+
+    def stats(self) -> t.Dict[str, int]:
+        return dict(sessions=len(self), hits=self.hits, misses=self.misses)
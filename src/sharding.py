@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import os
+import signal
+import sys
+
+import httpx
+import structlog
+
+import metrics
+from httpserver import HTTPServer, Request, Response
+
+logger = structlog.get_logger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+# Keys of updates carrying a message, in the order Telegram documents them.
+MESSAGE_KEYS = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+)
+CHAT_KEYS = ("my_chat_member", "chat_member", "chat_join_request")
+USER_KEYS = (
+    "inline_query",
+    "chosen_inline_result",
+    "shipping_query",
+    "pre_checkout_query",
+    "poll_answer",
+)
+
+DISPATCHED = metrics.registry.counter(
+    "shard_updates_dispatched_total", "Updates forwarded to workers.", ["worker"]
+)
+REJECTED = metrics.registry.counter(
+    "shard_updates_rejected_total",
+    "Updates dropped because workers refused them.",
+    ["worker"],
+)
+WORKER_RESTARTS = metrics.registry.counter(
+    "shard_worker_restarts_total", "Worker processes restarted.", ["worker"]
+)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring, adding a node only moves about 1/n of the keys."""
+
+    def __init__(self, nodes: t.Sequence[str], replicas: int = 64) -> None:
+        points = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def node(self, key: t.Any) -> str:
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+def shard_key(update: t.Dict[str, t.Any]) -> t.Optional[int]:
+    """Chat id of a raw update, or the user id for updates without a chat."""
+    for key in MESSAGE_KEYS:
+        if key in update:
+            return update[key]["chat"]["id"]
+    query = update.get("callback_query")
+    if query is not None:
+        message = query.get("message")
+        if message is not None:
+            return message["chat"]["id"]
+        return query["from"]["id"]
+    for key in CHAT_KEYS:
+        if key in update:
+            return update[key]["chat"]["id"]
+    for key in USER_KEYS:
+        if key in update:
+            return update[key].get("from", update[key].get("user", {})).get("id")
+    return None
+
+
+class Worker:
+    """A bot process receiving its shard of updates on a local webhook.
+
+    The process is restarted whenever it exits. Updates are posted in order
+    and in batches; a batch is retried while the worker is unreachable or
+    fails with a server error, so nothing is lost while the worker restarts.
+    A batch the worker rejects as bad is logged and dropped.
+    """
+
+    def __init__(
+        self,
+        index: int,
+        port: int,
+        argv: t.Sequence[str],
+        env: t.Dict[str, str],
+        secret_token: str,
+        max_batch: int = 100,
+    ) -> None:
+        self.index = index
+        self.name = f"worker-{index}"
+        self.url = f"http://127.0.0.1:{port}/updates"
+        self.argv = list(argv)
+        self.env = env
+        self.secret_token = secret_token
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue[t.Dict[str, t.Any]] = asyncio.Queue()
+        self.process: t.Optional[asyncio.subprocess.Process] = None
+        self._stopping = False
+        self._tasks: t.List[asyncio.Task] = []
+
+    def start(self, client: httpx.AsyncClient):
+        self._tasks = [
+            asyncio.create_task(self._supervise()),
+            asyncio.create_task(self._send(client)),
+        ]
+
+    async def stop(self, timeout: float = 30):
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.process is not None and self.process.returncode is None:
+            # SIGTERM lets the worker flush its persistence.
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.process.kill()
+
+    async def _supervise(self):
+        backoff = 1.0
+        while not self._stopping:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.argv, env=self.env
+            )
+            logger.info(f"{self.name} started", pid=self.process.pid)
+            code = await self.process.wait()
+            if self._stopping:
+                break
+            WORKER_RESTARTS.inc(self.name)
+            logger.warning(f"{self.name} exited, restarting", code=code)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    async def _send(self, client: httpx.AsyncClient):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            delay = 0.1
+            while True:
+                try:
+                    response = await client.post(
+                        self.url,
+                        content=json.dumps(batch),
+                        headers={
+                            "content-type": "application/json",
+                            SECRET_HEADER: self.secret_token,
+                        },
+                    )
+                except httpx.TransportError as exc:
+                    logger.debug(f"{self.name} unavailable", error=str(exc))
+                else:
+                    if response.status_code < 500:
+                        break
+                    logger.debug(f"{self.name} failed", status=response.status_code)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+            if response.is_success:
+                DISPATCHED.inc(self.name, amount=len(batch))
+            else:
+                # Retrying would stall the shard on this batch for good.
+                REJECTED.inc(self.name, amount=len(batch))
+                logger.error(
+                    f"{self.name} rejected updates, dropped",
+                    status=response.status_code,
+                    update_ids=[update.get("update_id") for update in batch],
+                )
+
+
+class ShardFront:
+    """Receive updates and dispatch them to worker processes by chat id.
+
+    Every worker is the bot itself, started with `TELEGRAM_SHARD_INDEX` set,
+    owning the sessions of the chats hashed to it. Chat data lives in the
+    shared SQLite database, so a chat moved to another worker when the number
+    of shards changes picks up its saved conversation there.
+    """
+
+    def __init__(
+        self,
+        shards: int,
+        base_port: int,
+        argv: t.Optional[t.Sequence[str]] = None,
+        env: t.Optional[t.Dict[str, str]] = None,
+    ) -> None:
+        self.secret_token = os.urandom(16).hex()
+        argv = list(argv or [sys.executable, *sys.argv])
+        env = dict(env if env is not None else os.environ)
+        self.workers: t.Dict[str, Worker] = {}
+        for i in range(shards):
+            worker_env = dict(
+                env,
+                TELEGRAM_SHARD_INDEX=str(i),
+                TELEGRAM_UPDATE_MODE="webhook",
+                TELEGRAM_WEBHOOK_HOST="127.0.0.1",
+                TELEGRAM_WEBHOOK_PORT=str(base_port + i),
+                TELEGRAM_WEBHOOK_PATH="/updates",
+                TELEGRAM_WEBHOOK_SECRET_TOKEN=self.secret_token,
+            )
+            worker = Worker(i, base_port + i, argv, worker_env, self.secret_token)
+            self.workers[worker.name] = worker
+        self.ring = HashRing(list(self.workers))
+        self._client: t.Optional[httpx.AsyncClient] = None
+        metrics.registry.gauge(
+            "shard_queue_depth",
+            "Updates waiting to be forwarded to a worker.",
+            ["worker"],
+            fn=lambda: {(n,): w.queue.qsize() for n, w in self.workers.items()},
+        )
+
+    def worker_for(self, key: t.Any) -> Worker:
+        return self.workers[self.ring.node(key)]
+
+    def dispatch(self, update: t.Dict[str, t.Any]):
+        key = shard_key(update)
+        worker = self.worker_for(key if key is not None else update["update_id"])
+        worker.queue.put_nowait(update)
+
+    def webhook_endpoint(self, secret_token: t.Optional[str] = None):
+        async def endpoint(request: Request) -> Response:
+            if secret_token is not None and not hmac.compare_digest(
+                request.headers.get(SECRET_HEADER, "").encode(), secret_token.encode()
+            ):
+                return Response(status=403)
+            try:
+                self.dispatch(json.loads(request.body))
+            except (ValueError, KeyError, TypeError):
+                logger.exception("invalid webhook update")
+                return Response(status=400)
+            return Response()
+
+        return endpoint
+
+    async def health_endpoint(self, request: Request) -> Response:
+        alive = {
+            name: w.process is not None and w.process.returncode is None
+            for name, w in self.workers.items()
+        }
+        status = 200 if self._client is not None and all(alive.values()) else 503
+        return Response(
+            json.dumps(alive), status=status, content_type="application/json"
+        )
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=30)
+        for worker in self.workers.values():
+            worker.start(self._client)
+
+    async def stop(self):
+        await asyncio.gather(*(w.stop() for w in self.workers.values()))
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def poll(self, api_url: str, timeout: int = 30):
+        """Long poll `getUpdates` at `api_url` (base url and token) forever."""
+        async with httpx.AsyncClient(timeout=timeout + 10) as client:
+            response = await client.post(f"{api_url}/deleteWebhook")
+            response.raise_for_status()
+            offset = 0
+            while True:
+                try:
+                    response = await client.post(
+                        f"{api_url}/getUpdates",
+                        json=dict(offset=offset, timeout=timeout),
+                    )
+                    response.raise_for_status()
+                    updates = response.json()["result"]
+                except (httpx.HTTPError, ValueError, KeyError):
+                    logger.exception("getUpdates failed")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    self.dispatch(update)
+                    offset = update["update_id"] + 1
+
+
+async def run_front(
+    front: ShardFront,
+    servers: t.Sequence[HTTPServer],
+    api_url: str,
+    webhook_url: t.Optional[str] = None,
+    secret_token: t.Optional[str] = None,
+):
+    """Run `front` until SIGINT or SIGTERM, polling unless `webhook_url` is set.
+
+    In webhook mode one of `servers` must already route the webhook to
+    `front.webhook_endpoint`.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await front.start()
+    for server in servers:
+        await server.start()
+    receiver = None
+    try:
+        if webhook_url is None:
+            receiver = asyncio.create_task(front.poll(api_url))
+        else:
+            data: t.Dict[str, t.Any] = dict(url=webhook_url)
+            if secret_token is not None:
+                data["secret_token"] = secret_token
+            async with httpx.AsyncClient() as client:
+                response = await client.post(f"{api_url}/setWebhook", json=data)
+                response.raise_for_status()
+            logger.info("webhook set", url=webhook_url)
+        await stop.wait()
+    finally:
+        if receiver is not None:
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+        for server in servers:
+            await server.stop()
+        await front.stop()
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import time
+
+import structlog
+from telegram import Message, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+from render import Renderer, plain
+
+logger = structlog.get_logger(__name__)
+
+# Sent with a reply keyboard that can't be attached to the streamed answer.
+KEYBOARD_TEXT = "可以接着问:"
+
+
+class MessageStreamer:
+    """Progressively edit the reply messages while an answer streams in.
+
+    The answer is rendered by `renderer` into as many messages as needed.
+    The first pushed chunk is sent as a new reply, later chunks are coalesced
+    and applied at most once every `interval` seconds, editing only the
+    messages whose text changed and sending new ones as the answer grows.
+    """
+
+    def __init__(
+        self,
+        message: Message,
+        interval: float = 1.0,
+        renderer: t.Optional[Renderer] = None,
+        **kwargs,
+    ) -> None:
+        self._message = message
+        self._interval = interval
+        self._renderer = renderer or Renderer()
+        self._kwargs = kwargs
+        self._replies: t.List[Message] = []
+        self._sent: t.List[str] = []
+        self._text: t.Optional[str] = None
+        self._rendered_text: t.Optional[str] = None
+        self._next_edit = 0.0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: t.Optional[asyncio.Task] = None
+
+    @property
+    def started(self) -> bool:
+        return self._task is not None
+
+    def push(self, text: str):
+        """Record the latest text, the flusher sends it when allowed."""
+        if not text:
+            return
+        self._text = text
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def finish(self, text: str, reply_markup=None):
+        """Stop streaming and show `text` as the final answer.
+
+        The streamed messages are edited in place. A `ReplyKeyboardMarkup`
+        can't be attached by editing, it then comes in a message of its own.
+        """
+        if self._task is not None:
+            # Wait for an in-flight send so the placeholder is never lost.
+            async with self._lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        if reply_markup is None:
+            reply_markup = ReplyKeyboardRemove()
+        chunks = self._renderer.render(text)
+        # The answer may end up shorter than what was streamed.
+        while len(self._replies) > len(chunks):
+            await self._replies.pop().delete()
+            self._sent.pop()
+        last = len(chunks) - 1
+        while True:
+            try:
+                await self._sync(chunks[:last])
+                if len(self._replies) > last:
+                    await self._edit(last, chunks[last])
+                    if isinstance(reply_markup, ReplyKeyboardMarkup):
+                        await self._message.reply_text(
+                            text=KEYBOARD_TEXT, reply_markup=reply_markup
+                        )
+                else:
+                    await self._send(chunks[last], reply_markup=reply_markup)
+                return
+            except RetryAfter as exc:
+                await asyncio.sleep(t.cast(float, exc.retry_after))
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text = self._text
+            if text is None or text == self._rendered_text:
+                continue
+            try:
+                async with self._lock:
+                    await self._sync(self._renderer.render(text))
+                    self._rendered_text = text
+            except RetryAfter as exc:
+                retry_after = t.cast(float, exc.retry_after)
+                self._next_edit = time.monotonic() + retry_after
+                self._wakeup.set()
+                continue
+            except Exception:
+                logger.exception("stream update failed")
+            self._next_edit = time.monotonic() + self._interval
+
+    async def _sync(self, chunks: t.List[str]):
+        """Bring the reply messages up to `chunks`, last ones may be missing."""
+        for i, chunk in enumerate(chunks):
+            if i < len(self._replies):
+                await self._edit(i, chunk)
+            else:
+                # The first reply removes the keyboard of the previous answer.
+                await self._send(
+                    chunk, reply_markup=None if self._replies else ReplyKeyboardRemove()
+                )
+
+    async def _send(self, chunk: str, reply_markup=None):
+        kwargs = dict(self._kwargs, reply_markup=reply_markup)
+        try:
+            reply = await self._message.reply_text(
+                text=chunk, parse_mode=ParseMode.HTML, **kwargs
+            )
+        except BadRequest as exc:
+            if "parse entities" not in exc.message:
+                raise
+            logger.warning("rendered answer rejected", error=exc.message)
+            reply = await self._message.reply_text(text=plain(chunk), **kwargs)
+        self._replies.append(reply)
+        self._sent.append(chunk)
+
+    async def _edit(self, i: int, chunk: str):
+        if chunk == self._sent[i]:
+            return
+        try:
+            await self._replies[i].edit_text(text=chunk, parse_mode=ParseMode.HTML)
+        except BadRequest as exc:
+            if "not modified" in exc.message:
+                pass
+            elif "parse entities" in exc.message:
+                logger.warning("rendered answer rejected", error=exc.message)
+                await self._replies[i].edit_text(text=plain(chunk))
+            else:
+                raise
+        self._sent[i] = chunk
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import typing as t
+import asyncio
+import hmac
+import json
+import signal
+
+import structlog
+from telegram import Update
+from telegram.ext import Application, ExtBot
+
+from httpserver import Request, Response
+
+logger = structlog.get_logger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+def webhook_endpoint(app: Application, secret_token: t.Optional[str] = None):
+    """HTTP handler feeding Telegram webhook updates into `app`.
+
+    The update is only parsed and queued here, Telegram gets its 200 right
+    away and the handlers run in the background like polled updates. A JSON
+    list of updates, as forwarded by the sharding front, is queued in order.
+    """
+
+    async def endpoint(request: Request) -> Response:
+        if secret_token is not None and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, "").encode(), secret_token.encode()
+        ):
+            return Response(status=403)
+        try:
+            data = json.loads(request.body)
+            updates = [
+                Update.de_json(d, app.bot)
+                for d in (data if isinstance(data, list) else [data])
+            ]
+        except Exception:
+            logger.exception("invalid webhook update")
+            return Response(status=400)
+        for update in updates:
+            if update is None:
+                continue
+            if isinstance(app.bot, ExtBot):
+                app.bot.insert_callback_data(update)
+            app.update_queue.put_nowait(update)
+        return Response()
+
+    return endpoint
+
+
+def health_endpoint(app: Application):
+    async def endpoint(request: Request) -> Response:
+        if app.running:
+            return Response("ok")
+        return Response("starting", status=503)
+
+    return endpoint
+
+
+async def run_webhook(
+    app: Application,
+    url: t.Optional[str],
+    secret_token: t.Optional[str] = None,
+    drop_pending_updates: bool = False,
+):
+    """Run `app` receiving updates via webhook until SIGINT or SIGTERM.
+
+    The HTTP server receiving the updates is started by `app.post_init`. The
+    webhook isn't registered with Telegram if `url` is None, as for shard
+    workers fed by the front process.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    if app.post_init is not None:
+        await app.post_init(app)
+    try:
+        if url is not None:
+            await app.bot.set_webhook(
+                url,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=drop_pending_updates,
+            )
+            logger.info("webhook set", url=url)
+        await app.start()
+        await stop.wait()
+    finally:
+        if app.running:
+            await app.stop()
+        if app.post_shutdown is not None:
+            await app.post_shutdown(app)
+        await app.shutdown()